@@ -0,0 +1 @@
+../run_probe.py
\ No newline at end of file
@@ -5,23 +5,20 @@ import datetime
 import time
 import os
 import threading
-import glob
 import re
 import yaml
-import math
 import blinker
-import Queue
-import weakref
-import bitstring
-import subprocess
 
 import _strptime # Prevent import in thread
 
 from functools import partial
 from operator import itemgetter
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import illuminate
+import run_probe
+from tilemetrics import TileMetricsReader
+from watcher import RunFolderWatcher
 from flask import Flask, url_for, redirect, jsonify, Response, request
 
 # Limit number of completed runs to show, because the folders are not moved
@@ -37,6 +34,19 @@ SEQUENCER_LIST = [(seq['id'], (seq['type'], seq['name']))
 SEQUENCERS = dict(SEQUENCER_LIST)
 # Mark as cancelled if waiting for N times the measured cycle time
 CANCELLED_TIME_N_CYCLES = 3
+# Full update of the runs and the run storages (seconds)
+UPDATE_INTERVAL = 61
+# Check for new cycles of the runs in progress between the full updates
+# (seconds). The directory listings are cached by run_probe, so this is mostly
+# a few stat calls per run.
+POLL_INTERVAL = 10
+# inotify is only used if all run storages are on local file systems, as it
+# doesn't see changes made by other hosts on network file systems. Then the
+# run storages are only scanned at this interval (seconds), or when a change
+# is detected.
+STORAGE_RESCAN_INTERVAL = 600
+NETWORK_FS_TYPES = set(["nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "ceph", "glusterfs",
+    "fuse.sshfs", "fuse.glusterfs"])
 
 app = Flask(__name__)
 db = None # Set on bottom of script
@@ -44,14 +54,42 @@ db = None # Set on bottom of script
 def updater():
     """Updater background thread"""
 
+    last_update = 0
     while True:
-        db.update()
-        time.sleep(61)
+        if time.time() - last_update >= UPDATE_INTERVAL:
+            last_update = time.time()
+            db.update()
+        else:
+            db.poll_runs()
+        time.sleep(POLL_INTERVAL)
 
-MAX_ACTIVE_STREAMS = 19
-active_streams = []
+# Interval between the /status requests of each client (milliseconds)
+STATUS_RETRY_INTERVAL = 5000
+# Number of events kept for clients that reconnect with Last-Event-ID
+REPLAY_BUFFER_SIZE = 500
 KEEPALIVE_INTERVAL = 60 # Times sleep interval 61
 
+def is_network_filesystem(path):
+    """Check if path is on a network file system, based on the longest
+    matching mount point in /proc/mounts. Returns True if unknown."""
+    path = os.path.realpath(path)
+    fs_type = None
+    mount_length = -1
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) > mount_length:
+                    fs_type = fields[2]
+                    mount_length = len(mount_point)
+    except IOError:
+        return True
+    return fs_type is None or fs_type in NETWORK_FS_TYPES
+
 def machine_id(run_id):
     return re.match(r"\d{6}_([A-Z0-9]+)_.*", run_id).group(1)
 
@@ -65,6 +103,10 @@ class Database(object):
     def __init__(self):
         self.completed = set()
         self.status = {}
+        self.lock = threading.RLock()
+        self.watcher = None
+        self.last_rescan = 0
+        self.rescan_requested = True
         self.basecount_signal = blinker.Signal()
         self.run_status_signal = blinker.Signal()
         self.machine_list_signal = blinker.Signal()
@@ -85,20 +127,94 @@ class Database(object):
         except IOError:
             self.cancelled_runs = set()
 
+    def start_watcher(self):
+        """Use inotify to get notified of new cycles, if possible. Not used if
+        any run storage is on a network file system."""
+        if any(is_network_filesystem(run_storage) for run_storage, _ in RUN_STORAGES):
+            return
+        try:
+            self.watcher = RunFolderWatcher(self)
+        except OSError:
+            return
+        for run_storage, run_type in RUN_STORAGES:
+            self.watcher.watch_storage(run_storage)
+        watcher_thread = threading.Thread(target=self.watcher.run, name="watcher")
+        watcher_thread.daemon = True
+        watcher_thread.start()
+
+    def storage_changed(self):
+        """Called by the watcher when a run folder is created or removed."""
+        self.rescan_requested = True
+        self.update()
+
+    def run_event(self, run_id, finished=False):
+        """Called by the watcher when a new cycle or RTAComplete.txt is seen,
+        and by poll_runs(). The cycle is checked by run.update(), as the cycle
+        directory of CBCL runs is created before the data is written."""
+        with self.lock:
+            run = self.status.get(run_id)
+            if run is None:
+                return
+            if finished:
+                self.update() # Full update to add the bases to the total
+                return
+            if run.update():
+                if run.finished:
+                    self.update()
+                    return
+                self.basecount_signal.send(self, data=self.global_base_count)
+                if not run.hidden:
+                    self.run_status_signal.send(self, data=run.data_package)
+
+    def poll_runs(self):
+        """Check the runs in progress for new cycles, between the full updates.
+        Runs without metadata are left to the full update."""
+        with self.lock:
+            if self.watcher:
+                self.watch_runs(self.watcher)
+            for run in list(self.status.values()):
+                if run.read_config and not run.finished and not run.is_fake:
+                    self.run_event(run.run_id)
+
+    def watch_runs(self, watcher):
+        for r in self.status.values():
+            if r.finished:
+                watcher.unwatch_run(r.run_id)
+            elif not r.is_fake:
+                watcher.watch_run(r.run_id, r.run_dir)
+
+    def scan_storage(self):
+        """Find the run folders with some contents. The listings are cached by
+        run_probe, so the storages and run folders are only listed again when
+        they have been modified. Empty run folders are checked again on the
+        next update."""
+        self.runs_on_storage = {}
+        empty_run_dirs = False
+        for run_storage, run_type in RUN_STORAGES:
+            for run_id in run_probe.list_dir(run_storage):
+                if not re.match(r"[0-9]{6}_[A-Z0-9]+_[_A-Z0-9-]+$", run_id):
+                    continue
+                run_dir = os.path.join(run_storage, run_id)
+                if run_probe.list_dir(run_dir):
+                    self.runs_on_storage[run_id] = (run_dir, run_type)
+                else:
+                    empty_run_dirs = True
+        self.last_rescan = time.time()
+        self.rescan_requested = empty_run_dirs
+
     def update(self):
+        with self.lock:
+            self._update()
+
+    def _update(self):
         with open(self.COUNT_FILE) as f:
             self.count = int(f.read())
 
-        run_dirs_and_ids = [
-                (rpath, os.path.basename(os.path.dirname(rpath)), run_type)
-                for (run_storage, run_type) in RUN_STORAGES
-                for rpath in glob.glob(os.path.join(run_storage, "??????_*_*", "*"))
-            ]
-        runs_on_storage = {
-            run_id: (os.path.dirname(rpath), run_type)
-            for (rpath, run_id, run_type) in run_dirs_and_ids
-            if re.match(r"[0-9]{6}_[A-Z0-9]+_[_A-Z0-9-]+$", run_id)
-            }
+        watcher = self.watcher # May be set to None by the watcher thread
+        if watcher is None or self.rescan_requested or \
+                time.time() - self.last_rescan > STORAGE_RESCAN_INTERVAL:
+            self.scan_storage()
+        runs_on_storage = self.runs_on_storage
 
         new = set(runs_on_storage) - set(self.status.keys())
 
@@ -106,6 +222,9 @@ class Database(object):
             new_run = RunStatus(r_id, *runs_on_storage[r_id], start_cancelled=r_id in self.cancelled_runs)
             self.status[r_id] = new_run
 
+        if watcher:
+            self.watch_runs(watcher)
+
         modified = False
         updated = []
         for r in self.status.values():
@@ -125,6 +244,8 @@ class Database(object):
             if not self.status[r_id].is_fake:
                 del self.status[r_id]
                 self.booked_runs.discard(r_id)
+                if watcher:
+                    watcher.unwatch_run(r_id)
 
         self.booked_runs &= set(self.status.keys())
         new_cancelled_runs = set(k for (k, v) in self.status.items() if v.cancelled)
@@ -223,6 +344,7 @@ class RunStatus(object):
         self.current_cycle = 0
         self.total_cycles = 0
         self.clusters = 0
+        self.tile_metrics = TileMetricsReader(os.path.join(run_dir, "InterOp", "TileMetricsOut.bin"))
 
         self.last_update = time.time()
         self.booked = 0
@@ -248,40 +370,12 @@ class RunStatus(object):
         return self.total_cycles != 0
 
     def get_cycle(self):
-        for cycle in range(self.current_cycle, self.total_cycles):
-            test_paths = [
-                    os.path.join(
-                        self.run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                        "C{0}.1".format(cycle+1)
-                        ),
-                    os.path.join(
-                        self.run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                        "{0:04d}.bcl.bgzf".format(cycle+1)
-                        )
-                    ]
-            if not any(os.path.exists(test_path) for test_path in test_paths):
-                return cycle
-        return self.total_cycles
+        return run_probe.get_cycle(self.run_dir, self.total_cycles, self.current_cycle)
 
     def get_clusters(self):
-        instrument = SEQUENCERS[self.machine_id][0]
-        if instrument == "novaseq":
-            process = subprocess.Popen(['nsc-python27', 
-                            '/opt/gls/clarity/customextensions/lims/base-counter/clusters-helper.py',
-                             self.run_dir],
-                        stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
-            try:
-                out, _ = process.communicate()
-                val = float(out)
-                return None if math.isnan(val) else val
-            except (subprocess.CalledProcessError, ValueError):
-                return None
-        try:
-            ds = illuminate.InteropDataset(self.run_dir)
-            all_df = ds.TileMetrics().df
-        except (ValueError, TypeError, IOError, bitstring.ReadError, illuminate.InteropFileNotFoundError):
-            return None # No information yet, or it's being written to
-        return all_df[all_df.code == 103].sum().sum() # Number of clusters PF
+        """Number of clusters PF, or None if no information yet. Only the new
+        part of the tile metrics file is read on each call."""
+        return self.tile_metrics.update()
 
     def check_finished(self):
         return os.path.exists(os.path.join(self.run_dir, "RTAComplete.txt"))
@@ -443,61 +537,97 @@ class FakeRun(RunStatus):
         return True
 
 
-class EventQueuer(object):
-    """Helper class encapsulates a single type of signal, conversion
-    to queue data."""
+class EventPublisher(object):
+    """Helper class encapsulates a single type of signal, and passes
+    it to the hub with the event ID."""
 
-    def __init__(self, queue, ident):
-        self.queue = queue
+    def __init__(self, hub, ident):
+        self.hub = hub
         self.ident = ident
 
     def __call__(self, sender, data):
-        self.queue.put((self.ident, data))
+        self.hub.publish(self.ident, data)
+
 
-class SseStream(object):
-    """Usees a Queue to translate between a signal (method call
-    interface) and a generator protocol.
+def format_event(event_id, ident, data):
+    event_str = "id: {0}\n".format(event_id)
+    if ident is not None:
+        event_str += "event: " + ident + "\n"
+    event_str += 'data: ' + json.dumps(data) + '\n\n'
+    return event_str
 
-    This new version of SSE Stream can multiplex multiple signals
-    onto the event stream, setting the id of each event as appropriate.
-    The constructor argument is a list of event type sepecifications,
+
+class SseHub(object):
+    """Broadcasts events to all the /status clients.
+
+    Every time a signal is received, the data of the event is JSON
+    encoded once, and stored in a ring buffer with a sequential event ID.
+    A /status response contains the events the client hasn't seen, and
+    then ends. It starts with a retry field, so the client's EventSource
+    reconnects after STATUS_RETRY_INTERVAL, with the Last-Event-ID of the
+    last event it got. A client only holds a WSGI thread while its request
+    is handled, not for as long as the page is open. A client which
+    connects for the first time, or whose Last-Event-ID is no longer in
+    the buffer, gets the full current status.
+
+    The constructor argument is a list of event type specifications,
     encoded as tuples:
         (SIGNAL, ID)
-    Every time a signal is received, the data of the event is JSON
-    encoded and returned to the stream as a SSE, with the specified
-    ID ("event:" line).
-
-    The ID can be None, in which case no ID is sent.
+    The ID is sent in the "event:" line, and can be None, in which case
+    no ID is sent.
     """
 
-    TERMINATE = object()
-
-    def __init__(self, event_specs):
-        self.queue = Queue.Queue()
-        self.helpers = []
+    def __init__(self, event_specs, replay_size=REPLAY_BUFFER_SIZE):
+        self.lock = threading.Lock()
+        self.buffer = deque(maxlen=replay_size) # (event_id, event_str)
+        self.last_id = 0
+        self.publishers = [] # Signals only keep weak references
         for signal, ident in event_specs:
-            qr = EventQueuer(self.queue, ident)
-            signal.connect(qr)
-            self.helpers.append(qr)
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        ident, data = self.queue.get(block=True)
-        if ident is self.TERMINATE:
-            raise StopIteration()
-        event_str = ""
-        if ident is not None:
-            event_str = "event: " + ident + "\n"
-        event_str += 'data: ' + json.dumps(data) + '\n\n'
-        return event_str
+            publisher = EventPublisher(self, ident)
+            signal.connect(publisher)
+            self.publishers.append(publisher)
+
+    def publish(self, ident, data):
+        with self.lock:
+            self.last_id += 1
+            self.buffer.append((self.last_id, format_event(self.last_id, ident, data)))
+
+    def _events_after(self, event_id):
+        """List of events after event_id, or None if some of them are no
+        longer in the buffer. Call with the lock held."""
+        if event_id is None or event_id > self.last_id:
+            return None
+        if event_id == self.last_id:
+            return []
+        if not self.buffer or self.buffer[0][0] > event_id + 1:
+            return None
+        return [event_str for (eid, event_str) in self.buffer if eid > event_id]
+
+    def events(self, last_event_id, snapshot):
+        """List of event strings for one /status request. snapshot is a
+        function that returns the full current status as a list of (ID,
+        data)."""
+        with self.lock:
+            events = self._events_after(last_event_id)
+            position = self.last_id
+        response = ["retry: {0}\n\n".format(STATUS_RETRY_INTERVAL)]
+        if events is None:
+            # Initial status, or resynchronise a client which has missed events
+            response += [format_event(position, ident, data) for ident, data in snapshot()]
+        else:
+            response += events
+        return response
 
-    def update(self, ident, sender=None, data=None):
-        self.queue.put((ident, data))
 
-    def terminate(self):
-        self.queue.put((self.TERMINATE, None))
+def status_snapshot():
+    events = [
+        ("basecount", db.global_base_count),
+        ("machine_list", db.machine_list)
+    ]
+    for r in db.status.values():
+        if not r.hidden:
+            events.append(("run_status", r.data_package))
+    return events
 
 
 @app.route("/")
@@ -507,24 +637,11 @@ def get_main():
 
 @app.route("/status")
 def status():
-    global active_streams
-    active_streams = [stream for stream in active_streams if stream() is not None]
-    while len(active_streams) >= MAX_ACTIVE_STREAMS:
-        (active_streams.pop(0))().terminate()
-    events = [
-        (db.basecount_signal, "basecount"),
-        (db.run_status_signal, "run_status"),
-        (db.machine_list_signal, "machine_list")
-    ]
-    stream = SseStream(events)
-    # Send initial status
-    stream.update("basecount", data=db.global_base_count)
-    stream.update("machine_list", data=db.machine_list)
-    for r in db.status.values():
-        if not r.hidden:
-            stream.update("run_status", data=r.data_package)
-    active_streams.append(weakref.ref(stream))
-    return Response(stream, mimetype="text/event-stream")
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID'))
+    except (TypeError, ValueError):
+        last_event_id = None
+    return Response(hub.events(last_event_id, status_snapshot), mimetype="text/event-stream")
 
 @app.route("/machines")
 def machines():
@@ -549,6 +666,12 @@ def delete():
     return "OK"
 
 db = Database()
+hub = SseHub([
+        (db.basecount_signal, "basecount"),
+        (db.run_status_signal, "run_status"),
+        (db.machine_list_signal, "machine_list")
+    ])
+db.start_watcher()
 updater_thread = threading.Thread(target=updater, name="updater")
 updater_thread.daemon = True
 updater_thread.start()
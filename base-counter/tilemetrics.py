@@ -0,0 +1,104 @@
+# Incremental reader for InterOp/TileMetricsOut.bin
+
+# The tile metrics file is appended to while the run is in progress. The
+# reader remembers the offset of the last complete record, so each update only
+# reads the new records. Supports file format version 2 (HiSeq, MiSeq,
+# NextSeq) and version 3 (NovaSeq).
+
+import os
+import numpy
+
+# Version 2: code 103 is the number of clusters passing filter
+V2_RECORD = numpy.dtype([
+    ('lane', '<u2'),
+    ('tile', '<u2'),
+    ('code', '<u2'),
+    ('value', '<f4'),
+    ])
+V2_HEADER_SIZE = 2
+V2_CODE_CLUSTERS_PF = 103
+
+# Version 3: code 't' records contain the cluster count and the number of
+# clusters passing filter. Code 'r' records contain read-specific metrics, and
+# are ignored.
+V3_RECORD = numpy.dtype([
+    ('lane', '<u2'),
+    ('tile', '<u4'),
+    ('code', 'u1'),
+    ('value1', '<f4'),
+    ('value2', '<f4'),
+    ])
+V3_HEADER_SIZE = 6
+V3_CODE_CLUSTERS = ord('t')
+
+
+class TileMetricsReader(object):
+    """Keeps track of the number of clusters passing filter, summed over all
+    tiles. Call update() to read new data from the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.version = None
+        self.offset = 0
+        # (lane, tile) => clusters PF. If a tile is reported more than once,
+        # the last value is used.
+        self.tile_clusters_pf = {}
+
+    def _read_header(self, f):
+        header = f.read(2)
+        if len(header) < 2:
+            return False
+        version, record_size = bytearray(header)
+        if version == 2 and record_size == V2_RECORD.itemsize:
+            self.version, self.record, self.offset = 2, V2_RECORD, V2_HEADER_SIZE
+        elif version == 3 and record_size == V3_RECORD.itemsize:
+            self.version, self.record, self.offset = 3, V3_RECORD, V3_HEADER_SIZE
+        else:
+            raise ValueError("Unsupported tile metrics version {0} with record size {1}.".format(
+                version, record_size))
+        return True
+
+    def update(self):
+        """Read any new records. Returns the total clusters PF, or None if no
+        data are available yet."""
+        try:
+            size = os.path.getsize(self.path)
+            if size < self.offset:
+                # File has been replaced, start over
+                self.reset()
+            with open(self.path, 'rb') as f:
+                if self.version is None and not self._read_header(f):
+                    return None
+                num_records = (size - self.offset) // self.record.itemsize
+                if num_records > 0:
+                    f.seek(self.offset)
+                    buf = f.read(num_records * self.record.itemsize)
+                    # Only complete records are used; a partially written record
+                    # is read in the next update.
+                    num_records = len(buf) // self.record.itemsize
+                    data = numpy.frombuffer(
+                            buf[:num_records * self.record.itemsize],
+                            dtype=self.record
+                            )
+                    self.offset += num_records * self.record.itemsize
+                    self._add_records(data)
+        except (IOError, OSError, ValueError):
+            return None
+        if not self.tile_clusters_pf:
+            return None
+        return sum(self.tile_clusters_pf.values())
+
+    def _add_records(self, data):
+        if self.version == 2:
+            pf = data[data['code'] == V2_CODE_CLUSTERS_PF]
+            values = pf['value']
+        else:
+            pf = data[data['code'] == V3_CODE_CLUSTERS]
+            values = pf['value2']
+        self.tile_clusters_pf.update(zip(
+            zip(pf['lane'].tolist(), pf['tile'].tolist()),
+            values.tolist()
+            ))
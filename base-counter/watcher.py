@@ -0,0 +1,158 @@
+# Event-driven detection of new cycles and completed runs, using inotify
+
+# The watcher is an optimisation for run storages on local file systems.
+# inotify does not report changes made by other hosts on network file systems,
+# so it is not used if any run storage is on a network file system; the base
+# counter then polls the run folders, using the cached listings of run_probe.
+# If inotify is not available, RunFolderWatcher() raises OSError, and the base
+# counter also polls.
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+
+from run_probe import CYCLE_PATTERNS
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify(object):
+    """Minimal ctypes interface to the Linux inotify API."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "C library not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Unable to watch " + path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait for events, and return a list of (wd, mask, name) tuples."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos+length].rstrip(b"\0").decode('utf-8', 'replace')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+
+class RunFolderWatcher(object):
+    """Watches the run storage directories, the run folders and the BaseCalls/L001
+    directory of each run, and calls the following methods on the database
+    object:
+
+        storage_changed()                     -- run folder added or removed
+        run_event(run_id)                     -- new cycle seen in run folder
+        run_event(run_id, finished=True)      -- RTAComplete.txt created
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.inotify = Inotify()
+        self.lock = threading.Lock()
+        self.storage_wds = set()
+        self.run_wds = {}       # wd => run_id
+        self.basecalls_wds = {} # wd => run_id
+        self.runs = {}          # run_id => (run_dir wd, basecalls wd or None)
+
+    def watch_storage(self, path):
+        try:
+            self.storage_wds.add(self.inotify.add_watch(path, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR))
+        except OSError:
+            pass
+
+    def watch_run(self, run_id, run_dir):
+        """Start watching a run. May be called repeatedly; the BaseCalls/L001
+        directory is added when it exists."""
+        with self.lock:
+            run_wd, basecalls_wd = self.runs.get(run_id, (None, None))
+            try:
+                if run_wd is None:
+                    run_wd = self.inotify.add_watch(run_dir, IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF)
+                    self.run_wds[run_wd] = run_id
+                if basecalls_wd is None:
+                    basecalls_dir = os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L001")
+                    if os.path.isdir(basecalls_dir):
+                        basecalls_wd = self.inotify.add_watch(basecalls_dir, IN_CREATE | IN_MOVED_TO)
+                        self.basecalls_wds[basecalls_wd] = run_id
+            except OSError:
+                pass
+            self.runs[run_id] = (run_wd, basecalls_wd)
+
+    def unwatch_run(self, run_id):
+        with self.lock:
+            for wd in self.runs.pop(run_id, ()):
+                if wd is not None:
+                    self.inotify.rm_watch(wd)
+                    self.run_wds.pop(wd, None)
+                    self.basecalls_wds.pop(wd, None)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW or wd in self.storage_wds:
+            self.db.storage_changed()
+            return
+        with self.lock:
+            run_id = self.run_wds.get(wd)
+            basecalls_run_id = self.basecalls_wds.get(wd)
+        if run_id:
+            if mask & IN_DELETE_SELF:
+                self.db.storage_changed()
+            elif name == "RTAComplete.txt":
+                self.db.run_event(run_id, finished=True)
+        elif basecalls_run_id:
+            if any(pattern.match(name) for pattern in CYCLE_PATTERNS):
+                self.db.run_event(basecalls_run_id)
+
+    def run(self):
+        """Event loop, to be run in a background thread. If reading the events
+        fails, the watcher is removed from the database, which then falls
+        back to polling."""
+        try:
+            while True:
+                try:
+                    events = self.inotify.read()
+                except (select.error, OSError, IOError) as e:
+                    if e.args and e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for wd, mask, name in events:
+                    if mask & IN_IGNORED:
+                        continue
+                    try:
+                        self.handle_event(wd, mask, name)
+                    except Exception:
+                        pass # Errors are handled by the next periodic update
+        finally:
+            self.db.watcher = None
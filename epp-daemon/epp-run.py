@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Client shim for the EPP execution daemon (eppd.py)
+#
+# Usage: epp-run.py SCRIPT [ARGS...]
+#
+# Replace "python SCRIPT ARGS" with "python epp-run.py SCRIPT ARGS" in the
+# automation command line. The script is run by the daemon, with this
+# process' working directory, environment, stdout and stderr, and the exit
+# status is passed back. If the daemon is not running, the script is executed
+# directly by this interpreter, so the command line works in either case.
+#
+# This file only uses the standard library, to keep the startup time short.
+
+import os
+import sys
+import json
+import errno
+import shutil
+import select
+import socket
+import tempfile
+
+from eppd import default_socket_path
+
+
+def run_local(script, args):
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+
+def relay(fds):
+    """Copy data from the FIFO read ends to our own stdout / stderr, until all
+    writers have closed them."""
+    targets = dict(fds)
+    while targets:
+        try:
+            readable, _, _ = select.select(list(targets), [], [])
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in readable:
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if data:
+                os.write(targets[fd], data)
+            else:
+                os.close(fd)
+                del targets[fd]
+
+
+def read_message(conn_file):
+    line = conn_file.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+def main(script, args):
+    script = os.path.abspath(script)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(default_socket_path())
+    except socket.error:
+        conn.close()
+        run_local(script, args)
+
+    tempdir = tempfile.mkdtemp(prefix="epp-run-")
+    try:
+        stdout_path = os.path.join(tempdir, "stdout")
+        stderr_path = os.path.join(tempdir, "stderr")
+        os.mkfifo(stdout_path, 0o600)
+        os.mkfifo(stderr_path, 0o600)
+        # Non-blocking open of the read end succeeds without a writer
+        stdout_fd = os.open(stdout_path, os.O_RDONLY | os.O_NONBLOCK)
+        stderr_fd = os.open(stderr_path, os.O_RDONLY | os.O_NONBLOCK)
+
+        request = {
+                'script': script,
+                'args': args,
+                'cwd': os.getcwd(),
+                'env': dict(os.environ),
+                'stdout': stdout_path,
+                'stderr': stderr_path,
+                }
+        conn.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        conn_file = conn.makefile('rb')
+
+        message = read_message(conn_file)
+        if not message or not message.get('started'):
+            sys.stderr.write("EPP daemon failed to start the script. See the daemon log.\n")
+            return 1
+
+        relay([(stdout_fd, 1), (stderr_fd, 2)])
+
+        message = read_message(conn_file)
+        if not message:
+            sys.stderr.write("EPP daemon connection lost before the script completed.\n")
+            return 1
+        return message['exit']
+    finally:
+        conn.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("usage: epp-run.py SCRIPT [ARGS...]\n")
+        sys.exit(1)
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
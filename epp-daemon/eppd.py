@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# EPP execution daemon
+#
+# Keeps one interpreter running with genologics and the heavy scientific
+# modules already imported. Each request from the client shim (epp-run.py) is
+# handled in a forked child process, which runs the requested script with
+# runpy, as if it had been started from the command line. The fork gives every
+# script a pristine copy of the preloaded interpreter, so module-level globals
+# (e.g. `lims` in set-reagent-labels/indexes.py) are never shared between
+# scripts, while the expensive imports are only done once.
+#
+# The daemon must run as the same user and with the same Python version as the
+# automation worker would use for the scripts. Run one daemon per interpreter:
+#
+#   /usr/bin/python2 eppd.py &
+#   /usr/bin/python3 eppd.py &
+#
+# The socket name includes the Python major version, see default_socket_path().
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import random
+import runpy
+import logging
+import argparse
+import importlib
+import traceback
+
+
+# Modules imported before forking. Missing modules are skipped, as not all
+# servers have the same dependencies installed.
+DEFAULT_PRELOAD = [
+        "requests",
+        "genologics.lims",
+        "genologics.config",
+        "yaml",
+        "jinja2",
+        "xlwt",
+        "xlrd",
+        "openpyxl",
+        "docx",
+        "numpy",
+        "scipy.stats",
+        "matplotlib",
+        ]
+
+logger = logging.getLogger("eppd")
+
+
+def default_socket_path():
+    """Socket path used by both the daemon and the client, unless the EPPD_SOCKET
+    environment variable is set."""
+    return os.environ.get("EPPD_SOCKET") or "/tmp/eppd-{0}-py{1}.sock".format(
+            os.getuid(), sys.version_info[0])
+
+
+def preload(modules):
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            logger.warning("Unable to preload {0}: {1}".format(module, e))
+        else:
+            logger.info("Preloaded {0}".format(module))
+
+
+def read_request(conn):
+    """Read a single JSON line from the client."""
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise EOFError("Client disconnected before sending request")
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+def send_message(conn, **message):
+    conn.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+
+def native_str(value):
+    """JSON strings are unicode on Python 2, but scripts expect str in argv and
+    environ."""
+    if sys.version_info[0] == 2 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def run_script(script):
+    """Run script as __main__ in the current (child) process, and return the
+    exit status, following the same rules as the interpreter itself."""
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        elif isinstance(e.code, int):
+            return e.code
+        else:
+            print(e.code, file=sys.stderr)
+            return 1
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def handle_connection(conn):
+    """Child process: set up the environment given by the client and run the
+    script. Never returns."""
+    status = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        random.seed()
+
+        request = read_request(conn)
+        script = native_str(request['script'])
+        argv = [script] + [native_str(arg) for arg in request['args']]
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(
+                (native_str(k), native_str(v)) for k, v in request['env'].items()
+                )
+
+        # Connect the standard streams to the client's FIFOs. The client has
+        # already opened the read ends, so this does not block.
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        out_fd = os.open(request['stdout'], os.O_WRONLY)
+        err_fd = os.open(request['stderr'], os.O_WRONLY)
+        for fd, target in [(null_fd, 0), (out_fd, 1), (err_fd, 2)]:
+            os.dup2(fd, target)
+            os.close(fd)
+        send_message(conn, started=True)
+
+        sys.argv = argv
+        # Same as the interpreter does for "python script.py"
+        sys.path[0] = os.path.dirname(os.path.realpath(script))
+
+        start_time = time.time()
+        status = run_script(script)
+        wall_time = time.time() - start_time
+        logger.info("{0} {1} exit={2} wall={3:.3f}s".format(
+            script, " ".join(argv[1:]), status, wall_time))
+
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os.close(1)
+        os.close(2)
+        send_message(conn, exit=status, wall_time=wall_time)
+    except Exception:
+        logger.exception("Error while handling request")
+    finally:
+        os._exit(status)
+
+
+def reap_children(signum, frame):
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+
+def serve(socket_path):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(64)
+    logger.info("Listening on {0}".format(socket_path))
+
+    signal.signal(signal.SIGCHLD, reap_children)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                handle_connection(conn)
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run EPP scripts in a preloaded interpreter.")
+    parser.add_argument("--socket", default=default_socket_path(), help="Path of the UNIX socket")
+    parser.add_argument("--log", default=None, help="Log file (default: stderr)")
+    parser.add_argument("--preload", default=",".join(DEFAULT_PRELOAD),
+            help="Comma-separated list of modules to import at startup")
+    args = parser.parse_args()
+
+    # The handler is attached directly to our logger, and uses a private copy
+    # of stderr, so that neither the scripts' own logging configuration nor the
+    # redirection of fd 2 in the child affects the daemon log.
+    if args.log:
+        handler = logging.FileHandler(args.log)
+    else:
+        handler = logging.StreamHandler(os.fdopen(os.dup(2), 'w'))
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(process)d] %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    preload([module for module in args.preload.split(",") if module])
+    serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
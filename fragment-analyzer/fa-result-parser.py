@@ -118,7 +118,7 @@ def limslogic():
             pass
 
     if DEBUG: print output_artifacts.toxml()
-    r = api.POST( output_artifacts.toxml(), api.getBaseURI() + "artifacts/batch/update" )
+    r = api.updateArtifacts( output_artifacts.toxml() )
     if DEBUG: print r
     print "The file was parsed successfully,", updated_count, "of", len(resultMap), "samples updated."
 
@@ -1,14 +1,313 @@
 import urllib2
 import re
+import os
 import sys
+import time
+import atexit
+import threading
+import StringIO
 import xml.dom.minidom
 
+from multiprocessing.pool import ThreadPool
 from xml.dom.minidom import parseString
 from optparse import OptionParser
 from xml.sax.saxutils import escape
 
 DEBUG = 0
 
+try:
+	import requests
+	import requests.adapters
+except ImportError:
+	requests = None
+
+################################################
+## Shared HTTP transport
+################################################
+
+## All API objects with the same credentials share one transport. If the
+## requests module is available, the transport keeps a pool of keep-alive
+## connections, so only the first request pays for the TCP and TLS setup,
+## and requests failing with a transient server or connection error are
+## retried with exponential backoff. Otherwise, a new urllib2 opener is used
+## for each request. Set GLSAPIUTIL_STATS=1 to print request counts and times
+## on exit.
+
+RETRY_STATUS = ( 502, 503, 504 )
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+POOL_SIZE = 10
+TIMEOUT = 300
+
+class LimsTransport:
+
+	def __init__( self, base_uri, user, password ):
+		self.lock = threading.Lock()
+		self.stats = {}		## method => [ count, seconds ]
+		self.retries = 0
+		password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
+		password_manager.add_password( None, base_uri, user, password )
+		self.auth_handler = urllib2.HTTPBasicAuthHandler( password_manager )
+		if requests is not None:
+			self.session = requests.Session()
+			self.session.auth = ( user, password )
+			adapter = requests.adapters.HTTPAdapter( pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE )
+			self.session.mount( "http://", adapter )
+			self.session.mount( "https://", adapter )
+		else:
+			self.session = None
+
+	def open( self, method, url, data=None, headers=None ):
+
+		"""
+		Perform a request, and return a file-like object with the response body.
+		Errors are raised as urllib2.HTTPError and urllib2.URLError, also when using
+		requests, so the callers handle errors the same way in both cases.
+		"""
+
+		start = time.time()
+		try:
+			if self.session is None:
+				return self.__openUrllib2( method, url, data, headers )
+			else:
+				return self.__openSession( method, url, data, headers )
+		finally:
+			with self.lock:
+				counter = self.stats.setdefault( method, [ 0, 0.0 ] )
+				counter[0] += 1
+				counter[1] += time.time() - start
+
+	@staticmethod
+	def isRetryable( method, url ):
+		## Only requests which can safely be repeated
+		return method in ( "GET", "PUT", "DELETE" ) or url.endswith( "/batch/retrieve" )
+
+	def __openSession( self, method, url, data, headers ):
+
+		attempt = 0
+		while True:
+			retry = attempt < MAX_RETRIES and self.isRetryable( method, url )
+			try:
+				response = self.session.request( method, url, data=data, headers=headers, timeout=TIMEOUT )
+			except requests.exceptions.RequestException, e:
+				if not retry:
+					raise urllib2.URLError( str( e ) )
+			else:
+				if response.status_code not in RETRY_STATUS or not retry:
+					break
+			time.sleep( RETRY_BACKOFF * 2 ** attempt )
+			attempt += 1
+			with self.lock:
+				self.retries += 1
+
+		if response.status_code >= 400:
+			raise urllib2.HTTPError( url, response.status_code, response.reason,
+					response.headers, StringIO.StringIO( response.content ) )
+		return StringIO.StringIO( response.content )
+
+	def __openUrllib2( self, method, url, data, headers ):
+
+		opener = urllib2.build_opener( self.auth_handler )
+		req = urllib2.Request( url )
+		if data is not None:
+			req.add_data( data )
+		req.get_method = lambda: method
+		for name, value in ( headers or {} ).items():
+			req.add_header( name, value )
+		return opener.open( req )
+
+	def getStats( self ):
+
+		"""
+		Returns a dict with the number of requests and the total time in seconds
+		for each HTTP method, and the number of retries.
+		"""
+
+		with self.lock:
+			response = dict( ( method, tuple( counter ) ) for method, counter in self.stats.items() )
+			response[ "retries" ] = self.retries
+		return response
+
+	def report( self ):
+		stats = self.getStats()
+		retries = stats.pop( "retries" )
+		parts = [ "%s: %d in %.1f s" % ( method, count, seconds ) for method, ( count, seconds ) in sorted( stats.items() ) ]
+		return "API requests: " + ", ".join( parts ) + ", retries: %d" % retries
+
+_transports = {}
+_transportsLock = threading.Lock()
+
+def getTransport( base_uri, user, password ):
+	key = ( base_uri, user, password )
+	with _transportsLock:
+		if key not in _transports:
+			_transports[ key ] = LimsTransport( base_uri, user, password )
+		return _transports[ key ]
+
+def _reportStats():
+	for transport in _transports.values():
+		sys.stderr.write( transport.report() + "\n" )
+
+if os.environ.get( "GLSAPIUTIL_STATS" ):
+	atexit.register( _reportStats )
+
+################################################
+## Batch requests
+################################################
+
+## Large batch retrieve requests are split into chunks of at most BATCH_SIZE
+## entities, which are sent in parallel over the shared transport. The responses
+## are combined into one document, so the callers see the same result as for a
+## single request.
+##
+## A batch update request is atomic, but a split update is not. Updates are only
+## split above BATCH_UPDATE_SIZE entities (a 384 well plate with its outputs fits
+## in one request), and the chunks are sent in sequence, stopping at the first error.
+
+BATCH_SIZE = 200
+BATCH_UPDATE_SIZE = 1000
+BATCH_THREADS = 4
+
+## objectType => ( batch resource, element name )
+BATCH_TYPES = {
+	"artifact": ( "artifacts", "art:artifact" ),
+	"sample": ( "samples", "smp:sample" ),
+	"container": ( "containers", "con:container" ),
+	"file": ( "files", "file:file" ),
+}
+## Types which support batch/update
+BATCH_UPDATE_TYPES = ( "artifact", "sample", "container" )
+
+def chunks( items, size=BATCH_SIZE ):
+	items = list( items )
+	return [ items[ i:i+size ] for i in range( 0, len( items ), size ) ]
+
+def postChunks( post, url, payloads, threads=BATCH_THREADS ):
+
+	"""
+	POST each payload to url, using the function post( xmlObject, url ). Up to threads
+	requests are sent at the same time. Returns the response texts in the order of the payloads.
+	"""
+
+	if len( payloads ) <= 1:
+		return [ post( payload, url ) for payload in payloads ]
+	pool = ThreadPool( min( threads, len( payloads ) ) )
+	try:
+		return pool.map( lambda payload: post( payload, url ), payloads )
+	finally:
+		pool.close()
+
+def splitDetails( xmlObject, size=BATCH_SIZE ):
+
+	"""
+	Split a details document, as used by the batch/update resources, into documents
+	with at most size entities each.
+	"""
+
+	root = parseString( xmlObject ).documentElement
+	nodes = [ node for node in root.childNodes if node.nodeType == node.ELEMENT_NODE ]
+	if len( nodes ) <= size:
+		return [ xmlObject ]
+	payloads = []
+	for chunk in chunks( nodes, size ):
+		chunkRoot = root.cloneNode( False )
+		for node in chunk:
+			chunkRoot.appendChild( node.cloneNode( True ) )
+		payloads.append( chunkRoot.toxml( "utf-8" ) )
+	return payloads
+
+def isErrorResponse( response ):
+
+	"""
+	Check if a response is an exception document, or not XML at all.
+	"""
+
+	try:
+		dom = parseString( response )
+	except:
+		return True
+	return dom.documentElement.tagName.endswith( "exception" )
+
+def mergeResponses( responses ):
+
+	"""
+	Combine the responses to a chunked batch request into one document. If one of the
+	responses is an error message, it is returned instead.
+	"""
+
+	if len( responses ) == 1:
+		return responses[0]
+	for response in responses:
+		if isErrorResponse( response ):
+			return response
+	documents = [ parseString( response ) for response in responses ]
+	merged = documents[0]
+	for dom in documents[1:]:
+		for node in dom.documentElement.childNodes:
+			if node.nodeType == node.ELEMENT_NODE:
+				merged.documentElement.appendChild( merged.importNode( node, True ) )
+	return merged.toxml( "utf-8" )
+
+def updatedLUIDs( responses ):
+
+	"""
+	Get the LUIDs of the entities in the links of batch update responses.
+	"""
+
+	luids = []
+	for response in responses:
+		for node in parseString( response ).getElementsByTagName( "link" ):
+			luid = node.getAttribute( "limsid" ) or node.getAttribute( "uri" ).split( "?" )[0].split( "/" )[-1]
+			luids.append( luid )
+	return luids
+
+def partialUpdateError( response, luids ):
+
+	"""
+	Add the LUIDs which were already updated to the message of an error response.
+	"""
+
+	note = "%d entities were already updated by the previous requests: %s" % ( len( luids ), ", ".join( luids ) )
+	try:
+		dom = parseString( response )
+		messages = dom.getElementsByTagName( "message" )
+		if len( messages ) > 0 and messages[0].firstChild is not None:
+			messages[0].firstChild.data = messages[0].firstChild.data + " (" + note + ")"
+		else:
+			message = dom.createElement( "message" )
+			message.appendChild( dom.createTextNode( note ) )
+			dom.documentElement.appendChild( message )
+		return dom.toxml( "utf-8" )
+	except:
+		return response + "\n" + note
+
+def batchUpdate( post, xmlObject, url ):
+
+	"""
+	POST a details document to a batch/update url. Documents with more than BATCH_UPDATE_SIZE
+	entities are sent in chunks, one at a time. Returns the combined links, or the first error
+	response. If an error occurs after some chunks were written, the LUIDs of the updated
+	entities are added to the error message.
+	"""
+
+	## DOM.toxml() returns unicode, which can't be parsed or sent as such if it
+	## contains non-ASCII characters
+	if isinstance( xmlObject, unicode ):
+		xmlObject = xmlObject.encode( "utf-8" )
+	try:
+		payloads = splitDetails( xmlObject, BATCH_UPDATE_SIZE )
+	except:
+		payloads = [ xmlObject ]
+	responses = []
+	for payload in payloads:
+		response = post( payload, url )
+		if isErrorResponse( response ):
+			if len( responses ) > 0:
+				return partialUpdateError( response, updatedLUIDs( responses ) )
+			return response
+		responses.append( response )
+	return mergeResponses( responses )
+
 class glsapiutil2:
 
 	## Housekeeping methods
@@ -21,6 +320,7 @@ class glsapiutil2:
 		self.uri = ""
 		self.base_uri = ""
 		self.pythonVersion = sys.version.split( " " )[0]
+		self.transport = None
 
 	def setHostname( self, hostname ):
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
@@ -55,12 +355,14 @@ class glsapiutil2:
 			self.base_uri = self.hostname + '/api/' + self.version + '/'
 
 		## setup up API plumbing
-		password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-		password_manager.add_password( None, self.base_uri, user, password )
-		self.auth_handler = urllib2.HTTPBasicAuthHandler( password_manager )
+		self.transport = getTransport( self.base_uri, user, password )
+		self.auth_handler = self.transport.auth_handler
 		opener = urllib2.build_opener( self.auth_handler )
 		urllib2.install_opener( opener )
 
+	def getRequestStats( self ):
+		return self.transport.getStats()
+
 	## REST Methods
 
 	def GET( self, url ):
@@ -71,7 +373,7 @@ class glsapiutil2:
 		thisXML = ""
 
 		try:
-			thisXML = urllib2.urlopen( url ).read()
+			thisXML = self.transport.open( "GET", url ).read()
 		except urllib2.HTTPError, e:
 			responseText = e.msg
 		except urllib2.URLError, e:
@@ -94,17 +396,14 @@ class glsapiutil2:
 
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
 
-		opener = urllib2.build_opener(self.auth_handler)
-
-		req = urllib2.Request(url)
-		req.add_data( xmlObject )
-		req.get_method = lambda: 'PUT'
-		req.add_header('Accept', 'application/xml')
-		req.add_header('Content-Type', 'application/xml')
-		req.add_header('User-Agent', 'Python-urllib2/%s' % self.pythonVersion )
+		headers = {
+			'Accept': 'application/xml',
+			'Content-Type': 'application/xml',
+			'User-Agent': 'Python-urllib2/%s' % self.pythonVersion
+		}
 
 		try:
-			response = opener.open( req )
+			response = self.transport.open( 'PUT', url, xmlObject, headers )
 			responseText = response.read()
 		except urllib2.HTTPError, e:
 			responseText = e.msg
@@ -124,17 +423,14 @@ class glsapiutil2:
 
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
 
-		opener = urllib2.build_opener(self.auth_handler)
-
-		req = urllib2.Request(url)
-		req.add_data( xmlObject )
-		req.get_method = lambda: 'POST'
-		req.add_header('Accept', 'application/xml')
-		req.add_header('Content-Type', 'application/xml')
-		req.add_header('User-Agent', 'Python-urllib2/%s' % self.pythonVersion )
+		headers = {
+			'Accept': 'application/xml',
+			'Content-Type': 'application/xml',
+			'User-Agent': 'Python-urllib2/%s' % self.pythonVersion
+		}
 
 		try:
-			response = opener.open( req )
+			response = self.transport.open( 'POST', url, xmlObject, headers )
 			responseText = response.read()
 		except urllib2.HTTPError, e:
 			responseText = e.read()
@@ -293,31 +589,61 @@ class glsapiutil2:
 		else:
 			return response
 
+	def updateArtifacts( self, xmlObject ):
+
+		"""
+		This function will be passed the XML for a list of artifacts (as returned by getArtifacts), and
+		update them with batch requests. Very large lists are split into several requests, which are sent
+		one at a time (see batchUpdate). Returns the links to the updated artifacts, or the error message
+		from the API
+		"""
+
+		return self.__updateBatchObjects( xmlObject, "artifact" )
+
+	def updateSamples( self, xmlObject ):
+
+		"""
+		This function will be passed the XML for a list of samples (as returned by getSamples), and
+		update them with batch requests
+		"""
+
+		return self.__updateBatchObjects( xmlObject, "sample" )
+
+	def updateContainers( self, xmlObject ):
+
+		"""
+		This function will be passed the XML for a list of containers (as returned by getContainers), and
+		update them with batch requests
+		"""
+
+		return self.__updateBatchObjects( xmlObject, "container" )
+
 	def __getBatchObjects( self, LUIDs, objectType ):
 
-		if objectType == "artifact":
-			batchNoun = "artifacts"
-			nodeNoun = "art:artifact"
-		elif objectType == "sample":
-			batchNoun = "samples"
-			nodeNoun = "smp:sample"
-		elif objectType == "container":
-			batchNoun = "containers"
-			nodeNoun = "con:container"
-		elif objectType == "file":
-			batchNoun = "files"
-			nodeNoun = "file:file"
-		else:
+		if objectType not in BATCH_TYPES:
 			return None
+		batchNoun, nodeNoun = BATCH_TYPES[ objectType ]
 
-		lXML = []
-		lXML.append( '<ri:links xmlns:ri="http://genologics.com/ri">' )
+		## LUIDs may also be given as URIs
+		uris = []
 		for limsid in set(LUIDs):
-			lXML.append( '<link uri="%s%s/%s"/>' % ( self.getBaseURI(), batchNoun, limsid ) )
-		lXML.append( '</ri:links>' )
-		lXML = ''.join( lXML )
+			if "/" in limsid:
+				uris.append( limsid )
+			else:
+				uris.append( "%s%s/%s" % ( self.getBaseURI(), batchNoun, limsid ) )
+		if len( uris ) == 0:
+			return ""
+
+		payloads = []
+		for chunk in chunks( sorted( uris ) ):
+			lXML = []
+			lXML.append( '<ri:links xmlns:ri="http://genologics.com/ri">' )
+			for uri in chunk:
+				lXML.append( '<link uri="%s"/>' % escape( uri, { '"': "&quot;" } ) )
+			lXML.append( '</ri:links>' )
+			payloads.append( ''.join( lXML ) )
 
-		mXML = self.POST( lXML, "%s%s/batch/retrieve" % ( self.getBaseURI(), batchNoun ) )
+		mXML = mergeResponses( postChunks( self.POST, "%s%s/batch/retrieve" % ( self.getBaseURI(), batchNoun ), payloads ) )
 
 		## did we get back anything useful?
 		try:
@@ -332,22 +658,27 @@ class glsapiutil2:
 
 		return response
 
+	def __updateBatchObjects( self, xmlObject, objectType ):
+
+		if objectType not in BATCH_UPDATE_TYPES:
+			return None
+		batchNoun = BATCH_TYPES[ objectType ][0]
+
+		return batchUpdate( self.POST, xmlObject, "%s%s/batch/update" % ( self.getBaseURI(), batchNoun ) )
+
 
         def deleteObject( self, xmlObject, url):
             
-                opener = urllib2.build_opener(self.auth_handler)
-            
-                req = urllib2.Request(url)
-                req.add_data( xmlObject )
-                req.get_method = lambda: 'DELETE'
-                req.add_header('Accept', 'application/xml')
-                req.add_header('Content-Type', 'application/xml')
-                req.add_header('User-Agent', 'Python-urllib2/2.4')
+                headers = {
+                    'Accept': 'application/xml',
+                    'Content-Type': 'application/xml',
+                    'User-Agent': 'Python-urllib2/2.4'
+                }
             
                 responseText = "EMPTY"
             
                 try:
-                    response = opener.open( req )
+                    response = self.transport.open( 'DELETE', url, xmlObject, headers )
                     responseText = response.read()
                 except urllib2.HTTPError, e:
                     responseText = e.read()
@@ -366,6 +697,7 @@ class glsapiutil:
 		self.hostname = ""
 		self.auth_handler = ""
 		self.version = "v1"
+		self.transport = None
 
 	def setHostname( self, hostname ):
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
@@ -380,30 +712,29 @@ class glsapiutil:
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
 
 		## setup up API plumbing
-		password_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-		password_manager.add_password( None, self.hostname + '/api/' + self.version, user, password )
-		self.auth_handler = urllib2.HTTPBasicAuthHandler(password_manager)
+		self.transport = getTransport( self.hostname + '/api/' + self.version, user, password )
+		self.auth_handler = self.transport.auth_handler
 		opener = urllib2.build_opener(self.auth_handler)
 		urllib2.install_opener(opener)
 
+	def getRequestStats( self ):
+		return self.transport.getStats()
+
 	## REST methods
 
 
         def deleteObject( self, xmlObject, url):
             
-                opener = urllib2.build_opener(self.auth_handler)
-            
-                req = urllib2.Request(url)
-                req.add_data( xmlObject )
-                req.get_method = lambda: 'DELETE'
-                req.add_header('Accept', 'application/xml')
-                req.add_header('Content-Type', 'application/xml')
-                req.add_header('User-Agent', 'Python-urllib2/2.4')
+                headers = {
+                    'Accept': 'application/xml',
+                    'Content-Type': 'application/xml',
+                    'User-Agent': 'Python-urllib2/2.4'
+                }
             
                 responseText = "EMPTY"
             
                 try:
-                    response = opener.open( req )
+                    response = self.transport.open( 'DELETE', url, xmlObject, headers )
                     responseText = response.read()
                 except urllib2.HTTPError, e:
                     responseText = e.read()
@@ -416,17 +747,14 @@ class glsapiutil:
 
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
 
-		opener = urllib2.build_opener(self.auth_handler)
-
-		req = urllib2.Request(url)
-		req.add_data( xmlObject )
-		req.get_method = lambda: 'POST'
-		req.add_header('Accept', 'application/xml')
-		req.add_header('Content-Type', 'application/xml')
-		req.add_header('User-Agent', 'Python-urllib2/2.6')
+		headers = {
+			'Accept': 'application/xml',
+			'Content-Type': 'application/xml',
+			'User-Agent': 'Python-urllib2/2.6'
+		}
 
 		try:
-			response = opener.open( req )
+			response = self.transport.open( 'POST', url, xmlObject, headers )
 			responseText = response.read()
 		except urllib2.HTTPError, e:
 			responseText = e.read()
@@ -439,17 +767,14 @@ class glsapiutil:
 
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
 
-		opener = urllib2.build_opener(self.auth_handler)
-
-		req = urllib2.Request(url)
-		req.add_data( xmlObject )
-		req.get_method = lambda: 'PUT'
-		req.add_header('Accept', 'application/xml')
-		req.add_header('Content-Type', 'application/xml')
-		req.add_header('User-Agent', 'Python-urllib2/2.6')
+		headers = {
+			'Accept': 'application/xml',
+			'Content-Type': 'application/xml',
+			'User-Agent': 'Python-urllib2/2.6'
+		}
 
 		try:
-			response = opener.open( req )
+			response = self.transport.open( 'PUT', url, xmlObject, headers )
 			responseText = response.read()
 		except urllib2.HTTPError, e:
 			responseText = e.read()
@@ -466,7 +791,7 @@ class glsapiutil:
 		xml = ""
 
 		try:
-			xml = urllib2.urlopen( url ).read()
+			xml = self.transport.open( "GET", url ).read()
 		except urllib2.HTTPError, e:
 			responseText = e.msg
 		except urllib2.URLError, e:
@@ -489,17 +814,14 @@ class glsapiutil:
 
 		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
 
-		opener = urllib2.build_opener(self.auth_handler)
-
-		req = urllib2.Request(url)
-		req.add_data( links )
-		req.get_method = lambda: 'POST'
-		req.add_header('Accept', 'application/xml')
-		req.add_header('Content-Type', 'application/xml')
-		req.add_header('User-Agent', 'Python-urllib2/2.6')
+		headers = {
+			'Accept': 'application/xml',
+			'Content-Type': 'application/xml',
+			'User-Agent': 'Python-urllib2/2.6'
+		}
 
 		try:
-			response = opener.open( req )
+			response = self.transport.open( 'POST', url, links, headers )
 			responseText = response.read()
 		except urllib2.HTTPError, e:
 			responseText = e.read()
@@ -508,6 +830,18 @@ class glsapiutil:
 
 		return responseText
 
+	def updateBatchResourceByURI( self, url, details ):
+
+		"""
+		POST a details document to a batch/update resource. Very large documents are split into
+		several requests, which are sent one at a time (see batchUpdate). Returns the combined links,
+		or the error message from the API
+		"""
+
+		if DEBUG > 0: print( "%s:%s called" % ( self.__module__, sys._getframe().f_code.co_name ) )
+
+		return batchUpdate( self.createObject, details, url )
+
 	## Helper methods
 
 	@staticmethod
@@ -4,6 +4,7 @@
 from optparse import OptionParser
 import glsapiutil
 from xml.dom.minidom import parseString
+from xml.sax.saxutils import escape, quoteattr
 import logging
 import datetime
 import socket
@@ -11,6 +12,8 @@ import socket
 # This script expects the file to have three columns, in the order: Reagent Name,Sequence,Reagent Category
 HOSTNAME = socket.gethostname() # Use local hostname of LIMS server
 newLine = "\r"
+# Concurrent POST requests when adding reagent types
+IMPORT_THREADS = 8
 
 def downloadfile( file_art_luid ):
 
@@ -30,6 +33,30 @@ def downloadfile( file_art_luid ):
     raw.close
     return r
 
+def listReagentTypes():
+
+    """
+    Returns the names of all reagent types in Clarity, following the pages of the list resource
+    """
+
+    names = set()
+    url = api.getBaseURI() + "reagenttypes"
+    while url:
+        dom = parseString( api.GET( url ) )
+        for node in dom.getElementsByTagName( "reagent-type" ):
+            names.add( node.getAttribute( "name" ) )
+        nextPage = dom.getElementsByTagName( "next-page" )
+        url = nextPage[0].getAttribute( "uri" ) if nextPage else None
+    return names
+
+def reagentTypeXML( ReagentName, Sequence, ReagentCategory ):
+
+    rtpXML = [ '<?xml version="1.0" encoding="UTF-8"?><rtp:reagent-type xmlns:rtp="http://genologics.com/ri/reagenttype"' ]
+    rtpXML.append( ' name=' + quoteattr( ReagentName ) + '><special-type name="Index">' )
+    rtpXML.append( '<attribute value=' + quoteattr( Sequence ) + ' name="Sequence"/></special-type>' )
+    rtpXML.append( '<reagent-category>' + escape( ReagentCategory ) + '</reagent-category></rtp:reagent-type>' )
+    return ''.join( rtpXML )
+
 def importIndexes():
 
     csvData = downloadfile( args.fileLUID ).split("\n")[0]
@@ -38,34 +65,64 @@ def importIndexes():
     IndexList = list( i for i in IndexList if len(i) > 2 )
     logging.info(' Attempting to add ' + str(len(IndexList)) + ' Indexes' )
 
-    count = 0
+    ## Check the whole file, and the names of the existing reagent types, before adding anything
+    existing = listReagentTypes()
+    newIndexes = []
+    skipped = []
+    invalid = []
+    seen = set()
     for line in IndexList:
+        fields = [ f.strip() for f in line.split(",") ]
+        if len( fields ) != 3:
+            invalid.append( line )
+            logging.warning( line + ' does not have three columns. This Index was not added.' )
+            continue
+        ReagentName, Sequence, ReagentCategory = fields
+        if not Sequence or not min( n in 'CTAG' for n in Sequence ):
+            # Checks The sequence is valid nucliotides
+            invalid.append( ReagentName )
+            logging.warning( str( ReagentName ) + ' does not have a valid nucleotide sequence. This Index was not added.' )
+        elif ReagentName in existing or ReagentName in seen:
+            skipped.append( ReagentName )
+            logging.info( str( ReagentName ) + ' already exists, or is repeated in the file. This Index was not added.' )
+        else:
+            seen.add( ReagentName )
+            newIndexes.append( ( ReagentName, Sequence, ReagentCategory ) )
+
+    responses = glsapiutil.postChunks( api.POST, api.getBaseURI() + "reagenttypes",
+            [ reagentTypeXML( *index ) for index in newIndexes ], IMPORT_THREADS )
 
-        ReagentName, Sequence, ReagentCategory = line.split(",")
-        #print ReagentName, Sequence, ReagentCategory
-
-        rtpXML = [ '<?xml version="1.0" encoding="UTF-8"?><rtp:reagent-type xmlns:rtp="http://genologics.com/ri/reagenttype"' ]
-        rtpXML.append( ' name="' + ReagentName + '"><special-type name="Index">' )
-        rtpXML.append( '<attribute value="' + Sequence + '" name="Sequence"/></special-type>' )
-        rtpXML.append( '<reagent-category>' + ReagentCategory + '</reagent-category></rtp:reagent-type>' )
+    count = 0
+    failed = []
+    for ( ReagentName, Sequence, ReagentCategory ), r in zip( newIndexes, responses ):
         try:
-            if min( n in 'CTAG' for n in Sequence ):
-                # Checks The sequence is valid nucliotides
-
-                r = api.POST( ''.join( rtpXML ), api.getBaseURI() + "reagenttypes" )
-                #print r
-                if len( parseString( r ).getElementsByTagName("exc:exception")) > 0 :
-                    logging.warning( str( ReagentName ) + ' could not be added. (code1)' )
-                    logging.warning( str( parseString( r ).getElementsByTagName("message")[0].firstChild.data ) )
-                else:
-                    count += 1
-            else:
-                logging.warning( str( ReagentName ) + ' does not have a valid nucleotide sequence. This Index was not added.' )
+            rDOM = parseString( r )
+            messages = rDOM.getElementsByTagName("message")
+            error = len( rDOM.getElementsByTagName("exc:exception") ) > 0
         except:
-            logging.warning( str( ReagentName ) + ' could not be added. (code2)' )
-
-    print str( count ) + " new indexes were added to Clarity."
+            messages = []
+            error = True
+        if error:
+            failed.append( ReagentName )
+            logging.warning( str( ReagentName ) + ' could not be added.' )
+            logging.warning( str( messages[0].firstChild.data ) if messages else str( r ) )
+        else:
+            count += 1
+
+    summary = str( count ) + " new indexes were added to Clarity."
+    details = []
+    if skipped:
+        details.append( str( len( skipped ) ) + " already existed or were repeated" )
+    if invalid:
+        details.append( str( len( invalid ) ) + " were invalid" )
+    if failed:
+        details.append( str( len( failed ) ) + " failed" )
+    if details:
+        summary += " (" + ", ".join( details ) + ", see log)"
+    print summary
     logging.info( str( count ) + " of " + str(len(IndexList)) + " new indexes were added to Clarity.")
+    if failed:
+        logging.info( "Failed: " + ", ".join( failed ) )
 
 def setupArguments():
 
@@ -0,0 +1,187 @@
+# Cached run summaries from the InterOp files of a run folder
+
+# NOTE: This file is used from ../sequencing/ and ../misc/, via symlinks
+
+# Reading the InterOp files of a NovaSeq run and summarising them takes a long
+# time, and the same run is summarised by several scripts. The summary values
+# that are used are saved to a JSON file per run ID, together with the name,
+# size and modification time of the InterOp files. The InterOp files are only
+# read again if one of them has changed, so a finished run is only parsed once.
+# Summaries of many runs can be computed in parallel with get_summaries(), which
+# uses a process pool, as the parsing is CPU bound.
+#
+# The scripts run as different users (the Clarity EPP user, cron jobs, and
+# manual backfills), so the cache is in a shared directory, which is created
+# group-writable and setgid, and the cache files are group-writable. The users
+# should be members of the group that owns the directory. The location can be
+# changed with the environment variable INTEROP_SUMMARY_CACHE_DIR. If the cache
+# can't be written, the summaries are still returned, but not saved.
+#
+# Summary format:
+#   {'lane_count': N, 'reads': [{'number': 1, 'is_index': False,
+#                                'lanes': [{'yield_g': ..., ...}, ...]}, ...]}
+# with one entry per lane, in lane order, for each read.
+
+import os
+import json
+import math
+import errno
+import tempfile
+import traceback
+from multiprocessing import Pool
+
+try:
+    from interop import py_interop_run_metrics, py_interop_run, py_interop_summary
+except ImportError:
+    py_interop_run_metrics = None
+
+CACHE_DIR = os.environ.get("INTEROP_SUMMARY_CACHE_DIR", "/var/cache/nsc-lims/interop-summaries")
+
+# Files in the run folder which affect the summary, in addition to InterOp/
+RUN_FILES = ["RunInfo.xml", "RunParameters.xml", "runParameters.xml"]
+
+# Number of runs to summarise in parallel in get_summaries()
+SUMMARY_PROCESSES = 4
+
+# Summary values for each lane and read: name => function of the lane summary
+LANE_VALUES = [
+        ('yield_g', lambda lane: lane.yield_g()),
+        ('percent_gt_q30', lambda lane: lane.percent_gt_q30()),
+        ('density', lambda lane: lane.density().mean()),
+        ('reads_pf', lambda lane: lane.reads_pf()),
+        ('percent_pf', lambda lane: lane.percent_pf().mean()),
+        ('first_cycle_intensity', lambda lane: lane.first_cycle_intensity().mean()),
+        ('error_rate', lambda lane: lane.error_rate().mean()),
+        ('phasing', lambda lane: lane.phasing().mean()),
+        ('prephasing', lambda lane: lane.prephasing().mean()),
+        ('percent_aligned', lambda lane: lane.percent_aligned().mean()),
+        ('percent_occupied', lambda lane: lane.percent_occupied().mean()),
+        ]
+
+
+def file_signature(run_dir):
+    """Get a list of [name, size, mtime] of the InterOp files and run
+    parameter files, which changes if any of them are modified."""
+    signature = []
+    interop_dir = os.path.join(run_dir, "InterOp")
+    paths = [os.path.join("InterOp", name) for name in sorted(os.listdir(interop_dir))] + RUN_FILES
+    for path in paths:
+        try:
+            st = os.stat(os.path.join(run_dir, path))
+        except OSError:
+            continue
+        signature.append([path, st.st_size, st.st_mtime])
+    return signature
+
+
+def read_summary(run_dir):
+    """Parse the InterOp files and return the summary (see top of file)."""
+    if py_interop_run_metrics is None:
+        raise RuntimeError("The InterOp library (interop) is not installed.")
+    valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
+    py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
+    valid_to_load[py_interop_run.ExtendedTile] = 1
+    run_metrics = py_interop_run_metrics.run_metrics()
+    run_metrics.read(run_dir, valid_to_load)
+    summary = py_interop_summary.run_summary()
+    py_interop_summary.summarize_run_metrics(run_metrics, summary)
+
+    reads = []
+    for read in range(summary.size()):
+        read_data = summary.at(read)
+        reads.append({
+            'number': read_data.read().number(),
+            'is_index': bool(read_data.read().is_index()),
+            'lanes': [
+                dict((name, func(read_data.at(lane))) for name, func in LANE_VALUES)
+                for lane in range(summary.lane_count())
+                ]
+            })
+    return {'lane_count': summary.lane_count(), 'reads': reads}
+
+
+def cache_path(run_dir):
+    return os.path.join(CACHE_DIR, os.path.basename(os.path.normpath(run_dir)) + ".json")
+
+
+def get_summary(run_dir):
+    """Get the summary of a run, from the cache if the files are unchanged.
+    Failure to write the cache is not fatal."""
+    signature = file_signature(run_dir)
+    path = cache_path(run_dir)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['signature'] == signature:
+            return cached['summary']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    summary = read_summary(run_dir)
+    try:
+        try:
+            os.makedirs(CACHE_DIR)
+            os.chmod(CACHE_DIR, 0o2775)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'signature': signature, 'summary': summary}, f, separators=(',', ':'))
+        os.chmod(tmp_path, 0o664)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+    return summary
+
+
+def _get_summary_or_error(run_dir):
+    try:
+        return run_dir, get_summary(run_dir), None
+    except Exception:
+        return run_dir, None, traceback.format_exc()
+
+
+def get_summaries(run_dirs, processes=SUMMARY_PROCESSES):
+    """Get the summaries of many runs, using a process pool. Generates
+    (run_dir, summary, error) tuples as the runs are completed, in any order.
+    If the summary could not be computed, summary is None and error is the
+    traceback as a string."""
+    run_dirs = list(run_dirs)
+    if not run_dirs:
+        return
+    pool = Pool(min(processes, len(run_dirs)))
+    try:
+        for result in pool.imap_unordered(_get_summary_or_error, run_dirs):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def nan_to_zero(val):
+    if math.isnan(val): return 0.0
+    else: return val
+
+
+def lane_udfs(summary, lane_number):
+    """Get a dict of the lane metric UDFs for the Measurement output of a lane
+    (1-based), from the summary. Reads are labelled R1, R2, ... in order of
+    the non-index reads."""
+    lane_index = lane_number - 1
+    udfs = {}
+    nonindex_reads = [read for read in summary['reads'] if not read['is_index']]
+    for i, read in enumerate(nonindex_reads):
+        read_label = str(i + 1)
+        lane_summary = read['lanes'][lane_index]
+        udfs['Yield PF (Gb) R{}'.format(read_label)] = lane_summary['yield_g']
+        udfs['% Bases >=Q30 R{}'.format(read_label)] = lane_summary['percent_gt_q30']
+        udfs['Cluster Density (K/mm^2) R{}'.format(read_label)] = lane_summary['density']
+        udfs['Reads PF (M) R{}'.format(read_label)] = lane_summary['reads_pf'] / 1.0e6
+        udfs['%PF R{}'.format(read_label)] = lane_summary['percent_pf']
+        udfs['Intensity Cycle 1 R{}'.format(read_label)] = lane_summary['first_cycle_intensity']
+        udfs['% Error Rate R{}'.format(read_label)] = nan_to_zero(lane_summary['error_rate'])
+        udfs['% Phasing R{}'.format(read_label)] = nan_to_zero(lane_summary['phasing'])
+        udfs['% Prephasing R{}'.format(read_label)] = nan_to_zero(lane_summary['prephasing'])
+        udfs['% Aligned R{}'.format(read_label)] = nan_to_zero(lane_summary['percent_aligned'])
+        udfs['% Occupied Wells'] = nan_to_zero(lane_summary['percent_occupied'])
+    return udfs
@@ -0,0 +1,355 @@
+# Local snapshot of LIMS entities, for read-only tools
+
+# NOTE: This file is used from ../reports/ and ../misc/, via symlinks
+
+# The snapshot is an SQLite file with the XML of projects, samples, artifacts,
+# containers and processes, and the links between them. It is updated
+# incrementally, e.g. by a cron job outside working hours (run this file as a
+# script). Only projects, containers and processes can be listed by
+# last-modified time in the API, so the other entity types are found through
+# them:
+#
+#  - samples of the modified projects, and of the artifacts below
+#  - artifacts used or produced by the modified processes
+#
+# Changes to samples and artifacts that don't involve a modified project or
+# process (e.g. a UDF edited in the sample list) are only picked up by a full
+# update. Artifacts, samples and containers are fetched with batch requests,
+# projects and processes with concurrent GET requests.
+#
+# Tools get genologics entity objects with the XML loaded from the snapshot,
+# so they can use the usual attributes without making any requests. Entities
+# which are not in the snapshot are loaded from the API when accessed.
+
+import os
+import re
+import time
+import sqlite3
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
+from genologics.lims import Project, Sample, Artifact, Container, Process
+
+# Concurrent GET requests for projects and processes
+FETCH_THREADS = 8
+# Entities per batch request
+BATCH_SIZE = 500
+# Overlap between incremental updates, to allow for clock differences
+LAST_MODIFIED_MARGIN = datetime.timedelta(minutes=2)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nsc-lims")
+
+# Entity type => (class, list resource)
+ENTITY_TYPES = {
+        'project': (Project, "projects"),
+        'sample': (Sample, "samples"),
+        'artifact': (Artifact, "artifacts"),
+        'container': (Container, "containers"),
+        'process': (Process, "processes"),
+        }
+# Types which can be listed by last-modified time
+MODIFIED_TYPES = ('project', 'container', 'process')
+BATCH_TYPES = ('sample', 'artifact', 'container')
+
+
+def lims_timestamp(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def limsid_from_uri(uri):
+    return uri.split("?")[0].rstrip("/").split("/")[-1]
+
+
+def entity_links(entity_type, root):
+    """Get the name, the date and a list of (relation, limsid) links from the
+    XML of an entity."""
+    name = root.findtext('name')
+    date = None
+    links = []
+    if entity_type == 'project':
+        date = root.findtext('open-date')
+    elif entity_type == 'sample':
+        date = root.findtext('date-received')
+        for tag in ('project', 'artifact'):
+            node = root.find(tag)
+            if node is not None:
+                links.append((tag, node.attrib['limsid']))
+    elif entity_type == 'artifact':
+        for node in root.findall('sample'):
+            links.append(('sample', node.attrib['limsid']))
+        node = root.find('parent-process')
+        if node is not None:
+            links.append(('parent-process', node.attrib['limsid']))
+        node = root.find('location/container')
+        if node is not None:
+            links.append(('container', node.attrib['limsid']))
+    elif entity_type == 'process':
+        date = root.findtext('date-run')
+        for iomap in root.findall('input-output-map'):
+            for tag in ('input', 'output'):
+                node = iomap.find(tag)
+                if node is not None:
+                    links.append((tag, limsid_from_uri(node.attrib['uri'])))
+    return name, date, links
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+class SnapshotStore(object):
+    """SQLite store of entity XML. If the file can't be opened, an in-memory
+    database is used."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            # Allow tools to read while the snapshot is being updated
+            self.db.execute("PRAGMA journal_mode=WAL")
+        except (OSError, sqlite3.Error):
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS entity (
+                        type TEXT,
+                        limsid TEXT,
+                        uri TEXT,
+                        name TEXT,
+                        date TEXT,
+                        xml TEXT,
+                        updated REAL,
+                        PRIMARY KEY (type, limsid)
+                        )""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS link (
+                        type TEXT,
+                        limsid TEXT,
+                        relation TEXT,
+                        target TEXT
+                        )""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS link_source ON link (type, limsid)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS link_target ON link (relation, target)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entity_date ON entity (type, date)")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+                        type TEXT PRIMARY KEY,
+                        value TEXT
+                        )""")
+
+    # Writing
+
+    def save(self, entity_type, entities):
+        """Store the XML of loaded genologics entities."""
+        rows = []
+        for entity in entities:
+            if entity.root is None:
+                continue
+            name, date, links = entity_links(entity_type, entity.root)
+            xml = ElementTree.tostring(entity.root, encoding="utf-8")
+            rows.append((entity.id, entity.uri, name, date, xml.decode('utf-8'), links))
+        now = time.time()
+        with self.lock, self.db:
+            for limsid, uri, name, date, xml, links in rows:
+                self.db.execute("INSERT OR REPLACE INTO entity VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (entity_type, limsid, uri, name, date, xml, now))
+                self.db.execute("DELETE FROM link WHERE type=? AND limsid=?", (entity_type, limsid))
+                self.db.executemany("INSERT INTO link VALUES (?, ?, ?, ?)",
+                        [(entity_type, limsid, relation, target) for relation, target in links])
+
+    def fetch(self, lims, entity_type, entities):
+        """Load the entities from the API, and store them. Returns the list
+        of entities."""
+        entities = list(entities)
+        if not entities:
+            return entities
+        if entity_type in BATCH_TYPES:
+            for chunk in chunks(entities):
+                lims.get_batch(chunk, force=True)
+        else:
+            pool = ThreadPool(min(FETCH_THREADS, len(entities)))
+            try:
+                pool.map(lambda entity: entity.get(force=True), entities)
+            finally:
+                pool.close()
+        self.save(entity_type, entities)
+        return entities
+
+    def _list(self, lims, entity_type, params):
+        """Get the URIs from a list resource, following all pages. (Using a
+        loop similar to Lims._get_instances())"""
+        cls, resource = ENTITY_TYPES[entity_type]
+        uris = []
+        root = lims.get(lims.get_uri(resource), params=params)
+        while root is not None:
+            for node in root.findall(entity_type):
+                uris.append(node.attrib['uri'])
+            node = root.find('next-page')
+            root = None
+            if node is not None:
+                root = lims.get(node.attrib['uri'])
+        return uris
+
+    def last_update(self, entity_type):
+        """Time of the last update of an entity type, as a LIMS timestamp, or
+        None."""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM sync_state WHERE type=?",
+                    (entity_type,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, lims, full=False, types=tuple(ENTITY_TYPES)):
+        """Fetch the entities modified since the last update (or all, if full
+        is True or the type has not been updated before). Samples and
+        artifacts are only updated if projects and processes, respectively,
+        are also updated. Returns a dict with the number of entities fetched
+        of each type."""
+        start = lims_timestamp(datetime.datetime.utcnow() - LAST_MODIFIED_MARGIN)
+        fetched = {}
+        full_listing = set()
+        for entity_type in MODIFIED_TYPES:
+            if entity_type not in types:
+                continue
+            since = None if full else self.last_update(entity_type)
+            if since is None:
+                full_listing.add(entity_type)
+            cls = ENTITY_TYPES[entity_type][0]
+            uris = self._list(lims, entity_type, {'last-modified': since} if since else {})
+            fetched[entity_type] = self.fetch(lims, entity_type, [cls(lims, uri=uri) for uri in uris])
+
+        if 'artifact' in types:
+            artifact_ids = set()
+            for process in fetched.get('process', []):
+                for relation, target in entity_links('process', process.root)[2]:
+                    artifact_ids.add(target)
+            fetched['artifact'] = self.fetch(lims, 'artifact',
+                    [Artifact(lims, id=limsid) for limsid in artifact_ids])
+
+        if 'sample' in types:
+            if 'project' in full_listing:
+                sample_uris = set(self._list(lims, 'sample', {}))
+            else:
+                sample_uris = set()
+                for project in fetched.get('project', []):
+                    sample_uris.update(self._list(lims, 'sample', {'projectlimsid': project.id}))
+            samples = set(Sample(lims, uri=uri) for uri in sample_uris)
+            for artifact in fetched.get('artifact', []):
+                for relation, target in entity_links('artifact', artifact.root)[2]:
+                    if relation == 'sample':
+                        samples.add(Sample(lims, id=target))
+            fetched['sample'] = self.fetch(lims, 'sample', samples)
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                    [(entity_type, start) for entity_type in fetched])
+        return dict((entity_type, len(entities)) for entity_type, entities in fetched.items())
+
+    # Reading
+
+    def _rows(self, entity_type, limsids):
+        """Get {limsid => (uri, xml)} for the entities in the snapshot."""
+        rows = {}
+        with self.lock:
+            for chunk in chunks(limsids):
+                rows.update((limsid, (uri, xml)) for limsid, uri, xml in self.db.execute(
+                        "SELECT limsid, uri, xml FROM entity WHERE type=? AND limsid IN ({0})".format(
+                            ",".join("?" * len(chunk))),
+                        [entity_type] + chunk))
+        return rows
+
+    def load(self, lims, entity_type, limsids):
+        """Get genologics entities, with the XML from the snapshot. Entities
+        which are not in the snapshot are returned without XML, so they are
+        loaded from the API when accessed."""
+        cls = ENTITY_TYPES[entity_type][0]
+        limsids = list(limsids)
+        rows = self._rows(entity_type, limsids)
+        entities = []
+        for limsid in limsids:
+            if limsid in rows:
+                uri, xml = rows[limsid]
+                entity = cls(lims, uri=uri)
+                if entity.root is None:
+                    entity.root = ElementTree.fromstring(xml.encode('utf-8'))
+            else:
+                entity = cls(lims, id=limsid)
+            entities.append(entity)
+        return entities
+
+    def fill(self, entity_type, entities):
+        """Set the XML of genologics entities which are not loaded yet, from
+        the snapshot. Returns a list of the entities which are not in the
+        snapshot."""
+        pending = [entity for entity in entities if entity.root is None]
+        rows = self._rows(entity_type, [entity.id for entity in pending])
+        missing = []
+        for entity in pending:
+            if entity.id in rows:
+                entity.root = ElementTree.fromstring(rows[entity.id][1].encode('utf-8'))
+            else:
+                missing.append(entity)
+        return missing
+
+    def get(self, lims, entity_type, limsid):
+        return self.load(lims, entity_type, [limsid])[0]
+
+    def query(self, lims, entity_type, name=None, date_from=None, date_to=None):
+        """Get the entities of a type in the snapshot, optionally filtered by
+        name and by date (YYYY-MM-DD). The date is the open date of projects,
+        the received date of samples and the run date of processes."""
+        sql = "SELECT limsid FROM entity WHERE type=?"
+        params = [entity_type]
+        if name is not None:
+            sql += " AND name=?"
+            params.append(name)
+        if date_from:
+            sql += " AND date >= ?"
+            params.append(date_from)
+        if date_to:
+            sql += " AND date <= ?"
+            params.append(date_to)
+        with self.lock:
+            limsids = [row[0] for row in self.db.execute(sql, params)]
+        return self.load(lims, entity_type, limsids)
+
+    def related(self, lims, entity_type, limsid, relation, target_type):
+        """Follow links from an entity. Example: related(lims, 'process',
+        '24-1234', 'input', 'artifact')."""
+        with self.lock:
+            targets = [row[0] for row in self.db.execute(
+                    "SELECT target FROM link WHERE type=? AND limsid=? AND relation=?",
+                    (entity_type, limsid, relation))]
+        return self.load(lims, target_type, targets)
+
+    def referring(self, lims, entity_type, relation, target):
+        """Follow links to an entity. Example: referring(lims, 'sample',
+        'project', 'ABC123') gets the samples of a project."""
+        with self.lock:
+            limsids = [row[0] for row in self.db.execute(
+                    "SELECT limsid FROM link WHERE type=? AND relation=? AND target=?",
+                    (entity_type, relation, target))]
+        return self.load(lims, entity_type, limsids)
+
+
+def default_path(lims):
+    server = re.sub(r"[^A-Za-z0-9.-]", "_", lims.baseuri.split("//")[-1].strip("/"))
+    return os.path.join(CACHE_DIR, "lims-snapshot-{0}.sqlite".format(server))
+
+
+def open_store(lims, path=None):
+    """Open the snapshot store for a LIMS server."""
+    return SnapshotStore(path or default_path(lims))
+
+
+if __name__ == "__main__":
+    # Update the snapshot for the default LIMS server. Use --full to re-read
+    # all entities.
+    import sys
+    from genologics.lims import Lims
+    from genologics import config
+    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+    store = open_store(lims)
+    counts = store.update(lims, full="--full" in sys.argv[1:])
+    print(", ".join("{0} {1}s".format(count, entity_type) for entity_type, count in sorted(counts.items())))
@@ -0,0 +1,106 @@
+# Waiting for artifacts to be queued for a step, and for steps to complete
+
+# NOTE: This file is used from ../proj-imp/ and ../sequencing/, via symlinks
+
+# The queue resource of a step contains all artifacts in the queue, over many
+# pages, so checking it repeatedly is slow when the queue is large. Instead,
+# the artifacts of interest are fetched with a batch request, and their
+# workflow-stage elements show if they are queued for the step. The checks are
+# retried with exponentially increasing delays, up to a time budget.
+
+import time
+
+from genologics.lims import Stage
+
+# Default time budget for waiting, in seconds
+DEFAULT_TIMEOUT = 60
+
+
+class WaitTimeout(RuntimeError):
+    pass
+
+
+class Backoff(object):
+    """Exponentially increasing delays, within a total time budget."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, initial=0.5, factor=2.0, maximum=10.0):
+        self.timeout = timeout
+        self.delay = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.start_time = time.time()
+        self.waits = 0
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def sleep(self):
+        """Sleep before the next attempt. Returns False without sleeping if
+        the time budget is used up."""
+        remaining = self.timeout - self.elapsed
+        if remaining <= 0:
+            return False
+        self.waits += 1
+        time.sleep(min(self.delay, remaining))
+        self.delay = min(self.delay * self.factor, self.maximum)
+        return True
+
+    def report(self):
+        return "{0} checks in {1:.0f} s".format(self.waits + 1, self.elapsed)
+
+
+# Stage URI => step configuration URI. Stages don't change, so this is kept
+# for the lifetime of the process.
+_stage_steps = {}
+
+def _stage_step_uri(lims, stage_uri):
+    if stage_uri not in _stage_steps:
+        _stage_steps[stage_uri] = Stage(lims, uri=stage_uri).step.uri
+    return _stage_steps[stage_uri]
+
+
+def queued_artifacts(lims, stepconf, artifacts):
+    """Get the subset of artifacts which are queued for the step configuration
+    stepconf. Refreshes the artifacts with a single batch request."""
+    queued = set()
+    for artifact in lims.get_batch(artifacts, force=True):
+        for node in artifact.root.findall('workflow-stages/workflow-stage'):
+            if node.attrib.get('status') == "QUEUED" and \
+                    _stage_step_uri(lims, node.attrib['uri']) == stepconf.uri:
+                queued.add(artifact)
+                break
+    return queued
+
+
+def wait_for_queue(lims, stepconf, artifacts, timeout=DEFAULT_TIMEOUT):
+    """Wait until all artifacts are queued for the step. Raises WaitTimeout if
+    they are not queued within the time budget."""
+    artifacts = list(artifacts)
+    backoff = Backoff(timeout)
+    while True:
+        missing = set(artifacts) - queued_artifacts(lims, stepconf, artifacts)
+        if not missing:
+            return backoff
+        if not backoff.sleep():
+            raise WaitTimeout("{0} of {1} artifacts were not queued for {2} ({3}).".format(
+                len(missing), len(artifacts), stepconf.name, backoff.report()))
+
+
+def complete_step(lims, step, status_callback=None, timeout=300):
+    """Advance the step until it is completed, using the default next steps.
+    If the state doesn't change when advancing (e.g. while automations are
+    running), the step is re-checked with increasing delays."""
+    backoff = Backoff(timeout)
+    while step.current_state.upper() != "COMPLETED":
+        state = step.current_state
+        if state == "Assign Next Steps":
+            lims.set_default_next_step(step)
+        step.advance()
+        step.get(force=True)
+        if status_callback:
+            status_callback(step.current_state)
+        if step.current_state == state and not backoff.sleep():
+            raise WaitTimeout("Step {0} did not advance from {1} ({2}).".format(
+                step.id, state, backoff.report()))
+    return backoff
@@ -1,13 +1,164 @@
+# Export the libraries in a queue, or the samples in a project, as a table
+
+# Usage:
+#   export-samples.py [--queue ID | --project LIMSID] [--columns project,sample,index]
+#
+# The default is to export project name, sample name and index of the
+# libraries in the pools in queue 1662, without a header. The entities of
+# each level (queued artifacts, parent processes, libraries, samples,
+# projects) are loaded together before the rows are written: artifacts,
+# samples and containers with batch requests, and processes and projects with
+# concurrent GET requests. With --snapshot, entities are read from the local
+# LIMS snapshot (see lims_snapshot.py) when they are in it, so only the queue
+# itself and any missing entities are read from the LIMS.
+
+from __future__ import print_function
 from genologics.lims import *
 from genologics import config
 
 import sys
+import csv
+import argparse
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import lims_snapshot
+
+# Concurrent GET requests for processes and projects
+FETCH_THREADS = 8
+
+DEFAULT_QUEUE = "1662"
+
+# A row of the table: the library (or sample's submitted artifact) and its
+# first sample. The pool is the queued artifact, or None for project exports.
+Row = namedtuple('Row', ['pool', 'artifact', 'sample'])
+
+
+def location_name(row):
+    return row.artifact.location[0].name if row.artifact.location and row.artifact.location[0] else ""
+
+
+COLUMNS = [
+        ('project', lambda row: row.sample.project.name if row.sample.project else ""),
+        ('project_id', lambda row: row.sample.project.id if row.sample.project else ""),
+        ('sample', lambda row: row.sample.name),
+        ('sample_id', lambda row: row.sample.id),
+        ('library', lambda row: row.artifact.name),
+        ('library_id', lambda row: row.artifact.id),
+        ('index', lambda row: next(iter(row.artifact.reagent_labels), "")),
+        ('pool', lambda row: row.pool.name if row.pool else ""),
+        ('pool_id', lambda row: row.pool.id if row.pool else ""),
+        ('container', location_name),
+        ('well', lambda row: row.artifact.location[1] if row.artifact.location else ""),
+        ]
+DEFAULT_COLUMNS = "project,sample,index"
+
+
+class Loader(object):
+    """Loads all entities of a level together, from the snapshot if available,
+    otherwise from the API."""
+
+    def __init__(self, lims, store=None):
+        self.lims = lims
+        self.store = store
+
+    def load(self, entity_type, entities):
+        """Load the entities, and return them as a list without duplicates
+        and None values, in the original order."""
+        unique = []
+        seen = set()
+        for entity in entities:
+            if entity is not None and entity not in seen:
+                seen.add(entity)
+                unique.append(entity)
+        missing = [entity for entity in unique if entity.root is None]
+        if self.store:
+            missing = self.store.fill(entity_type, missing)
+        if missing:
+            if entity_type in lims_snapshot.BATCH_TYPES:
+                for chunk in lims_snapshot.chunks(missing):
+                    self.lims.get_batch(chunk)
+            else:
+                pool = ThreadPool(min(FETCH_THREADS, len(missing)))
+                try:
+                    pool.map(lambda entity: entity.get(), missing)
+                finally:
+                    pool.close()
+        return unique
+
+
+def queue_rows(lims, loader, queue_id):
+    """Get the rows for the libraries in the pools in a queue. Artifacts
+    without a parent process are exported as they are."""
+    pools = loader.load('artifact', Queue(lims, id=queue_id).artifacts)
+    loader.load('process', [pool.parent_process for pool in pools])
+    pool_libraries = []
+    for pool in pools:
+        if pool.parent_process:
+            libraries = [i['uri'] for i, o in pool.parent_process.input_output_maps
+                            if o and o['limsid'] == pool.id]
+        else:
+            libraries = [pool]
+        pool_libraries.append((pool, libraries))
+    loader.load('artifact', [library for pool, libraries in pool_libraries for library in libraries])
+    return [
+            Row(pool, library, library.samples[0])
+            for pool, libraries in pool_libraries
+            for library in libraries
+            ]
+
+
+def project_rows(lims, loader, project_id):
+    """Get the rows for the samples in a project."""
+    samples = loader.load('sample', lims.get_samples(projectlimsid=project_id))
+    loader.load('artifact', [sample.artifact for sample in samples])
+    return [Row(None, sample.artifact, sample) for sample in samples]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the libraries in a queue, or the samples in a project.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--queue', help="Queue ID (default: {0})".format(DEFAULT_QUEUE))
+    source.add_argument('--project', help="Project LIMS ID")
+    parser.add_argument('--columns', default=DEFAULT_COLUMNS,
+            help="Comma-separated list of columns, from: " + ", ".join(name for name, func in COLUMNS))
+    parser.add_argument('--format', choices=['tsv', 'csv'], default='tsv')
+    parser.add_argument('--header', action='store_true', help="Write a header line")
+    parser.add_argument('--output', help="Output file (default: standard output)")
+    parser.add_argument('--snapshot', action='store_true', help="Use the local LIMS snapshot")
+    args = parser.parse_args()
+
+    column_funcs = dict(COLUMNS)
+    columns = [column.strip() for column in args.columns.split(",")]
+    unknown = [column for column in columns if column not in column_funcs]
+    if unknown:
+        parser.error("Unknown column(s): " + ", ".join(unknown))
+
+    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+    loader = Loader(lims, lims_snapshot.open_store(lims) if args.snapshot else None)
+
+    if args.project:
+        rows = project_rows(lims, loader, args.project)
+    else:
+        rows = queue_rows(lims, loader, args.queue or DEFAULT_QUEUE)
+    loader.load('sample', [row.sample for row in rows])
+    if any(column.startswith('project') for column in columns):
+        loader.load('project', [row.sample.project for row in rows])
+    if 'container' in columns:
+        loader.load('container', [row.artifact.location[0] for row in rows if row.artifact.location])
 
-lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    writer = csv.writer(out, delimiter="\t" if args.format == 'tsv' else ",", lineterminator="\n")
+    if args.header:
+        writer.writerow(columns)
+    for row in rows:
+        values = [column_funcs[column](row) for column in columns]
+        if sys.version_info[0] == 2:
+            values = [value.encode('utf-8') if isinstance(value, unicode) else value for value in values]
+        writer.writerow(values)
+    if args.output:
+        out.close()
 
-q = Queue(lims, id="1662")
-for a in q.artifacts: #pools
-    arts = [i['uri'] for i, o in a.parent_process.input_output_maps if o['limsid'] == a.id]
-    for ape in arts:
-        print "\t".join([ape.samples[0].project.name, ape.samples[0].name, next(iter(ape.reagent_labels))])
 
+if __name__ == "__main__":
+    main()
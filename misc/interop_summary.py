@@ -0,0 +1 @@
+../interop_summary.py
\ No newline at end of file
@@ -4,36 +4,84 @@
 
 # This script is designed to add the metrics to all previous runs(!)
 
-from interop import py_interop_run_metrics, py_interop_run, py_interop_summary
-import sys
+# The NovaSeq Run processes are handled in groups of --group-size. For each
+# group, the processes are fetched in parallel, and all their input and output
+# artifacts with batch requests. The run folders are then summarised in
+# parallel by a process pool (see interop_summary.py; runs summarised before are
+# read from the summary cache), and the changed artifacts of the whole group
+# are written with batch updates. The IDs of the completed processes are
+# appended to the checkpoint file, and are skipped when the script is run
+# again. With --dry-run, the changes are printed, and nothing is written to the
+# LIMS or to the checkpoint file.
+
+from __future__ import print_function
 import re
 import os
-import traceback
 import math
+import glob
+import argparse
+from multiprocessing.pool import ThreadPool
 from genologics.lims import *
 from genologics import config
 
-import glob
-lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+import interop_summary
+
+PROCESS_TYPES = ["AUTOMATED - NovaSeq Run (NovaSeq 6000 v3.0)", "AUTOMATED - NovaSeq Run NSC 3.0"]
+
+#RUN_DIR_PATTERN = "/data/runScratch.boston/demultiplexed/*/*/{}"
+RUN_DIR_PATTERN = "/data/runScratch.boston/nova-interop-temp-marius/{}"
+
+DEFAULT_CHECKPOINT = os.path.join(os.path.expanduser("~"), ".cache", "nsc-lims",
+        "novaseq-lane-metrics-backfill.txt")
+
+# Processes per group
+GROUP_SIZE = 50
+# Entities per batch request
+BATCH_SIZE = 500
+# Concurrent GET requests for processes and projects
+FETCH_THREADS = 8
+
+
+def chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    return [items[i:i+size] for i in range(0, len(items), size)]
 
-processes = lims.get_processes(type=["AUTOMATED - NovaSeq Run (NovaSeq 6000 v3.0)","AUTOMATED - NovaSeq Run NSC 3.0"])
-#processes = lims.get_processes(type=["AUTOMATED - NovaSeq Run NSC 3.0"])
 
-def nan_to_zero(val):
-    if math.isnan(val): return 0.0
-    else: return val
+def fetch_parallel(entities):
+    entities = list(entities)
+    if entities:
+        pool = ThreadPool(min(FETCH_THREADS, len(entities)))
+        try:
+            pool.map(lambda entity: entity.get(), entities)
+        finally:
+            pool.close()
 
-for seq_process in processes:
+
+def read_checkpoint(path):
     try:
-        run_id = seq_process.udf['Run ID']
-    except KeyError:
-        # Something wrong with seq. step -- can't do anything
-        print("No run ID for", seq_process.id)
-        continue
+        with open(path) as f:
+            return set(line.strip() for line in f if line.strip())
+    except (IOError, OSError):
+        return set()
+
+
+def write_checkpoint(path, process_ids):
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    with open(path, 'a') as f:
+        for process_id in process_ids:
+            f.write(process_id + "\n")
+
 
+def lane_artifacts_for_process(seq_process):
+    """Get {lane number => Measurement output artifact}, and {lane number =>
+    new name} for the outputs which should be renamed."""
     using_xp_workflow = len(seq_process.all_inputs(unique=True)) > 1
 
     lane_artifacts = {}
+    lane_names = {}
     ios = seq_process.input_output_maps
     if using_xp_workflow:
         for i, o in ios:
@@ -45,57 +93,143 @@ for seq_process in processes:
         # and also rename the artifacts
         for laneno, art in zip(range(1,5), [o['uri'] for _, o in ios]):
             lane_artifacts[laneno] = art
-            art.name = "Lane {}:1".format(laneno)
-
-#    run_dir_all = glob.glob("/data/runScratch.boston/demultiplexed/*/*/{}".format(run_id))
-    run_dir_all = glob.glob("/data/runScratch.boston/nova-interop-temp-marius/{}".format(run_id))
-    if not run_dir_all:
-        print("No run folder for", run_id)
-    else:
-        run_dir = run_dir_all[0]
-        try: # Ignore parsing error, to not disturb the sequencer integrations
-
-            # Parse InterOp data
-            valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
-            py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
-            valid_to_load[py_interop_run.ExtendedTile] = 1
-            run_metrics = py_interop_run_metrics.run_metrics()
-            run_metrics.read(run_dir, valid_to_load)
-            summary = py_interop_summary.run_summary()
-            py_interop_summary.summarize_run_metrics(run_metrics, summary)
-            extended_tile_metrics = run_metrics.extended_tile_metric_set()
-
-            read_count = summary.size()
-            lane_count = summary.lane_count()
-
-            if lane_count != len(lane_artifacts):
-                raise RuntimeError("Error: Number of lanes in InterOp data: {}, does not match the number "
-                    "of lanes in LIMS: {}.".format(lane_count, len(lane_artifacts)))
-
-            result = {}
-            phix_pct = [] # We report PhiX % per read R1 / R2 (non-index)
-            for lane_number, artifact in lane_artifacts.items():
-                lane_index = lane_number - 1
-                nonindex_read_count = 0
-                for read in range(read_count):
-                    read_data = summary.at(read)
-                    if not read_data.read().is_index():
-                        read_label = str(nonindex_read_count + 1)
-                        lane_summary = read_data.at(lane_index)
-                        artifact.udf['Yield PF (Gb) R{}'.format(read_label)] = lane_summary.yield_g()
-                        artifact.udf['% Bases >=Q30 R{}'.format(read_label)] = lane_summary.percent_gt_q30()
-                        artifact.udf['Cluster Density (K/mm^2) R{}'.format(read_label)] = lane_summary.density().mean()
-                        artifact.udf['Reads PF (M) R{}'.format(read_label)] = lane_summary.reads_pf() / 1.0e6
-                        artifact.udf['%PF R{}'.format(read_label)] = lane_summary.percent_pf().mean()
-                        artifact.udf['Intensity Cycle 1 R{}'.format(read_label)] = lane_summary.first_cycle_intensity().mean()
-                        artifact.udf['% Error Rate R{}'.format(read_label)] = nan_to_zero(lane_summary.error_rate().mean())
-                        artifact.udf['% Phasing R{}'.format(read_label)] = nan_to_zero(lane_summary.phasing().mean())
-                        artifact.udf['% Prephasing R{}'.format(read_label)] = nan_to_zero(lane_summary.prephasing().mean())
-                        artifact.udf['% Aligned R{}'.format(read_label)] = nan_to_zero(lane_summary.percent_aligned().mean())
-                        artifact.udf['% Occupied Wells'] = nan_to_zero(lane_summary.percent_occupied().mean())
-                        nonindex_read_count += 1
-
-            lims.put_batch(lane_artifacts.values())
-            print("Updated LIMS ID", seq_process.id, ", Run", run_id, "(", artifact.samples[0].project.name, ")")
-        except Exception as e:
-            print("Exception encountered in novaseq-lane-metrics.py, and ignored:"+str(e))
+            lane_names[laneno] = "Lane {}:1".format(laneno)
+    return lane_artifacts, lane_names
+
+
+def same_value(old, new):
+    if old is None:
+        return False
+    try:
+        if math.isnan(old) and math.isnan(new):
+            return True
+        return abs(old - new) <= 1e-6 * max(1.0, abs(new))
+    except TypeError:
+        return old == new
+
+
+def set_lane_udfs(artifact, udfs):
+    """Set the UDFs of the artifact. Returns a list of (name, old value, new
+    value) of the changed UDFs."""
+    changes = []
+    for udf, value in sorted(udfs.items()):
+        old = artifact.udf.get(udf)
+        if not same_value(old, value):
+            changes.append((udf, old, value))
+            artifact.udf[udf] = value
+    return changes
+
+
+def process_group(lims, seq_processes, dry_run):
+    """Update the lane metrics of a group of processes. Returns the IDs of the
+    processes which are completed (updated, or already up to date)."""
+    fetch_parallel(seq_processes)
+
+    # Run folder => [(process, run ID)]. Several processes may refer to the
+    # same run, e.g. if the sequencing step was repeated.
+    runs = {}
+    for seq_process in seq_processes:
+        try:
+            run_id = seq_process.udf['Run ID']
+        except KeyError:
+            # Something wrong with seq. step -- can't do anything
+            print("No run ID for", seq_process.id)
+            continue
+        run_dir_all = glob.glob(RUN_DIR_PATTERN.format(run_id))
+        if not run_dir_all:
+            print("No run folder for", run_id)
+        else:
+            if run_dir_all[0] in runs:
+                print("Run", run_id, "of", seq_process.id, "is also used by",
+                        ", ".join(p.id for p, _ in runs[run_dir_all[0]]))
+            runs.setdefault(run_dir_all[0], []).append((seq_process, run_id))
+
+    # Inputs and outputs of all the processes
+    artifacts = set()
+    for seq_process, run_id in sum(runs.values(), []):
+        for i, o in seq_process.input_output_maps:
+            artifacts.add(i['uri'])
+            if o:
+                artifacts.add(o['uri'])
+    for chunk in chunks(artifacts):
+        lims.get_batch(chunk)
+
+    changed_artifacts = []
+    completed = []
+    reports = []
+    for run_dir, summary, error in interop_summary.get_summaries(runs):
+        for seq_process, run_id in runs[run_dir]:
+            try:
+                if error:
+                    raise RuntimeError(error)
+                lane_artifacts, lane_names = lane_artifacts_for_process(seq_process)
+                lane_count = summary['lane_count']
+
+                if lane_count != len(lane_artifacts):
+                    raise RuntimeError("Error: Number of lanes in InterOp data: {}, does not match the number "
+                        "of lanes in LIMS: {}.".format(lane_count, len(lane_artifacts)))
+
+                run_changes = []
+                for lane_number, artifact in sorted(lane_artifacts.items()):
+                    changes = set_lane_udfs(artifact, interop_summary.lane_udfs(summary, lane_number))
+                    new_name = lane_names.get(lane_number, artifact.name)
+                    if artifact.name != new_name:
+                        changes.insert(0, ("name", artifact.name, new_name))
+                        artifact.name = new_name
+                    if changes:
+                        run_changes.append((lane_number, artifact, changes))
+                changed_artifacts += [artifact for lane_number, artifact, changes in run_changes]
+                reports.append((seq_process, run_id, lane_artifacts, run_changes))
+            except Exception as e:
+                print("Exception encountered for", seq_process.id, ", Run", run_id, "and ignored:", str(e))
+
+    # Samples and projects, only used for the report
+    samples = set(lane_artifacts[min(lane_artifacts)].samples[0]
+            for _, _, lane_artifacts, _ in reports if lane_artifacts)
+    for chunk in chunks(samples):
+        lims.get_batch(chunk)
+    fetch_parallel(set(sample.project for sample in samples if sample.project))
+
+    if not dry_run:
+        for chunk in chunks(changed_artifacts):
+            lims.put_batch(chunk)
+
+    for seq_process, run_id, lane_artifacts, run_changes in reports:
+        project = lane_artifacts[min(lane_artifacts)].samples[0].project if lane_artifacts else None
+        project_name = project.name if project else ""
+        if not run_changes:
+            print("Up to date LIMS ID", seq_process.id, ", Run", run_id, "(", project_name, ")")
+        elif dry_run:
+            print("Changes for LIMS ID", seq_process.id, ", Run", run_id, "(", project_name, ")")
+            for lane_number, artifact, changes in run_changes:
+                for udf, old, new in changes:
+                    print("   Lane {0} {1} {2}: {3} -> {4}".format(lane_number, artifact.id, udf, old, new))
+        else:
+            print("Updated LIMS ID", seq_process.id, ", Run", run_id, "(", project_name, ")")
+        completed.append(seq_process.id)
+    return completed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write lane metrics to all previous NovaSeq runs.")
+    parser.add_argument('--dry-run', action='store_true', help="Print the changes, without updating the LIMS")
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+            help="File with IDs of completed processes (default: {0})".format(DEFAULT_CHECKPOINT))
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint file, and process all runs")
+    parser.add_argument('--group-size', type=int, default=GROUP_SIZE, help="Processes per group")
+    args = parser.parse_args()
+
+    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+
+    done = set() if args.restart else read_checkpoint(args.checkpoint)
+    processes = [p for p in lims.get_processes(type=PROCESS_TYPES) if p.id not in done]
+    print("Processing", len(processes), "runs,", len(done), "already completed.")
+
+    for group in chunks(processes, args.group_size):
+        completed = process_group(lims, group, args.dry_run)
+        if not args.dry_run:
+            write_checkpoint(args.checkpoint, completed)
+
+
+if __name__ == "__main__":
+    main()
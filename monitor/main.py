@@ -12,9 +12,10 @@ import threading
 import jinja2
 import json
 import time
-from functools import partial
-from functools32 import lru_cache # Backport from Python 3.2
+import sqlite3
+from functools import partial, update_wrapper
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 # Dependencies:
 # mod_wsgi yum package
@@ -47,11 +48,22 @@ JOB_STATUS_UDF = "Job status"
 JOB_STATE_CODE_UDF = "Job state code"
 CURRENT_JOB_UDF = "Current job"
 
-recent_run_cache = {}
+recent_run_cache = None
+worker_pool = None
 sequencing_process_type = []
 eval_url_base = ""
 template_loc = ""
 
+# Number of threads used to make concurrent requests when refreshing the page
+REFRESH_WORKERS = 8
+
+# Each refresh only queries for processes and flowcells modified since the
+# previous refresh, but a full query is done at this interval (seconds), to
+# pick up any changes that don't update the last-modified time.
+FULL_RESCAN_INTERVAL = 600
+# Overlap between incremental queries, to allow for clock differences
+LAST_MODIFIED_MARGIN = datetime.timedelta(minutes=2)
+
 # Site variable is updated by deployment script. Currently we have cees and ous.
 # The line below must not be changed, not even whitespace / comments.
 SITE="TESTING"
@@ -77,6 +89,7 @@ servers = []
 # in the very bottom of this file.
 def run_init(site):
     global servers
+    global recent_run_cache
     configpath = os.path.join(
             os.path.dirname(__file__),
             "config",
@@ -85,6 +98,10 @@ def run_init(site):
     with open(configpath) as f:
         data = json.load(f)
         servers = [LimsServer(i, server) for i, server in enumerate(data['SERVERS'])]
+    cache_path = data.get('RECENT_RUN_CACHE_FILE') or os.path.join(
+            os.path.expanduser("~"), ".cache", "nsc-lims", "recent-runs-{0}.sqlite".format(site)
+            )
+    recent_run_cache = RecentRunCache(cache_path)
 
 def get_run_id(process):
     try:
@@ -92,7 +109,73 @@ def get_run_id(process):
     except KeyError:
         return process.udf.get('RunID', '')
 
-@lru_cache(maxsize=30) # Relevant for monitored processes (open runs)
+def pmap(func, items):
+    """Call func for each item using the shared worker pool, and return the
+    results as a list. Should not be nested, i.e., func must not call pmap."""
+    global worker_pool
+    if worker_pool is None:
+        worker_pool = ThreadPool(REFRESH_WORKERS)
+    return worker_pool.map(func, list(items))
+
+
+class RefreshTimer(object):
+    """Records the wall time spent in each stage of the page refresh."""
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.stages = []
+
+    def stage(self, name):
+        now = time.time()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+
+class LimsIdCache(object):
+    """Caches the results of a function of (server, entity), keyed by the LIMS
+    ID of the entity (key function can be overridden). Entries expire after ttl
+    seconds, and can be invalidated explicitly when the entity has changed."""
+
+    def __init__(self, func, ttl, key=None):
+        update_wrapper(self, func)
+        self.func = func
+        self.ttl = ttl
+        self.key = key or (lambda server, entity: (server.index, entity.id))
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, server, entity):
+        key = self.key(server, entity)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        value = self.func(server, entity)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+        return value
+
+    def invalidate(self, server, entity):
+        with self.lock:
+            self.entries.pop(self.key(server, entity), None)
+
+    def expire(self):
+        """Remove expired entries, to limit memory use."""
+        now = time.time()
+        with self.lock:
+            for key, (expiry, value) in list(self.entries.items()):
+                if expiry <= now:
+                    del self.entries[key]
+
+
+def lims_id_cache(ttl, key=None):
+    return lambda func: LimsIdCache(func, ttl, key)
+
+
+@lims_id_cache(ttl=3600) # Relevant for monitored processes (open runs)
 def get_sequencing_process(server, process):
     """Gets the sequencing process from a process object corresponing to a process
     which is run after sequencing, such as demultiplexing. This function looks up
@@ -167,6 +250,78 @@ class CompletedRunInfo(object):
         self.date = date
         self.instrument_index = instrument_index
 
+    def to_json(self):
+        data = dict(self.__dict__)
+        data['projects'] = [project.__dict__ for project in self.projects]
+        data['date'] = self.date.isoformat()
+        return json.dumps(data)
+
+    @staticmethod
+    def from_json(text):
+        data = json.loads(text)
+        data['projects'] = [Project(**project) for project in data['projects']]
+        data['date'] = datetime.datetime.strptime(data['date'], "%Y-%m-%d").date()
+        return CompletedRunInfo(**data)
+
+
+class RecentRunCache(object):
+    """Cache of CompletedRunInfo objects for recently completed flowcells, backed
+    by an SQLite file, so it survives restarts of the web server. Keyed by
+    server index and flowcell ID. An entry is only valid for the processing
+    date it was created with."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.memory = {}
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.db = sqlite3.connect(path, check_same_thread=False)
+        except (OSError, sqlite3.Error):
+            # Not fatal, but the cache is lost on restart
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS recent_run (
+                        server INTEGER,
+                        flowcell_id TEXT,
+                        processed_date TEXT,
+                        data TEXT,
+                        PRIMARY KEY (server, flowcell_id)
+                        )""")
+        for server, flowcell_id, data in self.db.execute(
+                "SELECT server, flowcell_id, data FROM recent_run"):
+            self.memory[(server, flowcell_id)] = CompletedRunInfo.from_json(data)
+
+    def get(self, server, fc):
+        run_info = self.memory.get((server.index, fc.id))
+        if run_info and run_info.date == fc.udf.get(PROCESSED_DATE_UDF):
+            return run_info
+        return None
+
+    def put(self, server, fc, run_info):
+        with self.lock:
+            self.memory[(server.index, fc.id)] = run_info
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO recent_run VALUES (?, ?, ?, ?)",
+                        (server.index, fc.id, run_info.date.isoformat(), run_info.to_json()))
+
+    def delete(self, server, fc):
+        with self.lock:
+            self.memory.pop((server.index, fc.id), None)
+            with self.db:
+                self.db.execute("DELETE FROM recent_run WHERE server=? AND flowcell_id=?",
+                        (server.index, fc.id))
+
+    def expire(self, cutoff_date):
+        """Remove entries processed on or before the cutoff date."""
+        with self.lock:
+            for key, run_info in list(self.memory.items()):
+                if run_info.date <= cutoff_date:
+                    del self.memory[key]
+            with self.db:
+                self.db.execute("DELETE FROM recent_run WHERE processed_date <= ?",
+                        (cutoff_date.isoformat(),))
+
 
 def clear_monitor(completed):
     for proc in completed:
@@ -229,16 +384,17 @@ def read_project(server, lims_project):
             tag += "B"
     return Project(url, lims_project.name, eval_url, tag)
 
-@lru_cache(maxsize=30*4) # Relevant for all processes x lanes, but "recently completed" is already cached
+@lims_id_cache(ttl=600, key=lambda server, artifacts: (server.index, frozenset(a.id for a in artifacts)))
 def get_projects_for_artifacts(server, artifacts):
-    return set(
-        sample.project
+    artifacts = server.lims.get_batch(artifacts)
+    samples = server.lims.get_batch(set(
+        sample
         for art in artifacts
-        for sample in server.lims.get_batch(art.samples)
-        if sample.project
-        )
+        for sample in art.samples
+        ))
+    return set(sample.project for sample in samples if sample.project)
 
-@lru_cache(maxsize=15) # Cache project lists, because it's prone to getting invalid results
+@lims_id_cache(ttl=600) # Cache project lists, because it's prone to getting invalid results
 def get_projects(server, process):
     lims_projects = []
     for attempt in range(3): 
@@ -469,61 +625,195 @@ def get_recent_run(server, fc):
 
 
 def get_recently_completed_runs(servers):
-    all_results = []
-    for server in servers:
-        # Look for any flowcells which have a value for this udf
-        flowcells = server.lims.get_containers(
-                udf={RECENTLY_COMPLETED_UDF: True},
-                type=server.FLOWCELL_TYPES
-                )
-
-        cutoff_date = datetime.date.today() - datetime.timedelta(days=30)
-        server_results = [list() for i in range(len(server.SEQUENCING))]
-        for fc in reversed(flowcells):
+    cutoff_date = datetime.date.today() - datetime.timedelta(days=30)
+    current_flowcells = []
+    for server, fc in monitor_state.flowcells_list():
+        try:
+            date = fc.udf[PROCESSED_DATE_UDF]
+        except KeyError:
+            fc.get(force=True)
             try:
                 date = fc.udf[PROCESSED_DATE_UDF]
             except KeyError:
-                fc.get(force=True)
-                try:
-                    date = fc.udf[PROCESSED_DATE_UDF]
-                except KeyError:
-                    # Set a date (Necessary for SeqLab, can't hook into the Sequence process)
-                    fc.udf[PROCESSED_DATE_UDF] = datetime.date.today()
-                    fc.put()
-
-            if date <= cutoff_date:
-                try:
-                    del recent_run_cache[(server, fc.id)]
-                except KeyError:
-                    pass
-                fc.get(force=True)
-                fc.udf[RECENTLY_COMPLETED_UDF] = False
+                # Set a date (Necessary for SeqLab, can't hook into the Sequence process)
+                fc.udf[PROCESSED_DATE_UDF] = datetime.date.today()
                 fc.put()
-            else:
-                run_info = recent_run_cache.get((server, fc.id))
-                if not run_info:
-                    run_info = get_recent_run(server, fc)
-                    recent_run_cache[(server, fc.id)] = run_info
 
-                server_results[run_info.instrument_index].append(run_info)
+        if date <= cutoff_date:
+            recent_run_cache.delete(server, fc)
+            fc.get(force=True)
+            fc.udf[RECENTLY_COMPLETED_UDF] = False
+            fc.put()
+            monitor_state.remove_flowcell(server, fc)
+        else:
+            current_flowcells.append((server, fc))
+
+    def get_cached_recent_run(server_fc):
+        server, fc = server_fc
+        run_info = recent_run_cache.get(server, fc)
+        if not run_info:
+            run_info = get_recent_run(server, fc)
+            recent_run_cache.put(server, fc, run_info)
+        return run_info
+    run_infos = pmap(get_cached_recent_run, current_flowcells)
+    recent_run_cache.expire(cutoff_date)
 
+    all_results = []
+    for server in servers:
+        server_results = [list() for i in range(len(server.SEQUENCING))]
+        for (fc_server, fc), run_info in zip(current_flowcells, run_infos):
+            if fc_server == server:
+                server_results[run_info.instrument_index].append(run_info)
         all_results += server_results
         
     return all_results
 
 
 def refresh(instances):
-    """Refresh all instances.
+    """Refresh all instances, using concurrent requests.
     
     This could be replaced by a few batch calls if that becomes available for Process / Step."""
-    for instance in instances:
-        instance.get(force=True)
+    instances = list(instances)
+    pmap(lambda instance: instance.get(force=True), instances)
     return instances
 
 
+def prefetch_inputs(server_processes):
+    """Load the input artifacts of the processes, and their containers, with batch
+    requests (two per server)."""
+    server_artifacts = defaultdict(set)
+    for server, process in server_processes:
+        server_artifacts[server].update(i['uri'] for i, o in process.input_output_maps)
+    for server, artifacts in server_artifacts.items():
+        artifacts = server.lims.get_batch(artifacts)
+        # Inputs without a container have no location, or None as container
+        containers = set(artifact.location[0] for artifact in artifacts
+                if artifact.location and artifact.location[0])
+        if containers:
+            server.lims.get_batch(containers)
+
+
+def lims_timestamp(dt):
+    """Format a UTC datetime for last-modified queries."""
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def lims_id_number(entity):
+    """Numeric part of the LIMS ID, for sorting in order of creation."""
+    return int(entity.id.rpartition("-")[2])
+
+
+class MonitorState(object):
+    """Persistent model of the monitored processes and recently completed
+    flowcells, which is updated incrementally.
+
+    Each refresh cycle only lists the processes and flowcells modified since
+    the previous cycle, and only these are re-fetched. Every
+    FULL_RESCAN_INTERVAL, everything is listed and fetched again.
+    """
+
+    def __init__(self):
+        # (server index, LIMS ID) => (server, process, step)
+        self.processes = {}
+        # (server index, LIMS ID) => (server, container)
+        self.flowcells = {}
+        self.last_query_time = None
+        self.last_full_time = None
+        self.cycle_start = None
+        self.cycle_full = False
+        self.modified_since = None
+
+    def start_cycle(self):
+        """Decide whether this will be a full rescan or an incremental update.
+        Returns True for a full rescan."""
+        self.cycle_start = datetime.datetime.utcnow()
+        self.cycle_full = self.last_full_time is None or \
+                (self.cycle_start - self.last_full_time).total_seconds() > FULL_RESCAN_INTERVAL
+        if self.cycle_full:
+            self.modified_since = None
+        else:
+            self.modified_since = lims_timestamp(self.last_query_time - LAST_MODIFIED_MARGIN)
+        return self.cycle_full
+
+    def finish_cycle(self):
+        """Record that the cycle completed. If the cycle fails, the next one
+        queries for changes since the last successful cycle."""
+        self.last_query_time = self.cycle_start
+        if self.cycle_full:
+            self.last_full_time = self.cycle_start
+
+    def update_processes(self, server_process_types):
+        """Query for monitored processes, and fetch the processes and steps which
+        are new or modified. server_process_types is a list of (server, process
+        type name). Returns the list of (server, process) which were fetched."""
+        process_lists = pmap(
+                lambda server_ptype: server_ptype[0].lims.get_processes(
+                    udf={'Monitor': True}, type=server_ptype[1],
+                    last_modified=self.modified_since
+                    ),
+                server_process_types
+                )
+        modified = [
+                (server, proc)
+                for (server, ptype), procs in zip(server_process_types, process_lists)
+                for proc in procs
+                ]
+        refresh(proc for server, proc in modified)
+        # Need Steps to see if COMPLETED
+        steps = refresh(Step(server.lims, id=proc.id) for server, proc in modified)
+
+        if self.modified_since is None:
+            self.processes = {}
+        for (server, proc), step in zip(modified, steps):
+            self.processes[(server.index, proc.id)] = (server, proc, step)
+            get_projects.invalidate(server, proc)
+            get_sequencing_process.invalidate(server, proc)
+        return modified
+
+    def processes_list(self):
+        return sorted(
+                self.processes.values(),
+                key=lambda server_proc_step: (server_proc_step[0].index, lims_id_number(server_proc_step[1]))
+                )
+
+    def remove_process(self, server, process):
+        self.processes.pop((server.index, process.id), None)
+
+    def update_flowcells(self, servers):
+        """Query for flowcells with the Recently completed flag, and fetch the
+        new or modified ones."""
+        server_flowcells = pmap(
+                lambda server: server.lims.get_batch(server.lims.get_containers(
+                    udf={RECENTLY_COMPLETED_UDF: True},
+                    type=server.FLOWCELL_TYPES,
+                    last_modified=self.modified_since
+                    )),
+                servers
+                )
+        if self.modified_since is None:
+            self.flowcells = {}
+        for server, flowcells in zip(servers, server_flowcells):
+            for fc in flowcells:
+                self.flowcells[(server.index, fc.id)] = (server, fc)
+
+    def flowcells_list(self):
+        """Most recent first"""
+        return sorted(
+                self.flowcells.values(),
+                key=lambda server_fc: (server_fc[0].index, -lims_id_number(server_fc[1]))
+                )
+
+    def remove_flowcell(self, server, flowcell):
+        self.flowcells.pop((server.index, flowcell.id), None)
+
+
+monitor_state = MonitorState()
+
+
 def prepare_page():
     global page
 
+    timer = RefreshTimer()
     try:
         servers_seq_process_types = [
             (server, proctypes) for server in servers for proctypes in server.SEQUENCING]
@@ -533,28 +823,27 @@ def prepare_page():
 
         all_servers_process_types = servers_seq_process_types + servers_data_process_types
 
+        full_rescan = monitor_state.start_cycle()
+
         # Get a list of all processes 
         # Of course it can't be this efficient :( Multiple process types not supported
         #monitored_process_list = lims.get_processes(udf={'Monitor': True}, type=all_process_types)
-        monitored_process_list = []
-        for server, ptypes in all_servers_process_types:
-            monitored_process_list += [ (server, proc)
-                            for ptype in ptypes
-                            for proc in server.lims.get_processes(udf={'Monitor': True}, type=ptype)
-                            ]
-
-        # Refresh data for all processes (need this for almost all monitored procs, so
-        # doing a batch request)
-        refresh(proc for server, proc in monitored_process_list)
-
-        # Need Steps to see if COMPLETED, this loads them into cache
-        steps = [Step(s.lims, id=p.id) for s, p in monitored_process_list]
-        refresh(steps)
+        # Instead, one query per server and process type, run concurrently.
+        server_process_types = [
+            (server, ptype)
+            for server, ptypes in all_servers_process_types
+            for ptype in ptypes
+            ]
+        modified_processes = set(
+                (server.index, proc.id)
+                for server, proc in monitor_state.update_processes(server_process_types)
+                )
+        timer.stage("processes and steps")
 
         seq_processes = defaultdict(list)
         post_processes = []
         completed = []
-        for (server, p), step in zip(monitored_process_list, steps):
+        for server, p, step in monitor_state.processes_list():
             if any(p.type_name in ptypes for ptypes in server.SEQUENCING):
                 if is_step_completed(step):
                     completed.append(p)
@@ -566,16 +855,35 @@ def prepare_page():
                     completed.append(p)
                 else:
                     post_processes.append((server,p))
+            if is_step_completed(step):
+                monitor_state.remove_process(server, p)
 
         clear_monitor(completed)
 
-        # List of one element per (server, machine type)
-        sequencing = [
-            [read_sequencing(server, proc) 
+        # Input artifacts and flowcells for new or modified open processes
+        open_seq_processes = [
+                (index, server, proc)
+                for index, (server, sptypes) in enumerate(servers_seq_process_types)
                 for sp in sptypes
-                for proc in seq_processes[sp] ]
-                for (server, sptypes) in servers_seq_process_types
-            ]
+                for proc in seq_processes[sp]
+                ]
+        prefetch_inputs(
+                (server, proc)
+                for server, proc in
+                    [(server, proc) for index, server, proc in open_seq_processes] + post_processes
+                if (server.index, proc.id) in modified_processes
+                )
+        timer.stage("inputs")
+
+        # List of one element per (server, machine type)
+        sequencing = [list() for i in servers_seq_process_types]
+        seq_infos = pmap(
+                lambda index_server_proc: read_sequencing(*index_server_proc[1:]),
+                open_seq_processes
+                )
+        for (index, server, proc), seq_info in zip(open_seq_processes, seq_infos):
+            sequencing[index].append(seq_info)
+        timer.stage("sequencing")
 
 
         # This list contains one item for each sequencer type, and each item is a list of processses
@@ -583,18 +891,37 @@ def prepare_page():
         post_sequencing = []
 
         # Find sequencing process for each post-sequencing process
-        sequencing_processes = [get_sequencing_process(server, process) for server, process in post_processes]
+        sequencing_processes = pmap(
+                lambda server_process: get_sequencing_process(*server_process),
+                post_processes
+                )
+        post_infos = pmap(
+                lambda server_process_seq: read_post_sequencing_process(*server_process_seq),
+                (
+                    (server, process, sequencing_process)
+                    for (server, process), sequencing_process in zip(post_processes, sequencing_processes)
+                    if sequencing_process
+                )
+                )
+        post_infos = iter(post_infos)
 
         # One workflow for each sequencer type
-        for index in range(len(servers_seq_process_types)):
-            machine_items = [] # all processes for a type of sequencing machine
-            for (server, process), sequencing_process in zip(post_processes, sequencing_processes):
-                if sequencing_process and sequencing_process.type_name in servers_seq_process_types[index][1]:
-                    machine_items.append(read_post_sequencing_process(server, process, sequencing_process))
-            post_sequencing.append(machine_items)
-            
-
+        post_sequencing = [list() for i in servers_seq_process_types]
+        for sequencing_process in sequencing_processes:
+            if sequencing_process:
+                post_info = next(post_infos)
+                for index in range(len(servers_seq_process_types)):
+                    if sequencing_process.type_name in servers_seq_process_types[index][1]:
+                        post_sequencing[index].append(post_info)
+        timer.stage("post-sequencing")
+
+        monitor_state.update_flowcells(servers)
         recently_completed = get_recently_completed_runs(servers)
+        timer.stage("recently completed")
+
+        for cache in [get_sequencing_process, get_projects, get_projects_for_artifacts]:
+            cache.expire()
+        monitor_state.finish_cycle()
 
 
         variables = {
@@ -603,7 +930,9 @@ def prepare_page():
                 'sequencing': sequencing,
                 'post_sequencing': post_sequencing,
                 'recently_completed': recently_completed,
-                'instruments': sum((server.INSTRUMENTS for server in servers), [])
+                'instruments': sum((server.INSTRUMENTS for server in servers), []),
+                'timer': timer,
+                'full_rescan': full_rescan
                 }
         page = jinja2.Environment(
                 loader=jinja2.FileSystemLoader(template_loc)
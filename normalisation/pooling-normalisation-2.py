@@ -4,14 +4,11 @@ import StringIO
 from genologics.lims import *
 from genologics import config
 
-TUBE = 'Tube'
-
-def get_tuple_key(tupl):
-    artifact = tupl[0]
-    container = artifact.location[0].name
-    well = artifact.location[1]
-    row, col = well.split(":")
-    return (container, int(col), row)
+from step_context import StepContext
+
+def get_location_key(location):
+    row, col = location.well.split(":")
+    return (location.container_name, int(col), row)
     
 
 def get_or_set(entity, udf, default_value):
@@ -23,7 +20,8 @@ def get_or_set(entity, udf, default_value):
 
 def main(process_id, output_file_id):
     lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
-    process = Process(lims, id=process_id)
+    context = StepContext(lims, process_id)
+    process = context.process
 
     # Clear the file, to make sure old data don't remain
     with open(output_file_id, 'wb') as f:
@@ -49,10 +47,8 @@ def main(process_id, output_file_id):
     inputs = []
     outputs = []
 
-    step = Step(lims, id=process.id)
-
-    lims.get_batch(process.all_inputs(unique=True) + process.all_outputs(unique=True))
-    lims.get_batch(input.samples[0] for input in process.all_inputs(unique=True))
+    # Artifacts, samples and containers, in three batch requests
+    context.load()
 
     try:
         norm_conc = process.udf['Pool molarity']
@@ -62,19 +58,10 @@ def main(process_id, output_file_id):
         print "This is used in case the per-pool value is not given for some pools"
         sys.exit(1)
 
-    input_tubes = sorted(set(
-        int(inp.location[0].id.partition("-")[2]) for inp in process.all_inputs()
-        if inp.location[0].type_name == TUBE
-    ))
-    output_tubes = sorted(set(
-        int(oup.location[0].id.partition("-")[2]) for oup in process.all_outputs()
-        if oup.type == 'Analyte' and oup.location[0].type_name == TUBE
-    ))
-
     error = False # "Soft" error, still will upload the file
 
     rows = []
-    for pool in step.pools.pooled_inputs:
+    for pool in context.pools:
         output = pool.output # output already fetched in batch, as process input
         pool_norm_conc = get_or_set(output, 'Normalized conc. (nM)', norm_conc)
         pool_pool_volume = get_or_set(output, 'Volume (uL)', pool_volume)
@@ -111,26 +98,20 @@ def main(process_id, output_file_id):
             print "try again."
             error = True
 
-        dest_container = output.location[0].name.encode('utf-8')
-        if output.location[0].type_name == TUBE:
-            dest_well = output_tubes.index(int(output.location[0].id.partition("-")[2])) + 1
-        else:
-            dest_well = output.location[1]
+        dest_container = context.location(output).container_name.encode('utf-8')
+        dest_well = context.tube_well(output)
 
         first_in_pool = True
         for input, sample_volume in sorted(
                 zip(pool.inputs, sample_volumes),
-                key=get_tuple_key
+                key=lambda tupl: get_location_key(context.location(tupl[0]))
                 ):
             sample_name = input.name.encode('utf-8')
             input_mol_conc = input.udf['Molarity']
             input_mol_conc_str = "%4.2f" % (input.udf['Molarity'])
             sample_vol_str = "%4.2f" % sample_volume
-            source_container = input.location[0].name.encode('utf-8')
-            if input.location[0].type_name == TUBE:
-                source_well = input_tubes.index(int(input.location[0].id.partition("-")[2])) + 1
-            else:
-                source_well = input.location[1]
+            source_container = context.location(input).container_name.encode('utf-8')
+            source_well = context.tube_well(input)
             if first_in_pool:
                 rows.append([
                     pool.name.encode('utf-8'),
@@ -162,7 +143,7 @@ def main(process_id, output_file_id):
                     ])
 
 
-    lims.put_batch(pool.output for pool in step.pools.pooled_inputs)
+    lims.put_batch(pool.output for pool in context.pools)
 
     with open(output_file_id, 'wb') as out_file:
         out = csv.writer(out_file)
@@ -4,12 +4,11 @@ import StringIO
 from genologics.lims import *
 from genologics import config
 
-def get_tuple_key(tupl):
-    artifact = tupl[0]
-    container = artifact.location[0].name
-    well = artifact.location[1]
-    row, col = well.split(":")
-    return (container, int(col), row)
+from step_context import StepContext
+
+def get_location_key(location):
+    row, col = location.well.split(":")
+    return (location.container_name, int(col), row)
     
 
 def get_or_set(entity, udf, default_value):
@@ -21,7 +20,8 @@ def get_or_set(entity, udf, default_value):
 
 def main(process_id, output_file_id):
     lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
-    process = Process(lims, id=process_id)
+    context = StepContext(lims, process_id)
+    process = context.process
 
     # Clear the file, to make sure old data don't remain
     with open(output_file_id, 'wb') as f:
@@ -47,17 +47,16 @@ def main(process_id, output_file_id):
     inputs = []
     outputs = []
 
-    step = Step(lims, id=process.id)
     inputs = process.all_inputs(unique=True)
     try:
         qc_results = lims.get_qc_results_re(inputs, "qPCR QC ")
     except KeyError, e:
         print "Missing molarity measurement for", e
         sys.exit(1)
-        lims.get_batch(qc_results)
 
-    lims.get_batch(inputs + process.all_outputs(unique=True) + qc_results)
-    lims.get_batch(input.samples[0] for input in process.all_inputs(unique=True))
+    # Artifacts (including QC results), samples and containers, in three
+    # batch requests
+    context.load(qc_results)
 
     qc_result_map = dict((input, qc_result) for input, qc_result in zip(inputs, qc_results))
 
@@ -73,7 +72,7 @@ def main(process_id, output_file_id):
 
 
     rows = []
-    for pool in step.pools.pooled_inputs:
+    for pool in context.pools:
         output = pool.output # output already fetched in batch, as process input
         pool_norm_conc = get_or_set(output, 'Normalized conc. (nM)', norm_conc)
         pool_pool_volume = get_or_set(output, 'Volume (uL)', pool_volume)
@@ -109,22 +108,22 @@ def main(process_id, output_file_id):
             print "try again."
             error = True
 
-        dest_container = output.location[0].name.encode('utf-8')
-        dest_well = output.location[1]
+        dest_container = context.location(output).container_name.encode('utf-8')
+        dest_well = context.location(output).well
 
         first_in_pool = True
         sum_frag_length = 0.0
         for input, sample_volume in sorted(
                 zip(pool.inputs, sample_volumes),
-                key=get_tuple_key
+                key=lambda tupl: get_location_key(context.location(tupl[0]))
                 ):
             sample_name = input.name.encode('utf-8')
             input_mol_conc = qc_result_map[input].udf['Molarity']
             sum_frag_length += qc_result_map[input].udf.get('Average Fragment Size', 0.0)
             input_mol_conc_str = "%4.2f" % (qc_result_map[input].udf['Molarity'])
             sample_vol_str = "%4.2f" % sample_volume
-            source_container = input.location[0].name.encode('utf-8')
-            source_well = input.location[1]
+            source_container = context.location(input).container_name.encode('utf-8')
+            source_well = context.location(input).well
             if first_in_pool:
                 rows.append([
                     pool.name.encode('utf-8'),
@@ -158,7 +157,7 @@ def main(process_id, output_file_id):
         pool.output.udf['Average Fragment Size'] = sum_frag_length / len(pool.inputs)
 
 
-    lims.put_batch(pool.output for pool in step.pools.pooled_inputs)
+    lims.put_batch(pool.output for pool in context.pools)
 
     with open(output_file_id, 'wb') as out_file:
         out = csv.writer(out_file)
@@ -4,6 +4,8 @@ import StringIO
 from genologics.lims import *
 from genologics import config
 
+from step_context import StepContext
+
 def get_row_key(row):
     container = row[2]
     well = row[3]
@@ -20,7 +22,8 @@ def get_or_set(entity, udf, default_value):
 
 def main(process_id, def_sample_dna_quantity, output_file_id):
     lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
-    process = Process(lims, id=process_id)
+    context = StepContext(lims, process_id)
+    process = context.process
 
     # Clear the file, to make sure old data don't remain
     with open(output_file_id, 'wb') as f:
@@ -42,18 +45,16 @@ def main(process_id, def_sample_dna_quantity, output_file_id):
             ]
 
 
-    step = Step(lims, id=process.id)
-
     inputs = process.all_inputs(unique=True)
-    lims.get_batch(inputs + process.all_outputs(unique=True))
-    lims.get_batch(input.samples[0] for input in inputs)
-
     try:
         qc_results = lims.get_qc_results_re(inputs, "Quant-iT QC")
     except KeyError, e:
         print "Missing QC result for", e
         sys.exit(1)
-    lims.get_batch(qc_results)
+
+    # Artifacts (including QC results), samples and containers, in three
+    # batch requests
+    context.load(qc_results)
     try:
         qc_result_map = dict((input, qc_result.udf['Concentration']) for input, qc_result in zip(inputs, qc_results))
     except KeyError as e:
@@ -73,7 +74,7 @@ def main(process_id, def_sample_dna_quantity, output_file_id):
         error = True
 
     rows = []
-    for pool in step.pools.pooled_inputs:
+    for pool in context.pools:
         output = pool.output # output already fetched in batch, as process input
         target_sample_qty = get_or_set(output, 'Amount of DNA per sample (ng)', float(def_sample_dna_quantity))
         target_sample_qty_str = "%4.2f" % target_sample_qty
@@ -82,8 +83,8 @@ def main(process_id, def_sample_dna_quantity, output_file_id):
         unknown_qc = []
         sample_concs = [qc_result_map[input] for input in pool.inputs]
 
-        dest_container = output.location[0].name
-        dest_well = output.location[1]
+        dest_container = context.location(output).container_name
+        dest_well = context.location(output).well
 
         pooling_volumes = [target_sample_qty / sample_conc for sample_conc in sample_concs]
         pool_total_volume = sum(pooling_volumes)
@@ -93,8 +94,8 @@ def main(process_id, def_sample_dna_quantity, output_file_id):
             sample_name = input.name.encode('utf-8')
             input_conc_str = "%4.2f" % (sample_conc)
             pooling_vol_str = "%4.2f" % pooling_volume
-            source_container = input.location[0].name
-            source_well = input.location[1]
+            source_container = context.location(input).container_name
+            source_well = context.location(input).well
             if first_in_pool:
                 rows.append([
                     pool.name,
@@ -124,7 +125,7 @@ def main(process_id, def_sample_dna_quantity, output_file_id):
                     ])
 
 
-    lims.put_batch(pool.output for pool in step.pools.pooled_inputs)
+    lims.put_batch(pool.output for pool in context.pools)
 
     with open(output_file_id, 'wb') as out_file:
         out = csv.writer(out_file)
@@ -0,0 +1,108 @@
+# Loading of the artifacts, samples and containers of a pooling step
+
+# The pooling and normalisation scripts use the container name, type and well
+# of every input and output. Reading artifact.location[0].name fetches each
+# container separately, which for a plate of libraries in tubes means one
+# request per tube. The StepContext loads all artifacts, their first samples
+# and their containers with one batch request each, and keeps the pools and the
+# locations in memory, so the worksheet is generated without further requests.
+
+from collections import namedtuple
+
+from genologics.lims import Process, Step
+
+TUBE = 'Tube'
+
+Location = namedtuple('Location', ['container', 'container_name', 'container_type', 'well'])
+Pool = namedtuple('Pool', ['name', 'output', 'inputs'])
+
+
+def unique(items):
+    """Remove None values and entities with the same LIMS ID, keeping the
+    first of each."""
+    seen = set()
+    result = []
+    for item in items:
+        if item is not None and item.id not in seen:
+            seen.add(item.id)
+            result.append(item)
+    return result
+
+
+def tube_number(container):
+    """Number part of the container LIMS ID (e.g. 27-1234 => 1234)."""
+    return int(container.id.partition("-")[2])
+
+
+class StepContext(object):
+    """Inputs, outputs, pools and locations of a pooling step. The step's
+    entities are loaded by load()."""
+
+    def __init__(self, lims, process_id):
+        self.lims = lims
+        self.process = Process(lims, id=process_id)
+        self.step = Step(lims, id=process_id)
+        self.inputs = []
+        self.outputs = []
+        self.pools = []
+        self.locations = {} # Artifact LIMS ID => Location
+        self.input_tubes = []
+        self.output_tubes = []
+        self.output_ids = set()
+
+    def load(self, extra_artifacts=()):
+        """Fetch the inputs, outputs and extra_artifacts (e.g. QC results),
+        the first sample of each input, and all their containers. Returns
+        self."""
+        self.inputs = self.process.all_inputs(unique=True)
+        self.outputs = self.process.all_outputs(unique=True)
+        # The pools resource may refer to the artifacts by other URIs (with or
+        # without state) than the process, so the artifact objects can be
+        # different. The locations are keyed by LIMS ID, and the pools refer
+        # to the loaded artifact objects.
+        step_pools = self.step.pools.pooled_inputs
+        pool_artifacts = [pool.output for pool in step_pools] + \
+                [input for pool in step_pools for input in pool.inputs]
+        artifacts = unique(self.inputs + self.outputs + pool_artifacts + list(extra_artifacts))
+        self.lims.get_batch(artifacts)
+        by_id = dict((artifact.id, artifact) for artifact in artifacts)
+        samples = unique(input.samples[0] for input in self.inputs if input.samples)
+        if samples:
+            self.lims.get_batch(samples)
+        containers = unique(artifact.location[0] for artifact in artifacts if artifact.location)
+        if containers:
+            self.lims.get_batch(containers)
+
+        for artifact in artifacts:
+            if artifact.location and artifact.location[0]:
+                container, well = artifact.location
+                self.locations[artifact.id] = Location(container, container.name, container.type_name, well)
+        self.pools = [
+                Pool(pool.name, by_id[pool.output.id], [by_id[input.id] for input in pool.inputs])
+                for pool in step_pools
+                ]
+        self.input_tubes = sorted(set(
+                tube_number(self.locations[input.id].container) for input in self.inputs
+                if input.id in self.locations and self.locations[input.id].container_type == TUBE
+                ))
+        self.output_tubes = sorted(set(
+                tube_number(self.locations[output.id].container) for output in self.outputs
+                if output.type == 'Analyte' and output.id in self.locations
+                    and self.locations[output.id].container_type == TUBE
+                ))
+        self.output_ids = set(output.id for output in self.outputs)
+        return self
+
+    def location(self, artifact):
+        """Get the Location of an artifact, by LIMS ID."""
+        return self.locations[artifact.id]
+
+    def tube_well(self, artifact):
+        """Get the well of the artifact, or for tubes, the position of the tube
+        among the input tubes or the output tubes of the step (1-based, in
+        order of container ID)."""
+        location = self.location(artifact)
+        if location.container_type != TUBE:
+            return location.well
+        tubes = self.output_tubes if artifact.id in self.output_ids else self.input_tubes
+        return tubes.index(tube_number(location.container)) + 1
@@ -0,0 +1,225 @@
+# Job scheduler and persistent job table for the project importers
+
+# NOTE: This file is also used from ../qpi/, via a symlink
+
+# Up to MAX_CONCURRENT_JOBS import jobs run at the same time, on a thread pool.
+# Each job has a key (the project type or the project name), and jobs with the
+# same key run one at a time, in the order they were submitted. The state and
+# the last status of each job are stored in an SQLite table, so the status
+# page still works after the web server is restarted. After a restart, jobs
+# which were waiting to start are submitted again, using the inputs stored
+# with them. Jobs which were running are marked as interrupted, as they may
+# have left a partially created project in the LIMS, which has to be checked
+# by a human.
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
+
+MAX_CONCURRENT_JOBS = 4
+# Finished jobs are removed from the table after this many seconds
+JOB_RETENTION = 30 * 24 * 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+INTERRUPTED = "interrupted"
+
+INTERRUPTED_MESSAGE = "Interrupted by a restart of the web server."
+
+
+class ScheduledJob(object):
+    """Base class for jobs run by the scheduler. Subclasses implement run(),
+    status_json() and the inputs property. The inputs are a JSON-serialisable
+    dict, which is given to the factory function to re-create the job if the
+    server is restarted before the job has started."""
+
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.scheduler = None
+
+    def run(self):
+        pass
+
+    def status_json(self):
+        return "null"
+
+    @property
+    def inputs(self):
+        return None
+
+    def changed(self):
+        """Save the current status in the job table. Called by the tasks when
+        their status changes."""
+        if self.scheduler:
+            self.scheduler.table.save(self)
+
+
+def interrupted_status(status_json):
+    """Mark the job status (in the format used by the importers' status pages)
+    as failed."""
+    status = json.loads(status_json) if status_json else None
+    if not status:
+        return status_json
+    status['running'] = False
+    status['queued'] = False
+    status['error'] = True
+    unfinished = [task for task in status.get('task_statuses', []) if not task['completed']]
+    running = [task for task in unfinished if task['running']] or unfinished[:1]
+    for task in running:
+        task['running'] = False
+        task['error'] = True
+        task['status'] = INTERRUPTED_MESSAGE
+    return json.dumps(status)
+
+
+class JobTable(object):
+    """SQLite table of jobs. If the file can't be opened, an in-memory database
+    is used, and the jobs are lost on restart."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.db = sqlite3.connect(path, check_same_thread=False)
+        except (OSError, sqlite3.Error):
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS job (
+                        id TEXT PRIMARY KEY,
+                        key TEXT,
+                        state TEXT,
+                        submitted REAL,
+                        started REAL,
+                        finished REAL,
+                        inputs TEXT,
+                        status TEXT
+                        )""")
+
+    def save(self, job):
+        # The inputs may contain the sample file, and are only kept until the
+        # job has started
+        inputs = json.dumps(job.inputs) if job.state == QUEUED else None
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job.id, job.key, job.state, job.submitted, job.started,
+                        job.finished, inputs, job.status_json()))
+
+    def get_status(self, job_id):
+        """Get the last saved status of a job, or None if it doesn't exist."""
+        with self.lock:
+            row = self.db.execute("SELECT status FROM job WHERE id=?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def latest_id(self, key):
+        """ID of the most recently submitted job with this key, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT id FROM job WHERE key=? ORDER BY submitted DESC LIMIT 1",
+                    (key,)).fetchone()
+        return row[0] if row else None
+
+    def unfinished(self):
+        """List of (id, key, state, submitted, inputs, status) for jobs which are
+        queued or running, in order of submission."""
+        with self.lock:
+            return self.db.execute("""SELECT id, key, state, submitted, inputs, status
+                    FROM job WHERE state IN (?, ?) ORDER BY submitted""",
+                    (QUEUED, RUNNING)).fetchall()
+
+    def mark_interrupted(self, job_id, status_json):
+        with self.lock, self.db:
+            self.db.execute("UPDATE job SET state=?, finished=?, inputs=NULL, status=? WHERE id=?",
+                    (INTERRUPTED, time.time(), interrupted_status(status_json), job_id))
+
+    def expire(self, cutoff):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM job WHERE finished < ?", (cutoff,))
+
+
+class JobScheduler(object):
+    """Runs jobs on a thread pool, one at a time per key.
+
+    Only queued and running jobs are kept in memory. The status of finished
+    jobs is read from the job table.
+    """
+
+    def __init__(self, table, max_jobs=MAX_CONCURRENT_JOBS):
+        self.table = table
+        self.pool = ThreadPool(max_jobs)
+        self.lock = threading.Lock()
+        self.jobs = {}                      # id => job
+        self.waiting = defaultdict(deque)   # key => jobs waiting for the key
+        self.active_keys = set()
+
+    def submit(self, job):
+        job.scheduler = self
+        with self.lock:
+            self.jobs[job.id] = job
+            self.table.save(job)
+            if job.key in self.active_keys:
+                self.waiting[job.key].append(job)
+            else:
+                self._start(job)
+
+    def _start(self, job):
+        """Call with the lock held."""
+        self.active_keys.add(job.key)
+        self.pool.apply_async(self._run, (job,))
+
+    def _run(self, job):
+        try:
+            job.state = RUNNING
+            job.started = time.time()
+            self.table.save(job)
+            job.run()
+        finally:
+            job.state = FINISHED
+            job.finished = time.time()
+            self.table.save(job)
+            with self.lock:
+                del self.jobs[job.id]
+                waiting = self.waiting[job.key]
+                if waiting:
+                    self._start(waiting.popleft())
+                else:
+                    self.active_keys.discard(job.key)
+                    del self.waiting[job.key]
+
+    def get(self, job_id):
+        """Get a queued or running job, or None."""
+        return self.jobs.get(job_id)
+
+    def get_active(self, key):
+        """Get the oldest queued or running job with this key, or None."""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.key == key]
+        return min(jobs, key=lambda job: job.submitted) if jobs else None
+
+    def resume(self, factory):
+        """Handle jobs left over from a previous server process, and remove old
+        jobs from the table. factory(inputs) should return a new job object."""
+        for job_id, key, state, submitted, inputs, status in self.table.unfinished():
+            job = None
+            if state == QUEUED and inputs:
+                try:
+                    job = factory(json.loads(inputs))
+                except Exception:
+                    job = None
+            if job is None:
+                self.table.mark_interrupted(job_id, status)
+            else:
+                job.id = job_id
+                job.submitted = submitted
+                self.submit(job)
+        self.table.expire(time.time() - JOB_RETENTION)
@@ -0,0 +1 @@
+../lims_wait.py
\ No newline at end of file
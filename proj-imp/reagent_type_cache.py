@@ -0,0 +1 @@
+../set-reagent-labels/reagent_type_cache.py
\ No newline at end of file
@@ -5,6 +5,7 @@ import os
 import io
 import threading
 import json
+import base64
 import Queue as Mod_Queue # Due to name conflict with genologics
 from flask import Flask, url_for, abort, jsonify, Response, request,\
         render_template, redirect
@@ -16,6 +17,8 @@ from genologics.lims import *
 from genologics import config
 
 import indexes
+import lims_wait
+from job_scheduler import JobScheduler, JobTable, ScheduledJob, QUEUED
 
 # External project creation backend server
 
@@ -31,11 +34,16 @@ import indexes
 app = Flask(__name__)
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
-# Global dict that maps type name to job object for project type
-# (only one project may be created at a time)
+JOB_TABLE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "nsc-lims", "proj-imp-jobs.sqlite")
+
+# Global dict that maps type name to worker object for project type
 project_types = {}
 project_types_lock = threading.Lock()
 
+# Jobs for different project types run concurrently. Jobs for the same
+# project type are queued, and run one at a time.
+scheduler = JobScheduler(JobTable(JOB_TABLE_FILE))
+
 # Return 404 for root path and subpaths not ending with /
 @app.route("/")
 def get_root(dummy=None):
@@ -99,50 +107,55 @@ def submit_project(project_type):
                 error_message="Sample file upload failed. Make sure sample file is specified.",
                 **project_data)
 
+    project_type_worker = get_worker(project_type, project_data)
+    try:
+        job = project_type_worker.start_job(username, password, project_title,
+                file_name, file_data.getvalue(), parameters)
+    except LimsCredentialsError:
+        # Why abort() here, not render_template?: We can't put the
+        # file back into the response, so better encourage the user
+        # to press back and try again (with the file).
+        abort(403, "Incorrect username or password, please go back "
+                "and try again.")
+    except Exception as e:
+        abort(500, "LIMS seems to be unreachable: {0}".format(e))
+
+    return redirect(url_for('get_project_status', project_type=project_type, job=job.id))
+
+
+def get_worker(project_type, project_data):
     with project_types_lock:
-        project_type_worker = project_types.setdefault(
-                    project_type, ProjectTypeWorker(project_data)
+        return project_types.setdefault(
+                    project_type, ProjectTypeWorker(project_type, project_data)
                     )
-        if not project_type_worker.active:
-            try:
-                project_type_worker.start_job(username, password, project_title,
-                        file_name, file_data.getvalue(), parameters)
-            except LimsCredentialsError:
-                # Why abort() here, not render_template?: We can't put the
-                # file back into the response, so better encourage the user
-                # to press back and try again (with the file).
-                abort(403, "Incorrect username or password, please go back "
-                        "and try again.")
-            except Exception as e:
-                abort(500, "LIMS seems to be unreachable: {0}".format(e))
-
-    return redirect(url_for('get_project_status', project_type=project_type))
 
 
 @app.route("/<project_type>/status")
 def get_project_status(project_type):
-    """Status page"""
+    """Status page. Shows the job given by the job query parameter, or the
+    latest job for the project type."""
 
     parameters = get_project_def(project_type)
-    parameters['evtSourceUrl'] = url_for('get_stream', project_type=project_type)
+    job_id = request.args.get('job') or scheduler.table.latest_id(project_type)
+    parameters['evtSourceUrl'] = url_for('get_stream', project_type=project_type, job=job_id)
     return render_template("status.html", **parameters)
 
 
 @app.route("/<project_type>/stream")
 def get_stream(project_type):
     """SSE stream with progress."""
-    with project_types_lock:
-        try:
-            project_type_worker = project_types[project_type]
-        except KeyError:
-            abort(404, "No such project type")
-        if project_type_worker.job is None:
-            abort(500, "No import has been started")
-    if project_type_worker.job:
-        stream = status_stream(project_type_worker.job)
+    job_id = request.args.get('job')
+    if not job_id:
+        abort(404, "No import has been started")
+    job = scheduler.get(job_id)
+    if job and job.key == project_type:
+        stream = status_stream(job)
         return Response(stream, mimetype="text/event-stream")
-    else:
+    # Finished job, or job from before a server restart
+    status = scheduler.table.get_status(job_id)
+    if status is None:
         abort(404, "No job found for this project type")
+    return Response(stored_status_stream(status), mimetype="text/event-stream")
 
 
 def status_repr(job):
@@ -152,13 +165,16 @@ def status_repr(job):
                 "error": task.error,
                 "completed": task.completed,
                 "status": task.status,
-                "name": task.NAME
+                "name": task.NAME,
+                "started": task.started,
+                "finished": task.finished
             } for task in job.tasks
         ]
     return json.dumps({
             "project_title": job.project_title,
             "step_url": job.step_url,
             "task_statuses": task_statuses,
+            "queued": job.state == QUEUED,
             "running": job.running,
             "error": job.error,
             "completed": job.completed
@@ -195,6 +211,11 @@ def status_stream(job):
             break
 
 
+def stored_status_stream(status):
+    yield "event: status\ndata: " + status + "\n\n"
+    yield "event: shutdown\ndata: null\n\n"
+
+
 class LimsCredentialsError(ValueError):
     pass
 
@@ -208,18 +229,23 @@ class Task(object):
         self._status = None
         self.error = False
         self.job = job
+        self.started = None
+        self.finished = None
 
     def __call__(self):
         try:
+            self.started = time.time()
             self.running = True
             self.status = None
             self.run()
         except Exception as e:
+            self.finished = time.time()
             self.running = False
             self.error = True
             self.status = str(e)
             return False
         else:
+            self.finished = time.time()
             self.completed = True
             self.running = False
             self.status = None
@@ -235,13 +261,16 @@ class Task(object):
     @status.setter
     def status(self, val):
         self._status = val
+        self.job.changed()
         self.job.queue.put("status")
 
 
-class Job(object):
+class Job(ScheduledJob):
     def __init__(self, worker, username, project_title, sample_filename,
             sample_file_data, parameters):
+        super(Job, self).__init__(worker.name)
         self.worker = worker
+        self.username = username
         self.project_type = worker.project_type
         self.read1_cycles = self.project_type['read1_cycles']
         self.read2_cycles = self.project_type.get('read2_cycles')
@@ -282,6 +311,20 @@ class Job(object):
                 break
         self.queue.put("shutdown")
 
+    def status_json(self):
+        return status_repr(self)
+
+    @property
+    def inputs(self):
+        return {
+                "project_type": self.worker.name,
+                "username": self.username,
+                "project_title": self.project_title,
+                "sample_filename": self.sample_filename,
+                "sample_file": base64.b64encode(self.sample_file_data).decode('ascii'),
+                "parameters": self.parameters
+                }
+
     @property
     def running(self):
         return any(task.running for task in self.tasks)
@@ -570,11 +613,7 @@ class RunPoolingStep(Task):
         stepconf = self.job.lims_workflow.protocols[0].steps[0]
         self.status = "Waiting for samples to appear in queue..."
         my_artifacts = [sample.artifact for sample in self.job.lims_samples]
-        for attempt in range(10):
-            queue = stepconf.queue()
-            if set(queue.artifacts) >= set(my_artifacts):
-                time.sleep(1)
-                queue.get(force=True)
+        lims_wait.wait_for_queue(lims, stepconf, my_artifacts)
         self.status = "Starting step..."
         step = lims.create_step(stepconf, my_artifacts, container_type="Tube")
         self.job.step_url = config.BASEURI.rstrip("/") +\
@@ -583,12 +622,9 @@ class RunPoolingStep(Task):
         self.status = "Running step..."
         poolable = step.pools.available_inputs
         step.pools.create_pool(self.job.project_type['pool_name'], poolable)
-        while step.current_state.upper() != "COMPLETED":
-            if step.current_state == "Assign Next Steps":
-                lims.set_default_next_step(step)
-            step.advance()
-            step.get(force=True)
-            self.status = "Completing step (" + str(step.current_state) + ")"
+        def show_state(state):
+            self.status = "Completing step (" + str(state) + ")"
+        lims_wait.complete_step(lims, step, show_state)
         process = Process(lims, id=step.id)
         process.technician = self.job.user
         process.put()
@@ -619,12 +655,7 @@ class RunDenatureStep(Task):
         # First, get the pooling step ID and the queue
         stepconf = self.job.lims_workflow.protocols[1].steps[0]
         self.status = "Waiting for pool to appear in queue..."
-        queue = stepconf.queue()
-        for attempt in range(10):
-            if any(a.id == self.job.pool.id for a in queue.artifacts):
-                break
-            time.sleep(3)
-            queue.get(force=True)
+        lims_wait.wait_for_queue(lims, stepconf, [self.job.pool])
         self.status = "Running step and setting parameters..."
         step = lims.create_step(stepconf, [self.job.pool], container_type="MiSeq Reagent Cartridge")
         self.job.step_url = config.BASEURI.rstrip("/") +\
@@ -692,12 +723,7 @@ class StartSequencingStep(Task):
         # First, get the pooling step ID and the queue
         stepconf = self.job.lims_workflow.protocols[1].steps[1]
         self.status = "Waiting for samples to appear in queue..."
-        for attempt in range(10):
-            queue = stepconf.queue()
-            if any(a.id == self.job.sequencing_pool.id for a in queue.artifacts):
-                break
-            time.sleep(3)
-            queue.get(force=True)
+        lims_wait.wait_for_queue(lims, stepconf, [self.job.sequencing_pool])
         self.status = "Starting step..."
         step = lims.create_step(stepconf, [self.job.sequencing_pool])
         process = Process(lims, id=step.id)
@@ -711,29 +737,24 @@ class ProjectTypeWorker(object):
 
     all_reagent_types = None
 
-    def __init__(self, project_type):
+    def __init__(self, name, project_type):
+        self.name = name
         self.project_type = project_type
         self.job = None
         self.indexes = []
-        self.active = False
 
     def start_job(self, username, password, project_title, sample_filename,
             sample_file_data, parameters):
-        """Start an import task with the specified parameters.
-        
-        This function is not thread safe! Syncrhonization must be handled
-        by the caller.
+        """Start an import task with the specified parameters, and return the
+        Job. The job is queued if another job for the same project type is
+        running.
         """
-        assert not self.active
-
         self.check_lims_credentials(username, password)
 
         self.job = Job(self, username, project_title, sample_filename,
                 sample_file_data, parameters)
-
-        thread = threading.Thread(target=self.run_job)
-        self.active = True
-        thread.start()
+        scheduler.submit(self.job)
+        return self.job
 
     def check_lims_credentials(self, username, password):
         """Check supplied username and password. Throws an
@@ -751,11 +772,16 @@ class ProjectTypeWorker(object):
                 # If the password is wrong, we will get a 401.
                 raise LimsCredentialsError()
 
-    def run_job(self):
-        try:
-            self.job.run()
-        finally:
-            self.active = False
+
+def resume_job(inputs):
+    """Re-create a job which was queued when the server was stopped."""
+    project_type = inputs['project_type']
+    worker = get_worker(project_type, get_project_def(project_type))
+    return Job(worker, inputs['username'], inputs['project_title'],
+            inputs['sample_filename'], base64.b64decode(inputs['sample_file']),
+            inputs['parameters'])
+
+scheduler.resume(resume_job)
 
 
 # Start deveopment server if called on the command line
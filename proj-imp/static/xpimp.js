@@ -8,6 +8,13 @@ function receiveStatusEvent(event) {
 
     var data = JSON.parse(event.data);
 
+    if (data.queued) {
+        var elem = document.createElement("div");
+        elem.innerHTML = "Waiting for another import to finish...";
+        elem.className = "task running";
+        new_container.appendChild(elem);
+    }
+
     var num_tasks = data.task_statuses.length;
     for (var i=0; i<num_tasks; ++i) {
         var task = data.task_statuses[i];
@@ -28,6 +35,9 @@ function receiveStatusEvent(event) {
         if (task.status) {
             text += ": " + task.status;
         }
+        if (task.started && task.finished) {
+            text += " (" + Math.round(task.finished - task.started) + " s)";
+        }
 
         elem.innerHTML = text;
         elem.className = classNames;
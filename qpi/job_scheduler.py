@@ -0,0 +1 @@
+../proj-imp/job_scheduler.py
\ No newline at end of file
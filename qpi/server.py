@@ -10,6 +10,7 @@ import sys
 import string
 import base64
 import Queue as Mod_Queue # Due to name conflict with genologics
+from xml.etree import ElementTree
 from flask import Flask, url_for, abort, jsonify, Response, request,\
         render_template, redirect
 from werkzeug.utils import secure_filename
@@ -19,19 +20,30 @@ import requests
 from genologics.lims import *
 from genologics import config
 
+from job_scheduler import JobScheduler, JobTable, ScheduledJob, QUEUED
+
 # External project creation backend server
 
 PROJECT_TYPES = ['FHI-Swift', 'MIK-Swift', 'FHI-NimaGen', 'MIK-NimaGen']
 
+# Number of samples per batch create request. Progress is reported after
+# each batch.
+SAMPLE_BATCH_SIZE = 24
+
+JOB_TABLE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "nsc-lims", "qpi-jobs.sqlite")
+
+SAMPLE_NS = "http://genologics.com/ri/sample"
+UDF_NS = "http://genologics.com/ri/userdefined"
+
 # This will be registered as a WSGI application under a path.
 
 app = Flask(__name__)
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
-# Global dict that maps type name to job object for project type
-# (only one project may be created at a time)
-workers = {}
-workers_lock = threading.Lock()
+# Import jobs for different projects run concurrently. Only one job at a time
+# is accepted for each project name.
+scheduler = JobScheduler(JobTable(JOB_TABLE_FILE))
+submit_lock = threading.Lock()
 
 @app.route("/")
 def get_project_start_page():
@@ -109,11 +121,9 @@ def submit_project():
                 project_types=PROJECT_TYPES, project_name_presets=project_name_presets,
                 error_message="Sample file upload failed. Make sure sample file is specified.")
 
-    with workers_lock:
-        worker = workers.setdefault(
-                    projectname, ProjectWorker(project_template_data)
-                    )
-        if not worker.active:
+    with submit_lock:
+        if not scheduler.get_active(projectname):
+            worker = ProjectWorker(template, project_template_data)
             try:
                 worker.start_job(username, password, projectname,
                         file_name, file_object)
@@ -125,11 +135,6 @@ def submit_project():
                         "and try again.".format(username, password))
             except Exception as e:
                 abort(500, "LIMS seems to be unreachable, or bug in job creation: {0}".format(e))
-        
-        # Cleanup old workers
-        for w in list(workers):
-            if workers[w].rundate and workers[w].rundate < datetime.date.today():
-                del workers[w]
 
     return redirect(url_for('get_project_status', projectname=projectname))
 
@@ -145,18 +150,15 @@ def get_project_status(projectname):
 @app.route("/stream/<projectname>")
 def get_stream(projectname):
     """SSE stream with progress."""
-    with workers_lock:
-        try:
-            worker = workers[projectname]
-        except KeyError:
-            abort(404, "Project is not being processed")
-        if worker.job is None:
-            abort(500, "No import has been started")
-    if worker.job:
-        stream = status_stream(worker.job)
-        return Response(stream, mimetype="text/event-stream")
-    else:
-        abort(404, "No job found for this project")
+    job = scheduler.get_active(projectname)
+    if job:
+        return Response(status_stream(job), mimetype="text/event-stream")
+    # Finished job, or job from before a server restart
+    job_id = scheduler.table.latest_id(projectname)
+    if job_id is None:
+        abort(404, "Project is not being processed")
+    stream = stored_status_stream(scheduler.table.get_status(job_id))
+    return Response(stream, mimetype="text/event-stream")
 
 
 def status_repr(job):
@@ -166,13 +168,16 @@ def status_repr(job):
                 "error": task.error,
                 "completed": task.completed,
                 "status": task.status,
-                "name": task.NAME
+                "name": task.NAME,
+                "started": task.started,
+                "finished": task.finished
             } for task in job.tasks
         ]
     return json.dumps({
             "project_title": job.projectname,
             "step_url": job.step_url,
             "task_statuses": task_statuses,
+            "queued": job.state == QUEUED,
             "running": job.running,
             "error": job.error,
             "completed": job.completed
@@ -209,6 +214,11 @@ def status_stream(job):
             break
 
 
+def stored_status_stream(status):
+    yield "event: status\ndata: " + status + "\n\n"
+    yield "event: shutdown\ndata: null\n\n"
+
+
 class LimsCredentialsError(ValueError):
     pass
 
@@ -222,13 +232,17 @@ class Task(object):
         self._status = None
         self.error = False
         self.job = job
+        self.started = None
+        self.finished = None
 
     def __call__(self):
         try:
+            self.started = time.time()
             self.running = True
             self.status = None
             self.run()
         except Exception as e:
+            self.finished = time.time()
             self.running = False
             self.error = True
             # Remove non-ascii characters in exception message (this can happen)
@@ -237,6 +251,7 @@ class Task(object):
             app.logger.error("Failed in task {}.".format(self.__class__.__name__), exc_info=e)
             return False
         else:
+            self.finished = time.time()
             self.completed = True
             self.running = False
             self.status = None
@@ -252,13 +267,16 @@ class Task(object):
     @status.setter
     def status(self, val):
         self._status = val
+        self.job.changed()
         self.job.queue.put("status")
 
 
-class Job(object):
+class Job(ScheduledJob):
     def __init__(self, worker, username, projectname, sample_filename,
             sample_file_object):
+        super(Job, self).__init__(projectname)
         self.worker = worker
+        self.username = username
         self.project_template_data = worker.project_template_data
         self.projectname = projectname
         # Get user object used as owner of objects created in LIMS. This also
@@ -282,6 +300,19 @@ class Job(object):
                 break
         self.queue.put("shutdown")
 
+    def status_json(self):
+        return status_repr(self)
+
+    @property
+    def inputs(self):
+        return {
+                "template": self.worker.template,
+                "username": self.username,
+                "projectname": self.projectname,
+                "sample_filename": self.sample_filename,
+                "sample_file": base64.b64encode(self.sample_file_object.getvalue()).decode('ascii')
+                }
+
     @property
     def running(self):
         return any(task.running for task in self.tasks)
@@ -442,29 +473,91 @@ class UploadFile(Task):
         f_obj.upload(self.job.sample_file_object.getvalue())
 
 
+def udf_type(value):
+    """UDF type attribute for a value, using the same rules as genologics
+    when adding a new UDF to an entity."""
+    if isinstance(value, bool):
+        return "Boolean"
+    elif isinstance(value, (int, long, float)):
+        return "Numeric"
+    elif isinstance(value, datetime.date):
+        return "Date"
+    else:
+        return "String"
+
+
+def sample_creation_xml(samples, project, container):
+    """Request body for samples/batch/create. samples is a list of
+    (name, well, udf_dict) tuples."""
+    root = ElementTree.Element("{%s}details" % SAMPLE_NS)
+    for name, well, udfs in samples:
+        node = ElementTree.SubElement(root, "{%s}samplecreation" % SAMPLE_NS)
+        ElementTree.SubElement(node, "name").text = name
+        ElementTree.SubElement(node, "project", uri=project.uri)
+        location = ElementTree.SubElement(node, "location")
+        ElementTree.SubElement(location, "container", uri=container.uri)
+        ElementTree.SubElement(location, "value").text = well
+        for key, value in udfs.items():
+            field = ElementTree.SubElement(node, "{%s}field" % UDF_NS,
+                    name=key, type=udf_type(value))
+            if isinstance(value, bool):
+                field.text = "true" if value else "false"
+            elif isinstance(value, datetime.date):
+                field.text = value.isoformat()
+            else:
+                field.text = unicode(value)
+    return ElementTree.tostring(root, encoding="utf-8")
+
+
 class CreatePlateAndSamples(Task):
+    """Create the samples using the batch create endpoint, in chunks of
+    SAMPLE_BATCH_SIZE. The samples are then retrieved with a batch request, so
+    their artifacts are known without further requests. If a batch fails, the
+    error lists the samples which were already created."""
+
     NAME = "Create plate and samples"
 
     def run(self):
         plate = lims.create_container(type=lims.get_container_types('96 well plate')[0])
-        for sample in self.job.samples:
-            set_udfs = sample[2]
-            if 'sample_fields' in self.job.project_template_data and self.job.project_template_data['sample_fields']:
-                set_udfs.update(self.job.project_template_data['sample_fields'])
-            lims_sample = lims.create_sample(
-                    sample[0],
-                    self.job.lims_project,
-                    container=plate,
-                    well=sample[1],
-                    udf=set_udfs
-            )
-            self.job.lims_samples.append(lims_sample)
-            
+        sample_fields = self.job.project_template_data.get('sample_fields') or {}
+        samples = []
+        for name, well, set_udfs in self.job.samples:
+            set_udfs.update(sample_fields)
+            samples.append((name, well, set_udfs))
+        create_uri = lims.get_uri('samples', 'batch', 'create')
+        lims_samples = []
+        for start in range(0, len(samples), SAMPLE_BATCH_SIZE):
+            self.status = "Created {0} of {1} samples...".format(start, len(samples))
+            try:
+                links = lims.post(
+                        create_uri,
+                        sample_creation_xml(samples[start:start+SAMPLE_BATCH_SIZE],
+                            self.job.lims_project, plate)
+                        )
+            except Exception as e:
+                # The batches before this one are already in the LIMS. Running
+                # the import again would create them a second time, on a new
+                # plate, so they have to be removed (or the rest added) by hand.
+                if not lims_samples:
+                    raise
+                raise RuntimeError("Error while creating samples {0} to {1}: {2}. "
+                        "Already created on plate {3}: {4}. These must be removed "
+                        "before the project is imported again.".format(
+                            start + 1, min(start + SAMPLE_BATCH_SIZE, len(samples)), e,
+                            plate.id, ", ".join(name for name, _, _ in samples[:start])))
+            lims_samples += [Sample(lims, uri=link.attrib['uri']) for link in links.findall('link')]
+        if len(lims_samples) != len(samples):
+            raise RuntimeError("Expected {0} samples to be created, but LIMS returned {1}.".format(
+                len(samples), len(lims_samples)))
+        self.status = "Created {0} of {0} samples. Retrieving samples...".format(len(samples))
+        self.job.lims_samples = lims.get_batch(lims_samples)
+
 
 class AssignWorkflow(Task):
     NAME = "Assign to workflow"
 
     def run(self):
+        # Samples were fetched by batch retrieve, so this doesn't cause requests
         artifacts = [sample.artifact for sample in self.job.lims_samples]
         workflows = lims.get_workflows(name=self.job.project_template_data['workflow'])
         if not workflows:
@@ -475,33 +568,26 @@ class AssignWorkflow(Task):
 
 
 class ProjectWorker(object):
-    """Worker, manages the trhead. Will run one Job, which is to import one project.
+    """Worker, creates the Job to import one project, and submits it to the
+    scheduler.
     
     (In version 1 project importer, the worker runs all jobs for a specific project type.)
     """
 
-    def __init__(self, project_template_data):
+    def __init__(self, template, project_template_data):
+        self.template = template
         self.project_template_data = project_template_data
         self.job = None
-        self.active = False
-        self.rundate = None
 
     def start_job(self, username, password, project_title, sample_filename,
             sample_file_object):
-        """Start an import task with the specified parameters.
-        
-        This function is not thread safe! Syncrhonization must be handled
-        by the caller.
+        """Start an import task with the specified parameters. The job is
+        queued if another job for the same project is running.
         """
-        assert not self.active
-
         self.check_lims_credentials(username, password)
         self.job = Job(self, username, project_title, sample_filename,
                 sample_file_object)
-        thread = threading.Thread(target=self.run_job)
-        self.active = True
-        self.rundate = None
-        thread.start()
+        scheduler.submit(self.job)
 
     def check_lims_credentials(self, username, password):
         """Check supplied username and password. Throws an
@@ -522,12 +608,14 @@ class ProjectWorker(object):
                 # If the password is wrong, we will get a 401.
                 raise LimsCredentialsError()
 
-    def run_job(self):
-        try:
-            self.job.run()
-        finally:
-            self.active = False
-            self.rundate = datetime.date.today()
+
+def resume_job(inputs):
+    """Re-create a job which was queued when the server was stopped."""
+    worker = ProjectWorker(inputs['template'], get_project_def(inputs['template']))
+    return Job(worker, inputs['username'], inputs['projectname'],
+            inputs['sample_filename'], io.BytesIO(base64.b64decode(inputs['sample_file'])))
+
+scheduler.resume(resume_job)
 
 
 # Start deveopment server if called on the command line
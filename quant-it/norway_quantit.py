@@ -245,7 +245,7 @@ def doStuff(pDOM):
 
 	## now update the artifacts
 	## now just POST the updated artifacts back to the LIMS
-	rXML = api.createObject( blDOM.toxml(), BASE_URI + "artifacts/batch/update" )
+	rXML = api.updateBatchResourceByURI( BASE_URI + "artifacts/batch/update", blDOM.toxml() )
 	try:
 		rDOM = parseString( rXML )
 		nodes = rDOM.getElementsByTagName( "link" )
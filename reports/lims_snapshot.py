@@ -0,0 +1 @@
+../lims_snapshot.py
\ No newline at end of file
@@ -1,27 +1,70 @@
+# Report of open projects to be delivered by NeLS or TSD
+
+# By default, the projects modified since yesterday are reported, as in the
+# daily report e-mail. The project list resource doesn't include the UDFs, and
+# there is no batch resource for projects, so the details of the modified
+# projects are fetched in parallel, and saved in the local LIMS snapshot. With
+# --from / --to, projects are reported by registration (open) date from the
+# snapshot, after updating its projects with the changes since the last update
+# (or not at all, with --offline).
+
 from genologics.lims import *
 from genologics import config
+import argparse
 import datetime
 
-lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
-
-date_str = str(datetime.date.today() - datetime.timedelta(days=1))
-timestamp_str = date_str + "T00:00:00Z"
-nels_tsd_projects = []
-
-for project in lims.get_projects(last_modified=timestamp_str):
-    if project.close_date:
-        continue
-    if project.udf.get('Delivery method') == "NeLS project":
-        project_id = project.udf.get('NeLS project identifier', '(none)')
-        if project_id.startswith('Click here'):
-            project_id = "(none)"
-        nels_tsd_projects.append((project.name, project_id))
-    elif project.udf.get('Delivery method') == "TSD project":
-        nels_tsd_projects.append((project.name, "TSD"))
-
-if nels_tsd_projects:
-    print("*** New NeLS/TSD projects registered since {0} ***".format(date_str))
-    print("Project name\t\tNeLS ID")
-    for project in nels_tsd_projects:
-        print("{0}\t\t{1}".format(*project))
+import lims_snapshot
+
+
+def nels_tsd_projects(projects):
+    """Get a list of (name, NeLS ID) of open NeLS and TSD projects."""
+    result = []
+    for project in projects:
+        if project.close_date:
+            continue
+        if project.udf.get('Delivery method') == "NeLS project":
+            project_id = project.udf.get('NeLS project identifier', '(none)')
+            if project_id.startswith('Click here'):
+                project_id = "(none)"
+            result.append((project.name, project_id))
+        elif project.udf.get('Delivery method') == "TSD project":
+            result.append((project.name, "TSD"))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report open NeLS and TSD projects.")
+    parser.add_argument('--from', dest='date_from', metavar='YYYY-MM-DD',
+            help="Report projects opened on or after this date, using the snapshot")
+    parser.add_argument('--to', dest='date_to', metavar='YYYY-MM-DD',
+            help="Report projects opened on or before this date, using the snapshot")
+    parser.add_argument('--offline', action='store_true',
+            help="Don't update the snapshot from the LIMS before reporting a date range")
+    parser.add_argument('--snapshot', help="Snapshot file (default: per-server file in ~/.cache/nsc-lims)")
+    args = parser.parse_args()
+
+    lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
+    store = lims_snapshot.open_store(lims, args.snapshot)
+
+    if args.date_from or args.date_to:
+        if not args.offline:
+            store.update(lims, types=('project',))
+        projects = store.query(lims, 'project', date_from=args.date_from, date_to=args.date_to)
+        heading = "*** NeLS/TSD projects opened from {0} to {1} ***".format(
+                args.date_from or "the start", args.date_to or "today")
+    else:
+        date_str = str(datetime.date.today() - datetime.timedelta(days=1))
+        timestamp_str = date_str + "T00:00:00Z"
+        projects = store.fetch(lims, 'project', lims.get_projects(last_modified=timestamp_str))
+        heading = "*** New NeLS/TSD projects registered since {0} ***".format(date_str)
+
+    projects = nels_tsd_projects(projects)
+    if projects:
+        print(heading)
+        print("Project name\t\tNeLS ID")
+        for project in projects:
+            print("{0}\t\t{1}".format(*project))
+
 
+if __name__ == "__main__":
+    main()
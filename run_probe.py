@@ -0,0 +1,111 @@
+# Detection of the current cycle of a run in progress, from the run folder
+
+# NOTE: This file is used from ../sequencing/ and ../base-counter/, via symlinks
+
+# Checking the cycle directories or files one at a time from the last known
+# cycle takes up to a few hundred stat calls per run on the NFS storage, when
+# a run is first seen. Instead, the lane 1 base call directory is listed, and
+# the listing is cached until the modification time of the directory changes.
+# A listing taken within LISTING_MIN_AGE of the modification time is not
+# reused, as an entry may have been added within the same mtime tick.
+# The sequencers write the cycles in order, so the highest completed cycle is
+# found by bisection. Only the NovaSeq (CBCL) layout needs to look into the
+# cycle directories, as the directory is created before the data is written.
+#
+# Supported layouts, under Data/Intensities/BaseCalls/L001:
+#  - C{n}.1/             Directory per cycle (MiSeq, HiSeq)
+#  - C{n}.1/*.cbcl       Directory per cycle with CBCL files (NovaSeq, NextSeq 2000)
+#  - {n:04d}.bcl.bgzf    File per cycle (NextSeq 500)
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+CYCLE_PATTERNS = [re.compile(r"C(\d+)\.1$"), re.compile(r"(\d{4})\.bcl\.bgzf$")]
+
+# Number of directory listings to keep. Covers the run storages, run folders,
+# base call directories and a few cycle directories for all runs on the
+# storages.
+LISTING_CACHE_SIZE = 2000
+# Minimum time between the modification of a directory and the listing, for the
+# listing to be reused (seconds). Covers the mtime resolution of the file
+# system, and clock differences between the NFS server and client.
+LISTING_MIN_AGE = 2
+
+_listings = OrderedDict() # path => (mtime, names, reusable)
+_lock = threading.Lock()
+
+
+def basecalls_dir(run_dir, lane=1):
+    return os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L{0:03d}".format(lane))
+
+
+def list_dir(path):
+    """List the names in a directory, or return an empty list if it doesn't
+    exist. The listing is reused while the directory's mtime is unchanged,
+    unless it was listed within LISTING_MIN_AGE of the mtime."""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return []
+    with _lock:
+        cached = _listings.pop(path, None)
+        if cached and cached[0] == mtime and cached[2]:
+            _listings[path] = cached
+            return cached[1]
+    listed_at = time.time()
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    with _lock:
+        _listings[path] = (mtime, names, listed_at - mtime >= LISTING_MIN_AGE)
+        while len(_listings) > LISTING_CACHE_SIZE:
+            _listings.popitem(last=False)
+    return names
+
+
+def cycle_entries(names):
+    """Get a dict of cycle number (1-based) => name of the cycle directory or
+    file, from a base call directory listing."""
+    entries = {}
+    for name in names:
+        for pattern in CYCLE_PATTERNS:
+            match = pattern.match(name)
+            if match:
+                entries[int(match.group(1))] = name
+                break
+    return entries
+
+
+def has_cbcl(path):
+    return any(name.endswith(".cbcl") for name in list_dir(path))
+
+
+def get_cycle(run_dir, total_cycles, lower_bound_cycle=0):
+    """Get the number of completed cycles, based on the files written in the
+    run folder. Cycles up to lower_bound_cycle are assumed to be completed.
+
+    Will look at lane 1 only, to reduce I/O and complexity.
+    """
+    lane_dir = basecalls_dir(run_dir)
+    entries = cycle_entries(list_dir(lane_dir))
+    cbcl = 1 in entries and has_cbcl(os.path.join(lane_dir, entries[1]))
+
+    def completed(cycle):
+        name = entries.get(cycle)
+        if name is None:
+            return False
+        return not cbcl or has_cbcl(os.path.join(lane_dir, name))
+
+    low = min(max(0, lower_bound_cycle), total_cycles)
+    high = min(total_cycles, max(entries) if entries else 0)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if completed(mid):
+            low = mid
+        else:
+            high = mid - 1
+    return low
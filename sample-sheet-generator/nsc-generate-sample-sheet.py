@@ -14,34 +14,14 @@ import datetime
 from genologics.lims import *
 from genologics import config
 from argparse import ArgumentParser
+import reagent_type_cache
 
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
-reagent_type_uri = {}
-reagent_type_seq = {}
-
-def get_all_reagent_types():
-    """Load all reagent types with name only, from the API resource.
-    (this is a lot faster than getting the full representations one by
-    one)."""
-    # Using a loop similar to Lims._get_instances()
-    reagent_types = {}
-    root = lims.get(lims.get_uri("reagenttypes"))
-    while root:
-        for node in root.findall("reagent-type"):
-            # add a reagent type to the dict by name
-            name = node.attrib['name']
-            uri = node.attrib['uri']
-            reagent_types[name] = uri
-        node = root.find('next-page')
-        root = None
-        if not node is None:
-            root = lims.get(node.attrib['uri'])
-    return reagent_types
-
+reagent_types = None
 
 def main(process_id, output_file_id, include_lane, use_sampleid):
-    global reagent_type_uri
+    global reagent_types
 
     process = Process(lims, id=process_id)
     i_os = [(i['uri'], o['uri']) 
@@ -54,7 +34,7 @@ def main(process_id, output_file_id, include_lane, use_sampleid):
         print("Only one output container (flowcell) may be used at a time")
         sys.exit(1)
 
-    reagent_type_uri = get_all_reagent_types()
+    reagent_types = reagent_type_cache.get_cache(lims)
 
     data = generate_sample_sheet(process, i_os, include_lane, use_sampleid)
 
@@ -229,15 +209,10 @@ def get_samples_and_indexes(artifact):
     if len(artifact.reagent_labels) == 1:
         index_name = next(iter(artifact.reagent_labels))
         try:
-            index_seq = reagent_type_seq[index_name]
-        except KeyError:
-            try:
-                reagent_obj = ReagentType(lims, uri=reagent_type_uri[index_name])
-                index_seq = reagent_obj.sequence
-                reagent_type_seq[index_name] = index_seq
-            except KeyError as e:
-                print("Index reagent name {0} is not available in the system.".format(e))
-                sys.exit(1)
+            index_seq = reagent_types.info(reagent_types.uri_for_name(index_name)).sequence
+        except KeyError as e:
+            print("Index reagent name {0} is not available in the system.".format(e))
+            sys.exit(1)
         return [(artifact.samples[0], artifact, index_seq)]
     else:
         parent = artifact.parent_process
@@ -1,21 +1,29 @@
 # -*- coding: utf-8 -*-
 
-from flask import Flask, redirect, request, jsonify, Response, send_file
+from flask import Flask, redirect, request, jsonify, Response
 from genologics.lims import *
 from genologics import config
-import io
-import zipfile
 import re
 import sys
 import os
-import glob
+import threading
+from zipstream import ZipStream
+from runindex import RunIndex, CACHE_DIR
 
 app = Flask(__name__)
 
 CURRENT_RUN_DIRS = ["/data/runScratch.boston", "/boston/diag/runs", "/boston/diag/runs/veriseq"]
-CURRENT_RUN_GLOBS = ["{0}/[0-9]*_*_*/".format(crd) for crd in CURRENT_RUN_DIRS]
 ARCHIVE_RUN_DIRS = ["/data/runScratch.boston/processed"]
-ARCHIVE_RUN_GLOBS = ["{0}/[0-9]*_*_*/".format(ard) for ard in ARCHIVE_RUN_DIRS]
+
+run_indexes = {
+        "current": RunIndex(CURRENT_RUN_DIRS, os.path.join(CACHE_DIR, "sav-runs-current.json")),
+        "archive": RunIndex(ARCHIVE_RUN_DIRS, os.path.join(CACHE_DIR, "sav-runs-archive.json")),
+        }
+
+# Each download keeps a WSGI thread busy while the archive is streamed, so the
+# number of simultaneous downloads is limited, leaving threads for the page
+MAX_CONCURRENT_DOWNLOADS = 4
+download_slots = threading.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
 
 
 @app.route('/')
@@ -25,24 +33,46 @@ def get_main():
 
 @app.route('/runs/<collection>')
 def get_runs(collection):
-    if collection == "current":
-        run_paths = sum((glob.glob(x) for x in CURRENT_RUN_GLOBS), [])
-    elif collection == "archive":
-        run_paths = sum((glob.glob(x) for x in ARCHIVE_RUN_GLOBS), [])
-    else:
-        return "Error: Invalid collection", 400
-    run_ids = [os.path.basename(r.rstrip("/")) for r in run_paths]
-    return jsonify(run_ids=sorted(run_ids, reverse=True))
-
+    """List runs, newest first.
 
-def add_directory(zfile, source_base, dest_base):
-    for f in os.listdir(source_base):
+    Optional query parameters:
+        instrument         -- instrument ID, as in the run ID
+        from, to           -- run date range, YYYY-MM-DD (inclusive)
+        offset, limit      -- pagination
+    """
+    try:
+        index = run_indexes[collection]
+    except KeyError:
+        return "Error: Invalid collection", 400
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = request.args.get('limit')
+        limit = int(limit) if limit else None
+    except ValueError:
+        return "Error: Invalid offset or limit", 400
+    total, runs = index.query(
+            instrument=request.args.get('instrument'),
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to'),
+            offset=offset,
+            limit=limit
+            )
+    return jsonify(
+            run_ids=[run['run_id'] for run in runs],
+            runs=runs,
+            total=total,
+            instruments=index.instruments()
+            )
+
+
+def add_directory(files, source_base, dest_base):
+    for f in sorted(os.listdir(source_base)):
         source_path = os.path.join(source_base, f)
         dest_path = os.path.join(dest_base, f)
         if os.path.isdir(source_path):
-            add_directory(zfile, source_path, dest_path)
+            add_directory(files, source_path, dest_path)
         else:
-            zfile.write(source_path, dest_path)
+            files.append((source_path, dest_path))
 
 
 def rangeexpand(txt):
@@ -69,30 +99,31 @@ def get_zip_file(collection, run_id):
     if not re.match(r"[0-9]+_[0-9a-zA-Z-_]+$", run_id):
         return "Error: Invalid run-id specified", 400
     for base_dir in base_dirs:
-    	run_path = os.path.join(base_dir, run_id)
+        run_path = os.path.join(base_dir, run_id)
         if os.path.isdir(run_path):
             break
     else:
         return "Error: Run doesn't exist", 400
-    outputbuffer = io.BytesIO()
-    zfile = zipfile.ZipFile(outputbuffer, 'w', allowZip64=True)
+    # The files are listed before the response starts, and read while the
+    # archive is sent. (source path, archive name)
+    files = []
     for file in request.args.get('files', '').split(','):
         try:
             if file in ("RunInfo.xml", "RTAConfiguration.xml"):
-                zfile.write(
+                files.append((
                         os.path.join(base_dir, run_id, file),
                         os.path.join(run_id, file)
-                        )
+                        ))
             elif file == "runParameters.xml":
                 for file_test in ["runParameters.xml", "RunParameters.xml"]:
                     path = os.path.join(base_dir, run_id, file_test)
                     if os.path.isfile(path):
-                        zfile.write(path, os.path.join(run_id, file_test))
+                        files.append((path, os.path.join(run_id, file_test)))
             elif file in [
                     "InterOp", "Images", "RTALogs", "Logs", "Recipe", "Config"
                     ]:
                 add_directory(
-                        zfile,
+                        files,
                         os.path.join(run_path, file),
                         os.path.join(run_id, file)
                         )
@@ -109,7 +140,7 @@ def get_zip_file(collection, run_id):
                         source = os.path.join(run_path, rel_path)
                         if os.path.isdir(source):
                             add_directory(
-                                    zfile,
+                                    files,
                                     source,
                                     os.path.join(run_id, rel_path)
                                     )
@@ -118,9 +149,15 @@ def get_zip_file(collection, run_id):
                 pass # Missing file!
             else:
                 raise
-    zfile.close()
-    outputbuffer.seek(0)
-    return send_file(outputbuffer, mimetype="application/zip")
+    if not download_slots.acquire(False):
+        return "Error: Too many downloads in progress, please try again later", 503
+    response = Response(ZipStream(files), mimetype="application/zip")
+    response.call_on_close(download_slots.release)
+    return response
+
+
+for index in run_indexes.values():
+    index.start()
 
 
 if __name__ == '__main__':
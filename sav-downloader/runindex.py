@@ -0,0 +1,234 @@
+# Index of run folders for the SAV downloader
+
+# Listing the run storage directories takes a long time on network storage,
+# especially the archive with thousands of processed runs. The index keeps the
+# information about each run in memory, and a background thread keeps it up to
+# date: a storage directory is only re-listed when its modification time has
+# changed, and a run folder is only re-examined when its own modification time
+# has changed. The index is saved to a JSON file, so the first page load after
+# a restart doesn't have to wait for a full scan.
+
+import os
+import re
+import json
+import time
+import errno
+import tempfile
+import threading
+
+REFRESH_INTERVAL = 60
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "nsc-lims")
+
+RUN_ID_PATTERN = re.compile(r"(\d{6,8})_([^_]+)_[^_]+")
+
+# Items offered for download, and the names they may have in the run folder
+COMPONENTS = {
+        "RunInfo.xml": ["RunInfo.xml"],
+        "RTAConfiguration.xml": ["RTAConfiguration.xml"],
+        "runParameters.xml": ["runParameters.xml", "RunParameters.xml"],
+        "InterOp": ["InterOp"],
+        "Images": ["Images"],
+        "RTALogs": ["RTALogs"],
+        "Logs": ["Logs"],
+        "Recipe": ["Recipe"],
+        "Config": ["Config"],
+        "Thumbnail_Images": ["Thumbnail_Images"],
+        }
+
+# The size reported for a run is the size of the default download: the
+# InterOp directory and the XML files. Images are not counted, as it would
+# require a walk of the whole run folder. The size is updated when the run
+# folder is re-examined, so it may lag behind for runs in progress.
+SIZE_COMPONENTS = ["RunInfo.xml", "runParameters.xml", "InterOp"]
+
+
+def parse_run_id(run_id):
+    """Get (date, instrument) from a run ID. The date is formatted as
+    YYYY-MM-DD."""
+    match = RUN_ID_PATTERN.match(run_id)
+    if not match:
+        return None, None
+    date, instrument = match.groups()
+    if len(date) == 6:
+        date = "20" + date
+    return "{0}-{1}-{2}".format(date[0:4], date[4:6], date[6:8]), instrument
+
+
+def path_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def scan_run(run_path, mtime):
+    """Get the index entry for a run folder."""
+    run_id = os.path.basename(run_path)
+    date, instrument = parse_run_id(run_id)
+    names = set(os.listdir(run_path))
+    components = sorted(
+            component for component, alternatives in COMPONENTS.items()
+            if any(name in names for name in alternatives)
+            )
+    size = 0
+    for component in SIZE_COMPONENTS:
+        for name in COMPONENTS[component]:
+            if name in names:
+                try:
+                    size += path_size(os.path.join(run_path, name))
+                except OSError:
+                    pass
+    return {
+            'run_id': run_id,
+            'path': run_path,
+            'date': date,
+            'instrument': instrument,
+            'components': components,
+            'size': size,
+            'last_modified': mtime,
+            }
+
+
+class RunIndex(object):
+    """Index of the run folders in a set of storage directories.
+
+    storage_dirs: list of directories containing run folders
+    path: JSON file to save the index in
+    """
+
+    def __init__(self, storage_dirs, path, pattern=r"[0-9].*_.*_"):
+        self.storage_dirs = storage_dirs
+        self.path = path
+        self.pattern = re.compile(pattern)
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.dir_mtimes = {}    # storage dir => mtime when last listed
+        self.dir_runs = {}      # storage dir => list of run IDs
+        self.runs = {}          # run ID => entry (dict)
+        self.loaded = False
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        with self.lock:
+            self.dir_mtimes = data['dir_mtimes']
+            self.dir_runs = data['dir_runs']
+            self.runs = data['runs']
+            self.loaded = True
+        return True
+
+    def save(self):
+        """Atomically replace the index file. Failure to write is not fatal."""
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with self.lock:
+                data = json.dumps({
+                        'dir_mtimes': self.dir_mtimes,
+                        'dir_runs': self.dir_runs,
+                        'runs': self.runs,
+                        })
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def refresh(self):
+        """Update the index. Returns True if anything changed."""
+        with self.refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        changed = False
+        for storage_dir in self.storage_dirs:
+            try:
+                mtime = os.path.getmtime(storage_dir)
+            except OSError:
+                mtime = None
+            if mtime is None:
+                run_ids = []
+            elif mtime != self.dir_mtimes.get(storage_dir):
+                run_ids = sorted(
+                        name for name in os.listdir(storage_dir)
+                        if self.pattern.match(name) and
+                            os.path.isdir(os.path.join(storage_dir, name))
+                        )
+            else:
+                run_ids = self.dir_runs.get(storage_dir, [])
+            updated = {}
+            for run_id in run_ids:
+                run_path = os.path.join(storage_dir, run_id)
+                try:
+                    run_mtime = os.path.getmtime(run_path)
+                    entry = self.runs.get(run_id)
+                    if entry is None or entry['path'] != run_path or \
+                            entry['last_modified'] != run_mtime:
+                        updated[run_id] = scan_run(run_path, run_mtime)
+                except OSError:
+                    continue # Removed while scanning
+            removed = set(self.dir_runs.get(storage_dir, [])) - set(run_ids)
+            with self.lock:
+                for run_id in removed:
+                    entry = self.runs.get(run_id)
+                    if entry and entry['path'] == os.path.join(storage_dir, run_id):
+                        del self.runs[run_id]
+                self.runs.update(updated)
+                self.dir_runs[storage_dir] = run_ids
+                self.dir_mtimes[storage_dir] = mtime
+            changed = changed or bool(updated or removed)
+        self.loaded = True
+        return changed
+
+    def update_loop(self):
+        while True:
+            try:
+                if self.refresh():
+                    self.save()
+            except Exception:
+                pass # Try again next time
+            time.sleep(REFRESH_INTERVAL)
+
+    def start(self):
+        """Load the saved index and start the background refresh thread."""
+        self.load()
+        thread = threading.Thread(target=self.update_loop)
+        thread.daemon = True
+        thread.start()
+
+    def query(self, instrument=None, date_from=None, date_to=None, offset=0, limit=None):
+        """Get (total, entries) for runs matching the filters, newest first.
+        The total is the number of matching runs, before pagination. If the
+        index has not been loaded or built yet, it is built first."""
+        if not self.loaded:
+            self.refresh()
+        with self.lock:
+            entries = list(self.runs.values())
+        if instrument:
+            entries = [e for e in entries if e['instrument'] == instrument]
+        if date_from:
+            entries = [e for e in entries if e['date'] and e['date'] >= date_from]
+        if date_to:
+            entries = [e for e in entries if e['date'] and e['date'] <= date_to]
+        entries.sort(key=lambda e: e['run_id'], reverse=True)
+        if limit is None:
+            return len(entries), entries[offset:]
+        return len(entries), entries[offset:offset+limit]
+
+    def instruments(self):
+        with self.lock:
+            return sorted(set(e['instrument'] for e in self.runs.values() if e['instrument']))
@@ -0,0 +1,205 @@
+# Streaming zip archive writer
+
+# zipfile.ZipFile needs a seekable output file (on Python 2 it seeks back to
+# update the local header of every member), so the whole archive would have
+# to be built in memory before the response is sent. This writer produces
+# the archive as a sequence of byte strings, which can be returned directly as
+# a WSGI response body. The CRC and sizes of each member are written in a data
+# descriptor after the member data, and ZIP64 records are used when sizes or
+# offsets exceed the limits of the original format.
+
+import os
+import time
+import zlib
+import struct
+import binascii
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Already compressed files are stored, everything else is deflated
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gz", ".bgzf", ".zip")
+
+CHUNK_SIZE = 1024 * 1024
+# Values which don't fit are replaced by these markers, and stored in ZIP64
+# records instead
+ZIP32_MAX = 0xFFFFFFFF
+ZIP32_COUNT_MAX = 0xFFFF
+ZIP64_LIMIT = ZIP32_MAX
+ZIP64_COUNT_LIMIT = ZIP32_COUNT_MAX
+# Deflate can make incompressible data slightly larger, use ZIP64 for the
+# member if the uncompressed size is close to the limit
+ZIP64_MARGIN = 1024 * 1024
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+VERSION_20 = 20
+VERSION_ZIP64 = 45
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+CENTRAL_HEADER = struct.Struct("<4sBBHHHHHLLLHHHHHLL")
+DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+DATA_DESCRIPTOR64 = struct.Struct("<4sLQQ")
+END_RECORD = struct.Struct("<4sHHHHLLH")
+END_RECORD64 = struct.Struct("<4sQHHLLQQQQ")
+END_LOCATOR64 = struct.Struct("<4sLQL")
+
+
+def compress_type_for(path):
+    if path.lower().endswith(STORED_EXTENSIONS):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+def dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return date, dostime
+
+
+class ZipEntry(object):
+    def __init__(self, arcname, compress_type, date, dostime, offset, zip64):
+        arcname = arcname.replace(os.sep, "/")
+        if not isinstance(arcname, bytes):
+            arcname = arcname.encode('utf-8')
+        self.arcname = arcname
+        self.compress_type = compress_type
+        self.date = date
+        self.dostime = dostime
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+
+class ZipStream(object):
+    """Generates a zip archive from files on disk.
+
+    Iterate over the object to get the archive data. The list of files is
+    given as (source_path, arcname) tuples. Source files which can't be
+    opened when their turn comes are left out of the archive.
+    """
+
+    def __init__(self, files, chunk_size=CHUNK_SIZE):
+        self.files = files
+        self.chunk_size = chunk_size
+        self.entries = []
+        self.offset = 0
+
+    def __iter__(self):
+        for source_path, arcname in self.files:
+            try:
+                f = open(source_path, 'rb')
+            except (IOError, OSError):
+                continue # Missing file!
+            with f:
+                for data in self._member(f, arcname):
+                    self.offset += len(data)
+                    yield data
+        yield self._central_directory()
+
+    def _member(self, f, arcname):
+        st = os.fstat(f.fileno())
+        date, dostime = dos_date_time(st.st_mtime)
+        entry = ZipEntry(
+                arcname,
+                compress_type_for(arcname),
+                date, dostime,
+                self.offset,
+                st.st_size >= ZIP64_LIMIT - ZIP64_MARGIN
+                )
+        if entry.zip64:
+            # Sizes are in the ZIP64 extra field, and filled in by the data
+            # descriptor
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            version = VERSION_ZIP64
+            size_placeholder = ZIP32_MAX
+        else:
+            extra = b""
+            version = VERSION_20
+            size_placeholder = 0
+        yield LOCAL_HEADER.pack(
+                b"PK\x03\x04", version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+                entry.compress_type, entry.dostime, entry.date,
+                0, size_placeholder, size_placeholder,
+                len(entry.arcname), len(extra)
+                ) + entry.arcname + extra
+
+        if entry.compress_type == ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+        crc = 0
+        while True:
+            data = f.read(self.chunk_size)
+            if not data:
+                break
+            crc = binascii.crc32(data, crc)
+            entry.file_size += len(data)
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                entry.compress_size += len(data)
+                yield data
+        if compressor:
+            data = compressor.flush()
+            entry.compress_size += len(data)
+            yield data
+        entry.crc = crc & 0xFFFFFFFF
+
+        if entry.zip64:
+            yield DATA_DESCRIPTOR64.pack(b"PK\x07\x08", entry.crc,
+                    entry.compress_size, entry.file_size)
+        else:
+            yield DATA_DESCRIPTOR.pack(b"PK\x07\x08", entry.crc,
+                    entry.compress_size, entry.file_size)
+        self.entries.append(entry)
+
+    def _central_directory(self):
+        records = []
+        for entry in self.entries:
+            zip64_fields = []
+            file_size, compress_size, offset = entry.file_size, entry.compress_size, entry.offset
+            if entry.zip64 or file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+                zip64_fields += [file_size, compress_size]
+                file_size = compress_size = ZIP32_MAX
+            if offset >= ZIP64_LIMIT:
+                zip64_fields.append(offset)
+                offset = ZIP32_MAX
+            if zip64_fields:
+                extra = struct.pack("<HH", 1, 8 * len(zip64_fields)) + \
+                        struct.pack("<" + "Q" * len(zip64_fields), *zip64_fields)
+                version = VERSION_ZIP64
+            else:
+                extra = b""
+                version = VERSION_20
+            records.append(CENTRAL_HEADER.pack(
+                    b"PK\x01\x02", version, 3, version,
+                    FLAG_DATA_DESCRIPTOR | FLAG_UTF8, entry.compress_type,
+                    entry.dostime, entry.date, entry.crc,
+                    compress_size, file_size,
+                    len(entry.arcname), len(extra), 0, 0, 0,
+                    0o100644 << 16, offset
+                    ) + entry.arcname + extra)
+
+        directory = b"".join(records)
+        count = len(self.entries)
+        cd_offset, cd_size = self.offset, len(directory)
+        if count >= ZIP64_COUNT_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            end64_offset = cd_offset + cd_size
+            directory += END_RECORD64.pack(
+                    b"PK\x06\x06", END_RECORD64.size - 12,
+                    VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                    count, count, cd_size, cd_offset
+                    )
+            directory += END_LOCATOR64.pack(b"PK\x06\x07", 0, end64_offset, 1)
+            count = min(count, ZIP32_COUNT_MAX)
+            cd_offset = min(cd_offset, ZIP32_MAX)
+            cd_size = min(cd_size, ZIP32_MAX)
+        directory += END_RECORD.pack(
+                b"PK\x05\x06", 0, 0, count, count, cd_size, cd_offset, 0
+                )
+        return directory
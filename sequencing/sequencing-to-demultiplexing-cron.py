@@ -2,9 +2,9 @@
 
 import sys
 import re
-import time
 from genologics.lims import *
 from genologics import config
+import lims_wait
 
 try:
     SITE = open("/etc/pipeline-site").read().strip()
@@ -29,14 +29,8 @@ WORKFLOW_NAME = "Demultiplexing and QC 2.0"
 def start_step(lims, analytes, workflow):
     protocol = workflow.protocols[0]
     ps = protocol.steps[0]
-    queue = ps.queue()
-    for attempt in xrange(3):
-        if set(analytes) <= set(queue.artifacts):
-            lims.create_step(ps, analytes)
-            break
-        else:
-            time.sleep(1)
-            queue.get(force=True)
+    lims_wait.wait_for_queue(lims, ps, analytes, timeout=30)
+    lims.create_step(ps, analytes)
 
 
 def main():
@@ -52,7 +46,10 @@ def main():
             if not demux:
                 analytes = proc.all_inputs(unique=True)
                 lims.route_analytes(analytes, workflow)
-                start_step(lims, analytes, workflow)
+                try:
+                    start_step(lims, analytes, workflow)
+                except lims_wait.WaitTimeout as e:
+                    print("Unable to start demultiplexing for {0}: {1}".format(proc.id, e))
 
 main()
 
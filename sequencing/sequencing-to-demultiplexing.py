@@ -2,21 +2,15 @@
 
 import sys
 import re
-import time
 from genologics.lims import *
 from genologics import config
+import lims_wait
 
 def start_step(lims, analytes, workflow):
     protocol = workflow.protocols[0]
     ps = protocol.steps[0]
-    queue = ps.queue()
-    for attempt in range(3):
-        if set(analytes) <= set(queue.artifacts):
-            lims.create_step(ps, analytes)
-            break
-        else:
-            time.sleep(1)
-            queue.get(force=True)
+    lims_wait.wait_for_queue(lims, ps, analytes, timeout=30)
+    lims.create_step(ps, analytes)
 
 
 def main(process_id, workflow_name):
@@ -27,7 +21,11 @@ def main(process_id, workflow_name):
     workflow = workflows[0]
     analytes = process.all_inputs(unique=True)
     lims.route_analytes(analytes, workflow)
-    start_step(lims, analytes, workflow)
+    try:
+        start_step(lims, analytes, workflow)
+    except lims_wait.WaitTimeout as e:
+        print("Unable to start demultiplexing step: {0}".format(e))
+        sys.exit(1)
 
 main(*sys.argv[1:])
 
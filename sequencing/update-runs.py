@@ -7,36 +7,57 @@ import glob
 import os
 import re
 import sys
+import time
 import yaml
+import fcntl
+import sqlite3
+import argparse
 import datetime
+import traceback
 from xml.etree.ElementTree import ElementTree
 import xml.parsers.expat
-# MatPlotLib, required for use of Pandas DataFrame
-os.environ['MPLCONFIGDIR'] = os.path.expanduser("~")
-import illuminate
 from genologics.lims import *
 from genologics import config
 
+import run_probe
+
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
-DB_FILE = "/var/db/rundb/runs.db"
+DB_FILE = "/var/db/rundb/runs.sqlite"
+# Tab-separated file used by previous versions, imported into a new database
+LEGACY_DB_FILE = "/var/db/rundb/runs.db"
 
-# RUN DATABASE FORMAT SPEC:
+# RUN DATABASE:
 
 # Run database is only used to track new / running / completed runs,
-# to limit the load on LIMS.
+# to limit the load on LIMS. It is an SQLite database in WAL mode, and each
+# run is saved in its own transaction when it has been updated, so an
+# interrupted update doesn't lose the state of the other runs.
 
-# Tab delimited columns:
-# RUN_ID    STATUS  LIMSID  CYCLE
+# Table run:
+# run_id, run_dir, state, process_id, cycle, total_cycles, lims_status, lims_checked
 
-# Column STATUS gives one of the values
+# Column state gives one of the values
 # NEW, LIMS, COMPLETED
 #-
 # NEW means that no information was found in LIMS. Will check again on next script execution.
-# LIMS means that the run is associated with a LIMS process. Will update the status in LIMS each time.
+# LIMS means that the run is associated with a LIMS process. The status in LIMS is updated when the
+#  cycle changes. lims_status is the last status written to LIMS.
 # COMPLETED means that the run has completed, LIMS status no longer relevant. Run is ignored, removed 
 #  from DB once removed from the filesystem.
 
+# Table storage:
+# path, mtime
+# A storage directory is only listed again when its modification time has changed.
+
+NEW = "NEW"
+LIMS = "LIMS"
+COMPLETED = "COMPLETED"
+
+# Maximum time between checks of the Finish Date of runs in LIMS state, for
+# runs which don't otherwise need an update (seconds)
+FINISH_CHECK_INTERVAL = 3600
+
 INSTRUMENT_NAME_MAP = {seq['id']: seq['name']
             for seq in yaml.safe_load(open(os.path.join(os.path.dirname(__file__), "sequencers.yaml")))
             }
@@ -53,11 +74,78 @@ RUN_STORAGES=[
     ]
 
 # This RUN ID match string does intentionally not match NovaSeq, which is 111111_A0....
-# We don't need this script for NovaSeq, and then we can sidestep the issue that
-# the illuminate library doesn't work well with NovaSeq InterOp files.
+# We don't need this script for NovaSeq.
 RUN_ID_MATCH = r"\d\d\d\d\d\d_[B-Z0-9\-_]+"
 
 
+class RunState(object):
+    def __init__(self, run_id, run_dir=None, state=NEW, process_id=None, cycle=-1,
+            total_cycles=None, lims_status=None, lims_checked=0):
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.state = state
+        self.process_id = process_id
+        self.cycle = cycle
+        self.total_cycles = total_cycles
+        self.lims_status = lims_status
+        self.lims_checked = lims_checked
+
+    def row(self):
+        return (self.run_id, self.run_dir, self.state, self.process_id, self.cycle,
+                self.total_cycles, self.lims_status, self.lims_checked)
+
+
+class RunDatabase(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS run (
+                        run_id TEXT PRIMARY KEY,
+                        run_dir TEXT,
+                        state TEXT,
+                        process_id TEXT,
+                        cycle INTEGER,
+                        total_cycles INTEGER,
+                        lims_status TEXT,
+                        lims_checked REAL
+                        )""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS storage (
+                        path TEXT PRIMARY KEY,
+                        mtime REAL
+                        )""")
+        if not self.load() and os.path.exists(LEGACY_DB_FILE):
+            self.import_legacy(LEGACY_DB_FILE)
+
+    def import_legacy(self, path):
+        with open(path) as legacy_file:
+            for l in legacy_file.readlines():
+                r = l.rstrip("\n").split("\t")
+                if r[1].strip() == LIMS:
+                    self.save(RunState(r[0], state=LIMS, process_id=r[2], cycle=int(r[3])))
+                elif r[1].strip() in (NEW, COMPLETED):
+                    self.save(RunState(r[0], state=r[1].strip()))
+
+    def load(self):
+        """Get {run_id => RunState}."""
+        return dict((row[0], RunState(*row)) for row in self.db.execute("SELECT * FROM run"))
+
+    def save(self, run):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO run VALUES (?, ?, ?, ?, ?, ?, ?, ?)", run.row())
+
+    def delete(self, run_id):
+        with self.db:
+            self.db.execute("DELETE FROM run WHERE run_id=?", (run_id,))
+
+    def storage_mtime(self, path):
+        row = self.db.execute("SELECT mtime FROM storage WHERE path=?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def set_storage_mtime(self, path, mtime):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO storage VALUES (?, ?)", (path, mtime))
+
 def get_mi_nextseq_container(run_dir):
     tree = ElementTree()
     recipes = glob.glob(os.path.join(run_dir, "Recipe", "[NM]S*-*.xml"))
@@ -87,36 +175,27 @@ def get_lims_container_name(run_dir):
         return get_hiseq_container(run_dir)
 
 
-def get_cycle(dataset, run_dir, lower_bound_cycle):
-    """Get total cycles and current cycle based on files written in the run folder. 
-
-    Will look at lane 1 only, to reduce I/O and complexity.
-    """
-    total_cycles = sum(r['cycles'] for r in dataset.Metadata().read_config)
-    
-    lower_bound_cycle = max(0, lower_bound_cycle)
-    for cycle in range(lower_bound_cycle, total_cycles):
-        test_paths = [
-                os.path.join(
-                    run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                    "C{0}.1".format(cycle+1)
-                ),
-                os.path.join(
-                    run_dir, "Data", "Intensities", "BaseCalls", "L001",
-                    "{0:04d}.bcl.bgzf".format(cycle+1)
-                )
+def read_run_info(run_dir):
+    """Get the run ID and the read configuration from RunInfo.xml. The reads
+    are given as dicts with keys read_num, cycles and is_index."""
+    tree = ElementTree()
+    tree.parse(os.path.join(run_dir, "RunInfo.xml"))
+    reads = [
+            {
+                'read_num': int(read.attrib['Number']),
+                'cycles': int(read.attrib['NumCycles']),
+                'is_index': read.attrib.get('IsIndexedRead') == "Y"
+            }
+            for read in tree.findall("Run/Reads/Read")
             ]
-        if not any(os.path.exists(test_path) for test_path in test_paths):
-            return cycle, total_cycles
-
-    return total_cycles, total_cycles
+    return tree.find("Run").attrib['Id'], reads
 
 
-def set_run_metadata(ds, run_dir, process):
-    process.udf['Run ID'] = ds.meta.runID
+def set_run_metadata(run_info_id, reads, process):
+    process.udf['Run ID'] = run_info_id
     i_data_read = 1
     i_index_read = 1
-    for read in sorted(ds.meta.read_config, key=lambda r: r['read_num']):
+    for read in sorted(reads, key=lambda r: r['read_num']):
         if read['is_index']:
             process.udf['Index %d Read Cycles' % (i_index_read)] = read['cycles']
             i_index_read += 1
@@ -125,120 +204,191 @@ def set_run_metadata(ds, run_dir, process):
             i_data_read += 1
 
 
-def main():
-    try:
-        with open(DB_FILE) as run_db_file:
-            run_db = [l.split("\t") for l in run_db_file.readlines()]
-    except IOError:
-        run_db = []
-
-    new_runs = set(r[0] for r in run_db if r[1].strip() == "NEW")
-    completed_runs = set(r[0] for r in run_db if r[1].strip() == "COMPLETED")
-    lims_runs_id_cycle = dict((r[0], [r[2], int(r[3])]) for r in run_db if r[1].strip() == "LIMS")
-
-    # Checks if any runs are missing
-    missing_runs = set(completed_runs) | set(lims_runs_id_cycle.keys()) | set(new_runs)
+def list_run_dirs(db, runs):
+    """Get {run_id => run_dir} for the run folders in the storage directories,
+    and a list of (storage, mtime) to save when the runs have been processed.
+    A storage directory is only listed if it has been modified since the last
+    time; otherwise the run folders known in the database are used. If a
+    storage directory is not available, its runs are kept as they are."""
+    run_dirs = {}
+    storage_mtimes = []
+    for storage in RUN_STORAGES:
+        try:
+            mtime = os.path.getmtime(storage)
+        except OSError:
+            mtime = None
+        if mtime is None or mtime == db.storage_mtime(storage):
+            run_dirs.update((run.run_id, run.run_dir) for run in runs.values()
+                    if run.run_dir and os.path.dirname(run.run_dir) == storage)
+        else:
+            for r in glob.glob(os.path.join(storage, "*_*_*")):
+                run_id = os.path.basename(r)
+                if re.match(RUN_ID_MATCH, run_id):
+                    run_dirs[run_id] = r
+            storage_mtimes.append((storage, mtime))
+    # Runs imported from the old database file have no run_dir until they are
+    # found by a listing. Keep them until all storages have been listed.
+    if len(storage_mtimes) < len(RUN_STORAGES):
+        for run in runs.values():
+            if not run.run_dir and run.run_id not in run_dirs:
+                run_dirs[run.run_id] = None
+    return run_dirs, storage_mtimes
+
+
+def find_lims_process(run_dir):
+    """Try to find the LIMS process for a new run, by looking up the flow cell
+    or reagent cartridge in LIMS."""
+    container_name = get_lims_container_name(run_dir)
+    lims_containers = lims.get_containers(name=container_name)
+    if lims_containers:
+        analyte = list(lims_containers[-1].placements.values())[0]
+        processes = lims.get_processes(inputartifactlimsid=[analyte.id], type=PROCESS_TYPES)
+        if processes:
+            process = processes[-1]
+            if set(process.all_inputs()) == set(lims_containers[-1].placements.values()):
+                handle_now = True
+                if "Illumina" in process.type_name: # HiSeq
+                    handle_now = process.udf.get("Status")
+                if handle_now:
+                    return process
+    return None
+
+
+def update_new_run(run):
+    process = find_lims_process(run.run_dir)
+    if process:
+        set_initial_fields(process, run.run_dir, run.run_id)
+        run.state = LIMS
+        run.process_id = process.id
+        run.cycle = -1 # Trigger update 
+    elif os.path.exists(os.path.join(run.run_dir, "RTAComplete.txt")):
+        run.state = COMPLETED
+
+
+def update_lims_run(run):
+    """Update the status of a run in LIMS, if it has changed. The process is
+    only read from LIMS when there is something to update, or to check if
+    the run is finished: each time after the run has completed on disk, and
+    at least every FINISH_CHECK_INTERVAL. The fields of run are only changed
+    once the process has been updated, so if a request fails, the update is
+    retried on the next pass."""
+    r = run.run_dir
+    first_update = run.cycle == -1
+    current_cycle = run.cycle
+    status = None # New status for LIMS, or None if it should not be updated
+    reads = None
+    miseq_or_nextseq = re.match(r"\d\d\d\d\d\d_(N|M)[A-Z0-9\-_]+", run.run_id)
+    if miseq_or_nextseq:
+        if "_N" in run.run_id and not os.path.isdir(os.path.join(r, "InterOp")):
+            status = "Cluster generation"
+        else:
+            if first_update or run.total_cycles is None:
+                run_info_id, reads = read_run_info(r)
+                run.total_cycles = sum(read['cycles'] for read in reads)
+            current_cycle = run_probe.get_cycle(r, run.total_cycles, run.cycle)
+            if current_cycle != run.total_cycles:
+                # Update all except last cycle for NextSeq (avoid race with clarity 
+                # integrations for last cycle)
+                status = "Cycle %d of %d" % (current_cycle, run.total_cycles)
+
+    needs_update = status is not None and status != run.lims_status
+    check_finished = not miseq_or_nextseq or \
+            os.path.exists(os.path.join(r, "RTAComplete.txt")) or \
+            time.time() - run.lims_checked > FINISH_CHECK_INTERVAL
+    if not (needs_update or check_finished):
+        run.cycle = current_cycle
+        return
+
+    process = Process(lims, id=run.process_id)
+    process.get(force=True)
+    run.lims_checked = time.time()
+
+    # Completed run
+    if process.udf.get('Finish Date'):
+        set_final_fields(process, r, run.run_id)
+        run.state = COMPLETED
+        return
+
+    if not needs_update:
+        run.cycle = current_cycle
+        return
+    if status == "Cluster generation":
+        if not process.udf.get('Status'):
+            process.udf['Status'] = status
+            process.udf['Run ID'] = run.run_id
+            process.put()
+        run.lims_status = status
+    else:
+        if first_update:
+            set_run_metadata(run_info_id, reads, process)
+        if 'Run ID' in process.udf: # Glitches happen. If no UDFs, don't push new changes
+            process.udf['Status'] = status
+            process.put()
+            run.lims_status = status
+    run.cycle = current_cycle
+
+
+def update_runs(db):
+    runs = db.load()
+    run_dirs, storage_mtimes = list_run_dirs(db, runs)
+
+    for run_id in set(runs) - set(run_dirs):
+        db.delete(run_id)
+
+    complete_listing = True
+    for run_id, r in sorted(run_dirs.items()):
+        run = runs.get(run_id)
+        if run is None:
+            if os.path.isdir(r) and\
+                            (os.path.isdir(os.path.join(r, "InterOp")) or 
+                            os.path.isdir(os.path.join(r, "Recipe"))):
+                run = RunState(run_id, r)
+            else:
+                # Not ready yet, list the storage again next time
+                complete_listing = False
+                continue
+        if r is None or run.state == COMPLETED:
+            if r and r != run.run_dir:
+                run.run_dir = r
+                db.save(run)
+            continue
+        run.run_dir = r
+        try:
+            if run.state == NEW:
+                update_new_run(run)
+            if run.state == LIMS:
+                update_lims_run(run)
+        except Exception:
+            # The run keeps the state of the last successful update
+            print "Error while updating run", run_id
+            traceback.print_exc()
+        db.save(run)
 
-    run_dirs = [r
-            for directory in RUN_STORAGES
-            for r in glob.glob(os.path.join(directory, "*_*_*"))
-            ] 
+    if complete_listing:
+        for storage, mtime in storage_mtimes:
+            db.set_storage_mtime(storage, mtime)
 
-    for r in run_dirs:
-        run_id = os.path.basename(r)
 
-        if not re.match(RUN_ID_MATCH, run_id):
-            continue
+def main():
+    parser = argparse.ArgumentParser(description="Update the status of MiSeq and NextSeq runs in LIMS.")
+    parser.add_argument('--loop', type=int, metavar='SECONDS',
+            help="Keep running, updating the runs at this interval (default: update once)")
+    args = parser.parse_args()
 
-        missing_runs.discard(run_id)
+    # Only one instance may update the runs at a time
+    lock_file = open(DB_FILE + ".lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print "Another instance is already running."
+        sys.exit(0)
 
-        if not (run_id in new_runs or lims_runs_id_cycle.has_key(run_id) or run_id in completed_runs):
-            if os.path.isdir(r) and\
-                            (os.path.isdir(os.path.join(r, "InterOp")) or 
-                            os.path.isdir(os.path.join(r, "Recipe"))):
-                new_runs.add(run_id)
-
-        if run_id in new_runs:
-            # Try to convert it into LIMS state by looking up the flow cell in LIMS
-            container_name = get_lims_container_name(r)
-            lims_containers = lims.get_containers(name=container_name)
-            if lims_containers:
-                analyte = lims_containers[-1].placements.values()[0]
-                processes = lims.get_processes(inputartifactlimsid=[analyte.id], type=PROCESS_TYPES)
-                if processes:
-                    process = processes[-1]
-                    if set(process.all_inputs()) == set(lims_containers[-1].placements.values()):
-                        handle_now = True
-                        if "Illumina" in process.type_name: # HiSeq
-                            handle_now = process.udf.get("Status")
-                        if handle_now:
-                            new_runs.remove(run_id)
-                            set_initial_fields(process, r, run_id)
-                            lims_runs_id_cycle[run_id] = [process.id, -1] # Trigger update 
-
-        if run_id not in completed_runs:
-            if os.path.exists(os.path.join(r, "RTAComplete.txt")):
-                try:
-                    # Remove if in new runs. If already found in LIMS, 
-                    # will update one last time with cycle
-                    new_runs.remove(run_id)
-                    completed_runs.add(run_id)
-                except KeyError:
-                    pass
-
-    # Update LIMS state runs
-    # Batch request for process objects not supported
-    ## lims.get_batch([Process(lims, id=id) for (id, cycles) in lims_runs_id_cycle.values()])
-    for r in run_dirs:
-        run_id = os.path.basename(r)
-        if lims_runs_id_cycle.has_key(run_id):
-            process_id, old_cycle = lims_runs_id_cycle[run_id]
-            process = Process(lims, id=process_id)
-
-            # Completed run
-            if process.udf.get('Finish Date'):
-                completed_runs.add(run_id)
-                del lims_runs_id_cycle[run_id]
-                set_final_fields(process, r, run_id)
-            else:
-                miseq_or_nextseq = re.match(r"\d\d\d\d\d\d_(N|M)[A-Z0-9\-_]+", run_id)
-                if miseq_or_nextseq:
-                    if "_N" in run_id and not os.path.isdir(os.path.join(r, "InterOp")):
-                        if not process.udf.get('Finish Date') and not process.udf.get('Status'):
-                            process.udf['Status'] = "Cluster generation"
-                            process.udf['Run ID'] = run_id
-                            process.put()
-                    else:
-                        ds = illuminate.InteropDataset(r)
-                        current_cycle, total_cycles = get_cycle(ds, r, old_cycle)
-                        lims_runs_id_cycle[run_id][1] = current_cycle
-                        if current_cycle is not None:
-                            if current_cycle != total_cycles:
-                                # Update all except last cycle for NextSeq (avoid race with clarity 
-                                # integrations for last cycle)
-                                if old_cycle == -1:
-                                    process.get()
-                                    set_run_metadata(ds, r, process)
-                                    process.put()
-                                else:
-                                    process.get(force=True)
-                                if 'Run ID'  in process.udf: # Glitches happen. If no UDFs, don't push new changes
-                                    process.udf['Status'] = "Cycle %d of %d" % (current_cycle, total_cycles)
-                                    if not process.udf.get('Finish Date'): # Another work-around for race condition
-                                        process.put()
-
-    completed_runs -= missing_runs
-    new_runs -= missing_runs
-    for r in missing_runs:
-        lims_runs_id_cycle.pop(r, None)
-
-    with open(DB_FILE, "w") as f:
-        for r in new_runs:
-            f.write("{0}\tNEW\n".format(r))
-        for (r, (limsid, c)) in lims_runs_id_cycle.items():
-            f.write("{0}\tLIMS\t{1}\t{2}\n".format(r, limsid, c))
-        for r in completed_runs:
-            f.write("{0}\tCOMPLETED\n".format(r))
+    db = RunDatabase(DB_FILE)
+    while True:
+        update_runs(db)
+        if not args.loop:
+            break
+        time.sleep(args.loop)
 
 def set_initial_fields(process, run_dir, run_id):
     process.udf['Operator'] = process.technician.username
@@ -1,12 +1,14 @@
 # Library for setting indexes
 
-# NOTE: This file is also used from ../proj-imp/, via a symlink
+# NOTE: This file is also used from ../proj-imp/, via a symlink. It requires
+# reagent_type_cache.py in the same directory.
 
 import re
 
 from genologics.lims import *
 from genologics import config
 from collections import defaultdict
+import reagent_type_cache
 
 lims = Lims(config.BASEURI, config.USERNAME, config.PASSWORD)
 
@@ -15,74 +17,47 @@ class ReagentError(Exception):
 
 
 def get_all_reagent_types():
-    """Load all reagent types with name only, from the API resource.
-    (this is a lot faster than getting the full representations one by
-    one).
+    """Get the index of all reagent types, from the persistent reagent type
+    cache. Only reagent types which are not already in the cache are fetched
+    from the API.
     
-    Breaks the name into space-separated tokens, also removing brackets
-    () at the beginning and end of the tokens. Then returns a dict indexed
-    by the token, where the values are sets of reagent types matching that
-    token. {token => (reagent1, reagent2, ...)}
+    The name of each reagent type is broken into space-separated tokens,
+    also removing brackets () at the beginning and end of the tokens. The
+    returned object is indexed by the token, and gives sets of reagent type
+    URIs matching that token: reagents[token] => {uri1, uri2, ...}. The
+    matches grouped by category, with name and sequence, are given by
+    reagents.categories_for_token(token) => {category => [info, ...]}.
+    Details are available with reagents.info(uri). None of these make any
+    API requests.
     
     Example: The name "AD005 (ACAGTG)" becomes two tokens: AD005 
     and ACAGTG.
     """ 
-    # Using a loop similar to Lims._get_instances()
-    reagent_types = defaultdict(set)
-    root = lims.get(lims.get_uri("reagenttypes"))
-    while root:
-        for node in root.findall("reagent-type"):
-
-            # add a reagent type to the search index, indexed by all words
-            name = node.attrib['name']
-            uri = node.attrib['uri']
-            for token in (
-                    tk.strip("()")
-                    for tk in name.split(" ")
-                    if tk != ""
-                    ):
-                reagent_types[token].add(uri)
-                
-        node = root.find('next-page')
-        root = None
-        if not node is None:
-            root = lims.get(node.attrib['uri'])
-
-    return reagent_types
+    return reagent_type_cache.get_cache(lims)
 
 
 def get_reagents_auto_category(reagents, index_analyte, sequence_match=False, allow_multi_match=False):
-    category_indexes = {}
-    candidate_categories = set()
-    ana_no_match = [] # list of analytes with no indexes at all
-    not_in_category = []
+    """Find the category which has a reagent type for all the analytes.
 
-    # Add all possible categories -- use categories for the first  analyte
-    ana_match_string = index_analyte[0][0]
-    for reagent_uri in reagents[ana_match_string]:
-        reagent = ReagentType(lims, uri=reagent_uri) 
-        candidate_categories.add(reagent.category)
-        category_indexes[reagent.category] = []
+    The analytes are processed in a single pass, keeping the set of
+    categories which matched all analytes so far. The candidates are
+    initially the categories matching the first analyte."""
+    category_indexes = defaultdict(list)
+    ana_no_match = [] # list of analytes with no indexes at all
 
-    # 2. Process all analytes including the first one
+    candidate_categories = set(reagents.categories_for_token(index_analyte[0][0]))
     for index, analyte_name in index_analyte:
-        new_candidates = set()
-        ana_match_string = index
-        analyte_reagents = reagents[ana_match_string]
-        if not analyte_reagents:
+        if not reagents[index]:
             ana_no_match.append(analyte_name)
-        for reagent_uri in reagents[ana_match_string]:
-            reagent = ReagentType(lims, uri=reagent_uri)
-            if not sequence_match or reagent.sequence == ana_match_string:
-                if reagent.category in candidate_categories:
-                    if reagent.category in new_candidates:
-                        raise ReagentError("Ambiguous match for sample" + analyte_name + ": in category" + reagent.category +\
-                                "the specified index matches multiple reagent types:" + reagent.name + "and" +\
-                                category_indexes[reagent.category][-1])
-                    else:
-                        new_candidates.add(reagent.category)
-                        category_indexes[reagent.category].append(reagent.name)
-        candidate_categories = new_candidates
+        by_category = reagents.categories_for_token(index, sequence_match)
+        candidate_categories &= set(by_category)
+        for category in candidate_categories:
+            matches = by_category[category]
+            if len(matches) > 1:
+                raise ReagentError("Ambiguous match for sample " + analyte_name + ": in category " + category +\
+                        " the specified index matches multiple reagent types: " + matches[1].name + " and " +\
+                        matches[0].name)
+            category_indexes[category].append(matches[0].name)
 
     if ana_no_match:
         raise ReagentError("Samples with no match at all: " + ", ".join(ana_no_match))
@@ -99,30 +74,19 @@ def get_reagents_for_category(reagents, index_analyte, category, sequence_match=
     match_reagents = []
     ana_no_match = [] # list of analytes with no indexes at all
 
-    # 2. Process all analytes including the first one
     for index, analyte_name in index_analyte:
-        ana_match_string = index
-        analyte_reagents = reagents[ana_match_string]
-        match = False
-        for reagent_uri in reagents[ana_match_string]:
-            reagent = ReagentType(lims, uri=reagent_uri)
-            if not sequence_match or reagent.sequence == ana_match_string:
-                if reagent.category == category:
-                    if match:
-                        raise ReagentError("Ambiguous match for sample" +  analyte_name + ": specified index "\
-                                "matches multiple reagent types: " + reagent.name +  " and " +\
-                                match_reagents[-1])
-                    else:
-                        match_reagents.append(reagent.name)
-                        match = True
-        if not match:
+        matches = reagents.categories_for_token(index, sequence_match).get(category, [])
+        if len(matches) > 1:
+            raise ReagentError("Ambiguous match for sample " +  analyte_name + ": specified index "\
+                    "matches multiple reagent types: " + matches[1].name +  " and " +\
+                    matches[0].name)
+        elif matches:
+            match_reagents.append(matches[0].name)
+        else:
             ana_no_match.append(analyte_name)
 
-
     if ana_no_match:
         raise ReagentError("No matching reagent type found for samples: " + ", ".join(ana_no_match))
     else:
         return match_reagents
 
-
-
@@ -0,0 +1,225 @@
+# Persistent cache of reagent types (indexes)
+
+# NOTE: This file is also used from ../proj-imp/ and ../sample-sheet-generator/,
+# via symlinks
+
+# The reagent type list resource only contains the name and URI of each
+# reagent type, and the category and sequence require one GET per reagent
+# type. This module keeps name, category and sequence of all reagent types in
+# a JSON file, and only fetches the details of reagent types that are not
+# already in the file. The list itself is re-read when the file is older than
+# MAX_AGE, or when a lookup doesn't find the requested token or name.
+
+import os
+import re
+import json
+import time
+import errno
+import tempfile
+import threading
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+# Seconds before the list of reagent types is re-read from the API
+MAX_AGE = 3600
+# Minimum time between refreshes caused by lookup misses, to avoid listing
+# all reagent types repeatedly when a token really doesn't exist
+MIN_MISS_REFRESH_INTERVAL = 60
+# Concurrent GET requests when fetching details of new reagent types
+FETCH_THREADS = 8
+
+CACHE_DIR = os.environ.get("REAGENT_TYPE_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "nsc-lims"))
+
+
+ReagentTypeInfo = namedtuple('ReagentTypeInfo', ['uri', 'name', 'category', 'sequence'])
+
+
+def tokenize(name):
+    """Breaks the name into space-separated tokens, also removing brackets
+    () at the beginning and end of the tokens.
+
+    Example: The name "AD005 (ACAGTG)" becomes two tokens: AD005
+    and ACAGTG.
+    """
+    return [tk.strip("()") for tk in name.split(" ") if tk != ""]
+
+
+class ReagentTypeCache(object):
+    """In-memory and on-disk index of reagent types.
+
+    entries: {uri => {'name': ..., 'category': ..., 'sequence': ...}}
+    """
+
+    def __init__(self, lims, path=None):
+        self.lims = lims
+        if path is None:
+            server = re.sub(r"[^A-Za-z0-9.-]", "_", lims.baseuri.split("//")[-1].strip("/"))
+            path = os.path.join(CACHE_DIR, "reagenttypes-{0}.json".format(server))
+        self.path = path
+        self.entries = {}
+        self.listed_time = 0
+        self.lock = threading.RLock()
+        self._build_lookups()
+
+    def _build_lookups(self):
+        self.by_token = defaultdict(set)
+        self.by_token_category = defaultdict(lambda: defaultdict(list))
+        self.by_name = {}
+        for uri, entry in self.entries.items():
+            self.by_name[entry['name']] = uri
+            info = ReagentTypeInfo(uri=uri, **entry)
+            for token in tokenize(entry['name']):
+                self.by_token[token].add(uri)
+                self.by_token_category[token][entry['category']].append(info)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        with self.lock:
+            self.entries = data['entries']
+            self.listed_time = data['listed_time']
+            self._build_lookups()
+        return True
+
+    def save(self):
+        """Atomically replace the cache file. Failure to write is not fatal, the
+        cache is then only used in memory."""
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'listed_time': self.listed_time, 'entries': self.entries}, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def _list_uris(self):
+        """Get {uri => name} for all reagent types, using the paged list resource.
+        (Using a loop similar to Lims._get_instances())"""
+        uris = {}
+        root = self.lims.get(self.lims.get_uri("reagenttypes"))
+        while root is not None:
+            for node in root.findall("reagent-type"):
+                uris[node.attrib['uri']] = node.attrib['name']
+            node = root.find('next-page')
+            root = None
+            if not node is None:
+                root = self.lims.get(node.attrib['uri'])
+        return uris
+
+    def _fetch_entry(self, uri):
+        root = self.lims.get(uri)
+        sequence = None
+        for special_type in root.findall('special-type'):
+            if special_type.attrib.get('name') == "Index":
+                for attribute in special_type.findall('attribute'):
+                    if attribute.attrib.get('name') == "Sequence":
+                        sequence = attribute.attrib.get('value')
+        return uri, {
+                'name': root.attrib['name'],
+                'category': root.findtext('reagent-category'),
+                'sequence': sequence
+                }
+
+    def refresh(self, full=False):
+        """Re-read the list of reagent types, and fetch the details of any new
+        (or renamed) reagent types. Reagent types that no longer exist are
+        removed. If full is True, the details of all reagent types are
+        re-fetched."""
+        with self.lock:
+            listed = self._list_uris()
+            entries = dict(
+                    (uri, entry) for uri, entry in self.entries.items()
+                    if not full and listed.get(uri) == entry['name']
+                    )
+            new_uris = [uri for uri in listed if uri not in entries]
+            if new_uris:
+                pool = ThreadPool(min(FETCH_THREADS, len(new_uris)))
+                try:
+                    entries.update(pool.map(self._fetch_entry, new_uris))
+                finally:
+                    pool.close()
+            self.entries = entries
+            self.listed_time = time.time()
+            self._build_lookups()
+            self.save()
+
+    def ensure_fresh(self, max_age=MAX_AGE):
+        with self.lock:
+            if not self.entries:
+                self.load()
+            if time.time() - self.listed_time > max_age:
+                self.refresh()
+
+    def _refresh_on_miss(self):
+        """Refresh after a failed lookup, unless that was done very recently.
+        Returns True if the cache was refreshed."""
+        with self.lock:
+            if time.time() - self.listed_time < MIN_MISS_REFRESH_INTERVAL:
+                return False
+            self.refresh()
+            return True
+
+    def uris_for_token(self, token):
+        """Set of reagent type URIs which have the token in their name."""
+        if token not in self.by_token:
+            self._refresh_on_miss()
+        return self.by_token.get(token, set())
+
+    # Lookup by token, compatible with the dict previously returned by
+    # indexes.get_all_reagent_types()
+    __getitem__ = uris_for_token
+
+    def categories_for_token(self, token, sequence_match=False):
+        """Get {category => [ReagentTypeInfo, ...]} for the reagent types which
+        have the token in their name. If sequence_match is True, only reagent
+        types with the token as their sequence are included."""
+        if token not in self.by_token:
+            self._refresh_on_miss()
+        by_category = self.by_token_category.get(token, {})
+        if not sequence_match:
+            return by_category
+        result = {}
+        for category, infos in by_category.items():
+            infos = [info for info in infos if info.sequence == token]
+            if infos:
+                result[category] = infos
+        return result
+
+    def uri_for_name(self, name):
+        if name not in self.by_name:
+            self._refresh_on_miss()
+        return self.by_name[name]
+
+    def info(self, uri):
+        """Get the ReagentTypeInfo for a URI."""
+        return ReagentTypeInfo(uri=uri, **self.entries[uri])
+
+
+_caches = {}
+def get_cache(lims, max_age=MAX_AGE):
+    """Get the shared cache object for a LIMS server, refreshing the list of
+    reagent types if it is older than max_age."""
+    cache = _caches.get(lims.baseuri)
+    if cache is None:
+        cache = _caches[lims.baseuri] = ReagentTypeCache(lims)
+    cache.ensure_fresh(max_age)
+    return cache
+
+
+if __name__ == "__main__":
+    # Rebuild the cache for the default LIMS server, e.g. after editing
+    # sequences of existing reagent types
+    from genologics.lims import Lims
+    from genologics import config
+    cache = ReagentTypeCache(Lims(config.BASEURI, config.USERNAME, config.PASSWORD))
+    cache.refresh(full=True)
+    print("Cached {0} reagent types in {1}.".format(len(cache.entries), cache.path))
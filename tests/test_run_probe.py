@@ -0,0 +1,105 @@
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+sys.path.append("..")
+
+import run_probe
+
+
+class RunProbeTestCase(unittest.TestCase):
+
+    TOTAL_CYCLES = 151
+
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self.lane_dir = run_probe.basecalls_dir(self.run_dir)
+        os.makedirs(self.lane_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def age_dir(self, path, seconds=10):
+        # Move the mtime back, as if the directory was last changed a while ago
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime - seconds))
+
+    def write_cycles(self, layout, first, last, cbcl_files=True):
+        for cycle in range(first, last + 1):
+            if layout == "bgzf":
+                open(os.path.join(self.lane_dir, "{0:04d}.bcl.bgzf".format(cycle)), 'w').close()
+            else:
+                cycle_dir = os.path.join(self.lane_dir, "C{0}.1".format(cycle))
+                os.mkdir(cycle_dir)
+                if layout == "cbcl" and cbcl_files:
+                    open(os.path.join(cycle_dir, "L001_1.cbcl"), 'w').close()
+                    open(os.path.join(cycle_dir, "L001_2.cbcl"), 'w').close()
+
+    def check_layout(self, layout):
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 0)
+        self.write_cycles(layout, 1, 37)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 37)
+        # Lower bound below and at the real cycle
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 10), 37)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 37), 37)
+        # Lower bound above the real cycle is trusted
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 50), 50)
+        # Lower bound above the total number of cycles
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 200), self.TOTAL_CYCLES)
+        # The cached listing is replaced when the directory changes
+        self.write_cycles(layout, 38, 120)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 37), 120)
+        self.write_cycles(layout, 121, self.TOTAL_CYCLES)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), self.TOTAL_CYCLES)
+
+    def test_cycle_directories(self):
+        self.check_layout("dir")
+
+    def test_bgzf(self):
+        self.check_layout("bgzf")
+
+    def test_cbcl(self):
+        self.check_layout("cbcl")
+
+    def test_cbcl_cycle_in_progress(self):
+        self.write_cycles("cbcl", 1, 25)
+        # The directory of the next cycle is created before the data is written
+        self.write_cycles("cbcl", 26, 26, cbcl_files=False)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 25)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 3), 25)
+        cycle_dir = os.path.join(self.lane_dir, "C26.1")
+        open(os.path.join(cycle_dir, "L001_1.cbcl"), 'w').close()
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 26)
+
+    def test_missing_run_folder(self):
+        self.assertEqual(run_probe.get_cycle(os.path.join(self.run_dir, "missing"), self.TOTAL_CYCLES), 0)
+
+    def test_listing_cache(self):
+        self.write_cycles("dir", 1, 5)
+        self.age_dir(self.lane_dir)
+        names = run_probe.list_dir(self.lane_dir)
+        self.assertEqual(len(names), 5)
+        # Same listing object is returned while the mtime is unchanged
+        self.assertIs(run_probe.list_dir(self.lane_dir), names)
+        self.write_cycles("dir", 6, 6)
+        self.assertEqual(len(run_probe.list_dir(self.lane_dir)), 6)
+
+    def test_new_cycle_without_mtime_change(self):
+        self.write_cycles("dir", 1, 5)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 5)
+        # A cycle created within the same mtime tick as the listing
+        st = os.stat(self.lane_dir)
+        self.write_cycles("dir", 6, 6)
+        os.utime(self.lane_dir, (st.st_atime, st.st_mtime))
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 6)
+
+    def test_cycles_written_between_polls(self):
+        self.write_cycles("bgzf", 1, 5)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES), 5)
+        self.write_cycles("bgzf", 6, 7)
+        self.assertEqual(run_probe.get_cycle(self.run_dir, self.TOTAL_CYCLES, 5), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
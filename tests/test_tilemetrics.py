@@ -0,0 +1,88 @@
+import unittest
+import os
+import sys
+import struct
+import shutil
+import tempfile
+sys.path.append("../base-counter")
+
+from tilemetrics import TileMetricsReader
+
+
+def v2_record(lane, tile, code, value):
+    return struct.pack("<HHHf", lane, tile, code, value)
+
+
+def v3_record(lane, tile, code, value1, value2=0.0):
+    return struct.pack("<HIBff", lane, tile, ord(code), value1, value2)
+
+
+class TileMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "TileMetricsOut.bin")
+        self.reader = TileMetricsReader(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def test_missing_file(self):
+        self.assertIsNone(self.reader.update())
+
+    def test_v2(self):
+        self.append(struct.pack("<BB", 2, 10))
+        self.assertIsNone(self.reader.update())
+        self.append(
+                v2_record(1, 1101, 100, 5000.0) +  # Cluster density, ignored
+                v2_record(1, 1101, 103, 1000.0) +
+                v2_record(1, 1102, 103, 2000.0)
+                )
+        self.assertEqual(self.reader.update(), 3000.0)
+
+        # Partial record is only used when it is complete
+        record = v2_record(2, 1101, 103, 500.0)
+        self.append(record[:4])
+        self.assertEqual(self.reader.update(), 3000.0)
+        self.append(record[4:])
+        self.assertEqual(self.reader.update(), 3500.0)
+
+        # New value for a tile replaces the old
+        self.append(v2_record(1, 1101, 103, 1500.0))
+        self.assertEqual(self.reader.update(), 4000.0)
+        self.assertEqual(self.reader.offset, 2 + 5 * 10)
+
+    def test_v3(self):
+        self.append(struct.pack("<BBf", 3, 15, 0.5))
+        self.assertIsNone(self.reader.update())
+        self.append(
+                v3_record(1, 1101, 't', 1200.0, 1000.0) +
+                v3_record(1, 1101, 'r', 1.0, 50.0) +  # Read metrics, ignored
+                v3_record(2, 2101, 't', 2500.0, 2000.0)
+                )
+        self.assertEqual(self.reader.update(), 3000.0)
+        record = v3_record(2, 2102, 't', 700.0, 600.0)
+        self.append(record[:10])
+        self.assertEqual(self.reader.update(), 3000.0)
+        self.append(record[10:] + v3_record(4, 1101, 't', 100.0, 80.0))
+        self.assertEqual(self.reader.update(), 3680.0)
+
+    def test_replaced_file(self):
+        self.append(struct.pack("<BB", 2, 10) + v2_record(1, 1101, 103, 1000.0) +
+                v2_record(1, 1102, 103, 1000.0))
+        self.assertEqual(self.reader.update(), 2000.0)
+        os.remove(self.path)
+        self.append(struct.pack("<BB", 2, 10) + v2_record(1, 1101, 103, 300.0))
+        self.assertEqual(self.reader.update(), 300.0)
+
+    def test_unsupported_version(self):
+        self.append(struct.pack("<BB", 1, 10) + v2_record(1, 1101, 103, 1000.0))
+        self.assertIsNone(self.reader.update())
+
+
+if __name__ == "__main__":
+    unittest.main()
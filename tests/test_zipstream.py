@@ -0,0 +1,78 @@
+import unittest
+import io
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+sys.path.append("../sav-downloader")
+
+import zipstream
+
+
+class ZipStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.contents = {
+                "RunInfo.xml": b"<RunInfo>" + b"x" * 5000 + b"</RunInfo>",
+                "InterOp/TileMetricsOut.bin": os.urandom(20000),
+                "Thumbnail_Images/L001/C1.1/s_1_1101_a.jpg": os.urandom(3000),
+                u"Logs/R\u00e9sum\u00e9.txt": b"",
+                }
+        self.files = []
+        for i, (arcname, data) in enumerate(sorted(self.contents.items())):
+            path = os.path.join(self.tempdir, "file{0}".format(i))
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.files.append((path, arcname))
+        self.limits = (zipstream.ZIP64_LIMIT, zipstream.ZIP64_COUNT_LIMIT, zipstream.ZIP64_MARGIN)
+
+    def tearDown(self):
+        zipstream.ZIP64_LIMIT, zipstream.ZIP64_COUNT_LIMIT, zipstream.ZIP64_MARGIN = self.limits
+        shutil.rmtree(self.tempdir)
+
+    def check_archive(self, files, chunk_size=zipstream.CHUNK_SIZE):
+        data = self.data = b"".join(zipstream.ZipStream(files, chunk_size=chunk_size))
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIsNone(archive.testzip())
+        arcnames = [arcname for path, arcname in files if os.path.exists(path)]
+        self.assertEqual(archive.namelist(), arcnames)
+        for arcname in arcnames:
+            self.assertEqual(archive.read(arcname), self.contents[arcname])
+        return archive
+
+    def test_archive(self):
+        archive = self.check_archive(self.files, chunk_size=1024)
+        self.assertEqual(archive.getinfo("RunInfo.xml").compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(
+                archive.getinfo("Thumbnail_Images/L001/C1.1/s_1_1101_a.jpg").compress_type,
+                zipfile.ZIP_STORED
+                )
+
+    def test_missing_file(self):
+        files = self.files[:1] + [(os.path.join(self.tempdir, "missing"), "missing.txt")] + self.files[1:]
+        self.check_archive(files)
+
+    def test_empty(self):
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(zipstream.ZipStream([]))))
+        self.assertEqual(archive.namelist(), [])
+
+    def test_zip64_members_and_offsets(self):
+        # Members above the limit get ZIP64 data descriptors, and offsets and
+        # the central directory beyond the limit use ZIP64 records
+        zipstream.ZIP64_LIMIT = 4000
+        zipstream.ZIP64_MARGIN = 100
+        archive = self.check_archive(self.files, chunk_size=1024)
+        self.assertIn(b"PK\x06\x06", self.data)
+        self.assertIn(b"PK\x06\x07", self.data)
+        self.assertGreater(archive.getinfo("Thumbnail_Images/L001/C1.1/s_1_1101_a.jpg").header_offset, 4000)
+
+    def test_zip64_count(self):
+        zipstream.ZIP64_COUNT_LIMIT = 2
+        self.check_archive(self.files)
+        self.assertIn(b"PK\x06\x06", self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()